@@ -1,4 +1,5 @@
 from src.graph_pipeline import GraphEduQuery
+from src.pipeline.streaming import StreamEvent
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -12,7 +13,11 @@ while True:
     if question == 'exit':
         break
     try:
-        resp = eq.ask(question=question, verbose=args.verbose)
-        print('\n', 'Answer:', resp, '\n\n')
+        # The answer is printed as it is generated
+        print('\n', 'Answer: ', end='', flush=True)
+        for event in eq.ask_stream(question=question, verbose=args.verbose):
+            if event.event == StreamEvent.TOKEN:
+                print(event.data, end='', flush=True)
+        print('\n\n')
     except Exception as e:
         print(e)
@@ -0,0 +1,104 @@
+import random
+import statistics
+import time
+from pathlib import Path
+from typing import List, Callable, Any, Tuple
+
+import yaml
+
+from src.api_keys import Neo4jDBConfig
+from src.datamodel.graph_db import Neo4jDB, CypherQueryRepository, QueryName
+from src.pipeline.entity_index import EntityIndex
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# This script compares resolving entity names with the in-memory EntityIndex against the
+# db.index.fulltext.queryNodes lookup on nameIndex. Run it after scripts/setup_neo4j.py has loaded the data.
+# Queries are the exact names, names with a typo and first words of names (e.g. a student's first name)
+
+SAMPLE_SIZE = 200
+SEED = 7
+
+
+def make_typo(name: str, rng: random.Random) -> str:
+    if len(name) < 4:
+        return name
+    i = rng.randrange(1, len(name) - 1)
+    edit = rng.choice(['drop', 'swap', 'replace'])
+    if edit == 'drop':
+        return name[:i] + name[i + 1:]
+    if edit == 'swap':
+        return name[:i - 1] + name[i] + name[i - 1] + name[i + 1:]
+    return name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[i + 1:]
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def time_calls(fn: Callable[[str], Any], queries: List[str]) -> Tuple[List[float], List[Any]]:
+    timings, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(fn(query))
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings, results
+
+
+def report(name: str, timings: List[float]) -> None:
+    print(f'{name:<12} mean {statistics.mean(timings):>10.1f}us  p50 {percentile(timings, 50):>10.1f}us  '
+          f'p95 {percentile(timings, 95):>10.1f}us  p99 {percentile(timings, 99):>10.1f}us')
+
+
+def run_benchmark():
+    root_folder = Path(__file__).resolve().parent.parent
+    with open(root_folder / 'config' / 'app_config.yaml') as file:
+        config = yaml.safe_load(file)
+
+    query_repo = CypherQueryRepository(
+        examples_file=config['db']['neo4j']['examples_file'],
+        queries_file=config['db']['neo4j']['queries_file']
+    )
+    with Neo4jDB(Neo4jDBConfig.NEO4J_URI, Neo4jDBConfig.NEO4J_USER, Neo4jDBConfig.NEO4J_PASSWORD,
+                 database=Neo4jDBConfig.NEO4J_DATABASE, **config['db']['neo4j']['driver']) as db:
+        # 1. Build the index
+        records = db.execute_read(query_repo.get_query(QueryName.ENTITY_NAMES_ALL))
+        index = EntityIndex(min_similarity=config['pipeline']['entity_index']['min_similarity'])
+        start = time.perf_counter()
+        index.sync(records)
+        print(f'Built index over {len(index)} names in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+        # 2. Sample the queries
+        rng = random.Random(SEED)
+        names = [record['name'] for record in records if record['name']]
+        sample = rng.sample(names, min(SAMPLE_SIZE, len(names)))
+        queries = {
+            'exact': sample,
+            'typo': [make_typo(name, rng) for name in sample],
+            'first word': [name.split()[0] for name in sample]
+        }
+
+        # 3. Compare
+        top_k = config['pipeline']['entity_resolution']['top_k']
+        fulltext_query = query_repo.get_query(QueryName.ENTITY_DB_FULLTEXT_SEARCH)
+        for kind, kind_queries in queries.items():
+            print(f'\n{kind} ({len(kind_queries)} queries)')
+            local_timings, local_results = time_calls(lambda value: index.lookup(value, top_k), kind_queries)
+            db_timings, db_results = time_calls(
+                lambda value: db.execute_read(fulltext_query, {"value": value}), kind_queries)
+            report('local index', local_timings)
+            report('fulltext', db_timings)
+
+            hits = sum(1 for result in local_results if result)
+            agree = sum(1 for local, remote in zip(local_results, db_results)
+                        if local and remote and local[0]['result'] == remote[0]['result'])
+            print(f'local hit rate {hits / len(kind_queries):.1%}, '
+                  f'top match agrees with fulltext on {agree / max(hits, 1):.1%} of the local hits')
+
+
+if __name__ == '__main__':
+    run_benchmark()
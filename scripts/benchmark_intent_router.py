@@ -0,0 +1,100 @@
+import argparse
+import json
+import statistics
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from src.graph_pipeline import GraphEduQuery
+import logging
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+# This script measures the intent router on the labelled questions in scripts/benchmark_questions.json:
+# coverage (share of the questions answered by a template), precision (routed to the labelled template),
+# and the time the routing takes. With --end-to-end it also answers every question with the router on and off,
+# to compare the latency of the template path with LLM Cypher generation.
+# Run it after scripts/setup_neo4j.py has loaded the data
+
+QUESTIONS_FILE = Path(__file__).resolve().parent / 'benchmark_questions.json'
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def extract_names(eq: GraphEduQuery, ner_chain: Any, question: str) -> List[str]:
+    names = eq.extract_known_entities(question)
+    if names is None:
+        names = ner_chain.invoke({'question': question})
+    return names[0]['args']['names']
+
+
+def measure_routing(eq: GraphEduQuery, questions: List[Dict[str, Any]]) -> None:
+    ner_chain = eq.prepare_ner_chain()
+    timings, routed, correct = [], 0, 0
+    for item in questions:
+        names = extract_names(eq, ner_chain, item['question'])
+        matches = eq.resolve_entities(names)
+        start = time.perf_counter()
+        result = eq.intent_router.route(item['question'], names, matches)
+        timings.append((time.perf_counter() - start) * 1e6)
+
+        intent = result[0] if result else None
+        routed += intent is not None
+        correct += intent is not None and intent == item['intent']
+        print(f'{"ok" if intent == item["intent"] else "MISS":<5} {str(intent):<28} {item["question"]}')
+
+    labelled = sum(1 for item in questions if item['intent'])
+    print(f'\ncoverage {routed / len(questions):.1%} ({routed}/{len(questions)}), '
+          f'labelled template questions {labelled}, precision {correct / max(routed, 1):.1%}, '
+          f'recall {correct / max(labelled, 1):.1%}')
+    print(f'routing mean {statistics.mean(timings):.1f}us  p50 {percentile(timings, 50):.1f}us  '
+          f'p95 {percentile(timings, 95):.1f}us  p99 {percentile(timings, 99):.1f}us')
+
+
+def measure_end_to_end(eq: GraphEduQuery, questions: List[Dict[str, Any]]) -> None:
+    router = eq.intent_router
+    for label, enabled in [('router on', True), ('router off', False)]:
+        eq.intent_router = router if enabled else None
+        timings, llm_calls = [], []
+        for item in questions:
+            try:
+                _, trace = eq.ask_with_trace(item['question'])
+            except Exception as e:
+                logger.warning(f'{label} failed on "{item["question"]}": {e}')
+                continue
+            timings.append(trace.total_ms)
+            llm_calls.append(sum(stats.llm_calls for stats in trace.stages.values()))
+        print(f'{label:<11} mean {statistics.mean(timings):>7.0f}ms  p50 {percentile(timings, 50):>7.0f}ms  '
+              f'p95 {percentile(timings, 95):>7.0f}ms  LLM calls per question {statistics.mean(llm_calls):.1f}')
+    eq.intent_router = router
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--end-to-end', action='store_true', help='also answer the questions with the router on and off')
+    args = parser.parse_args()
+
+    with open(QUESTIONS_FILE) as file:
+        questions = json.load(file)
+
+    eq = GraphEduQuery()
+    if eq.intent_router is None:
+        raise ValueError('Enable pipeline.intent_router in the config to benchmark it')
+    # Every question has to go through the pipeline
+    eq.answer_cache = None
+    eq.cypher_cache = None
+    eq.result_cache = None
+
+    measure_routing(eq, questions)
+    if args.end_to_end:
+        print()
+        measure_end_to_end(eq, questions)
+
+
+if __name__ == '__main__':
+    run_benchmark()
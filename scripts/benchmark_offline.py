@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import yaml
+from langchain_core.messages import BaseMessage
+
+from src.api_keys import Neo4jDBConfig
+from src.datamodel.graph_db import Neo4jDB
+from src.graph_pipeline import GraphEduQuery
+from src.pipeline.edu_query import PromptRepository
+from src.pipeline.offline import (FakeChatModel, Recording, RecordingNeo4jDB, RecordedNeo4jDB, AsyncRecordedNeo4jDB,
+                                  RecordedGraph)
+from src.pipeline.tracing import PipelineMetrics
+import logging
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+# This script benchmarks GraphEduQuery offline, without Gemini and Neo4j, so it runs on a bare machine in CI.
+# The LLM is a FakeChatModel with fixed latencies that replies with canned outputs built from the few-shot examples
+# in graph_examples.json and the labelled questions of scripts/benchmark_questions.json, and Neo4j is replayed from
+# scripts/benchmark_recording.json. The examples refer to ids, so they go through the NER and Cypher generation
+# calls, the labelled questions use the names of data/ and take the dictionary NER and intent router paths. Every question of the corpus
+# is asked --rounds times by N concurrent clients, and the p50/p95/p99 latency, the throughput and the per stage
+# breakdown are compared with scripts/benchmark_baseline.json. The script exits with 1 on a regression, when the
+# recording or the baseline is missing, when a query of the replay was not recorded, or when no question was
+# answered by the dictionary NER or routed to a template.
+# --record answers the corpus once against the Neo4j of the .env (the LLM stays fake, so the replay runs the same
+# queries) and saves the recording. --save-baseline stores the results as the new baseline.
+
+ROOT_FOLDER = Path(__file__).resolve().parent.parent
+EXAMPLES_FILE = ROOT_FOLDER / 'src' / 'datamodel' / 'queries' / 'graph_examples.json'
+QUESTIONS_FILE = Path(__file__).resolve().parent / 'benchmark_questions.json'
+RECORDING_FILE = Path(__file__).resolve().parent / 'benchmark_recording.json'
+BASELINE_FILE = Path(__file__).resolve().parent / 'benchmark_baseline.json'
+
+# Property values in the pattern of a query, {student_id: '1'}, are the entities the NER should find
+_PATTERN_VALUE = re.compile(r"\{\s*\w+\s*:\s*'([^']*)'")
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def build_corpus(answer_words: int) -> List[Dict[str, Any]]:
+    """
+    One item per few-shot example and labelled question: the question, the canned entities and Cypher query,
+    and an answer of `answer_words`
+    """
+    examples = []
+    for questions_file in [EXAMPLES_FILE, QUESTIONS_FILE]:
+        with open(questions_file) as file:
+            examples.extend(json.load(file))
+    return [{
+        'question': example['question'],
+        'names': _PATTERN_VALUE.findall(example['query']),
+        'query': example['query'],
+        'answer': ' '.join(f'word{i}' for i in range(answer_words))
+    } for example in examples]
+
+
+def canned_responder(prompt_repo: PromptRepository, corpus: List[Dict[str, Any]]) \
+        -> Callable[[List[BaseMessage]], str]:
+    """
+    Replies to the prompts of the pipeline, the prompt is told apart by its system message and the question
+    by its position: the few-shot examples in the Cypher prompts come after the question
+    """
+    ner_system = prompt_repo.get_ner_prompt()[0]
+    single_pass_system = prompt_repo.get_single_pass_prompt()[0]
+    cypher_system = prompt_repo.get_cypher_prompt()[0]
+
+    def respond(messages: List[BaseMessage]) -> str:
+        system, prompt = messages[0].content, messages[-1].content
+        found = [(prompt.find(item['question']), -len(item['question']), i) for i, item in enumerate(corpus)
+                 if item['question'] in prompt]
+        if not found:
+            raise ValueError(f'No canned output for the prompt: {prompt[:200]}')
+        item = corpus[min(found)[2]]
+        if system == ner_system:
+            return json.dumps({'names': item['names']})
+        if system == single_pass_system:
+            return json.dumps({'names': item['names'], 'query': item['query']})
+        if system == cypher_system:
+            return item['query']
+        return item['answer']
+
+    return respond
+
+
+def load_pipeline(args: argparse.Namespace, corpus: List[Dict[str, Any]], recording: Recording) -> GraphEduQuery:
+    with open(ROOT_FOLDER / 'config' / 'app_config.yaml') as file:
+        config = yaml.safe_load(file)
+
+    # Nothing is read from or written to the files of a live setup
+    config['pipeline']['mode'] = args.mode or config['pipeline']['mode']
+    config['pipeline']['schema_snapshot'] = None
+    config['pipeline']['cost_guard']['plan_log'] = None
+    config['pipeline']['answer_cache']['backend'] = 'memory'
+    # Every question has to go through all the stages
+    if not args.caches:
+        for cache in ['answer_cache', 'cypher_cache', 'result_cache']:
+            config['pipeline'][cache]['enabled'] = False
+
+    prompt_repo = PromptRepository(prompts_file=config['db']['neo4j']['prompts_file'])
+    llm = FakeChatModel(respond=canned_responder(prompt_repo, corpus), latency_ms=args.llm_latency,
+                        ms_per_token=args.ms_per_token)
+
+    if args.record:
+        db = RecordingNeo4jDB(Neo4jDB(Neo4jDBConfig.NEO4J_URI, Neo4jDBConfig.NEO4J_USER, Neo4jDBConfig.NEO4J_PASSWORD,
+                                      database=Neo4jDBConfig.NEO4J_DATABASE, **config['db']['neo4j']['driver']),
+                              recording)
+        eq = GraphEduQuery(config=config, llm=llm, db=db)
+    else:
+        eq = GraphEduQuery(config=config, llm=llm, graph=RecordedGraph(recording.schema),
+                           db=RecordedNeo4jDB(recording, latency_ms=args.db_latency),
+                           async_db_factory=lambda: AsyncRecordedNeo4jDB(recording, latency_ms=args.db_latency))
+    return eq
+
+
+def record(eq: GraphEduQuery, corpus: List[Dict[str, Any]], recording: Recording) -> None:
+    for item in corpus:
+        try:
+            eq.ask(item['question'])
+        except Exception as e:
+            logger.warning(f'Could not record "{item["question"]}": {e}')
+    recording.schema = eq.schema_cache.structured_schema
+    recording.save(RECORDING_FILE)
+    print(f'Recorded {len(recording.reads)} reads and {len(recording.plans)} plans to {RECORDING_FILE}')
+
+
+async def run_clients(eq: GraphEduQuery, questions: List[str], clients: int) -> Dict[str, Any]:
+    """
+    Answers the questions with `clients` concurrent clients, each one asks its next question when it has an answer
+    """
+    eq.metrics = PipelineMetrics()
+    pending = asyncio.Queue()
+    for question in questions:
+        pending.put_nowait(question)
+    latencies, errors = [], 0
+
+    async def client() -> None:
+        nonlocal errors
+        while not pending.empty():
+            question = pending.get_nowait()
+            try:
+                _, trace = await eq.aask_with_trace(question)
+            except Exception as e:
+                logger.warning(f'Failed on "{question}": {e}')
+                errors += 1
+            else:
+                latencies.append(trace.total_ms)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    elapsed = time.perf_counter() - start
+
+    stages = eq.latency_stats()['wall']
+    stages.pop(PipelineMetrics.TOTAL, None)
+    return {
+        'clients': clients,
+        'questions': len(questions),
+        'errors': errors,
+        'mean_ms': statistics.mean(latencies) if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) if latencies else 0.0,
+        'p95_ms': percentile(latencies, 95) if latencies else 0.0,
+        'p99_ms': percentile(latencies, 99) if latencies else 0.0,
+        'throughput_qps': len(latencies) / elapsed if elapsed else 0.0,
+        'stages': {stage: {'count': summary['count'], 'p50_ms': summary['p50_ms'], 'p95_ms': summary['p95_ms']}
+                   for stage, summary in stages.items()}
+    }
+
+
+async def run_benchmark_async(eq: GraphEduQuery, corpus: List[Dict[str, Any]], args: argparse.Namespace) \
+        -> List[Dict[str, Any]]:
+    questions = [item['question'] for item in corpus]
+    try:
+        # Warm up: the chain is built and the local entity index synced before the measured runs
+        await run_clients(eq, questions, 1)
+        return [await run_clients(eq, questions * args.rounds, clients) for clients in args.clients]
+    finally:
+        await eq.aclose()
+
+
+def report(runs: List[Dict[str, Any]]) -> None:
+    print(f'{"clients":>7} {"questions":>9} {"errors":>6} {"mean":>9} {"p50":>9} {"p95":>9} {"p99":>9} {"q/s":>8}')
+    for run in runs:
+        print(f'{run["clients"]:>7} {run["questions"]:>9} {run["errors"]:>6} {run["mean_ms"]:>7.1f}ms '
+              f'{run["p50_ms"]:>7.1f}ms {run["p95_ms"]:>7.1f}ms {run["p99_ms"]:>7.1f}ms {run["throughput_qps"]:>8.1f}')
+    for run in runs:
+        print(f'\nstages with {run["clients"]} clients')
+        for stage, summary in run['stages'].items():
+            print(f'  {stage:<20} {summary["count"]:>6} runs  p50 {summary["p50_ms"]:>7.1f}ms  '
+                  f'p95 {summary["p95_ms"]:>7.1f}ms')
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Regressions against the baseline: a latency percentile higher, or a throughput lower, by more than `tolerance`
+    """
+    if results['settings'] != baseline['settings']:
+        logger.warning(f'The baseline was measured with other settings: {baseline["settings"]}')
+    regressions = []
+    baseline_runs = {run['clients']: run for run in baseline['runs']}
+    for run in results['runs']:
+        base = baseline_runs.get(run['clients'])
+        if base is None:
+            continue
+        for metric in ['p50_ms', 'p95_ms', 'p99_ms']:
+            if run[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f'{run["clients"]} clients: {metric} {run[metric]:.1f} > {base[metric]:.1f}')
+        if run['throughput_qps'] < base['throughput_qps'] * (1 - tolerance):
+            regressions.append(f'{run["clients"]} clients: throughput {run["throughput_qps"]:.1f} '
+                               f'< {base["throughput_qps"]:.1f} q/s')
+        if run['errors'] > base['errors']:
+            regressions.append(f'{run["clients"]} clients: {run["errors"]} errors > {base["errors"]}')
+    return regressions
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=[GraphEduQuery.MODE_THREE_STAGE, GraphEduQuery.MODE_SINGLE_PASS],
+                        help='pipeline mode, pipeline.mode of the config by default')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16], help='concurrent clients per run')
+    parser.add_argument('--rounds', type=int, default=10, help='times every question is asked per run')
+    parser.add_argument('--llm-latency', type=float, default=200.0, help='ms before the first token of a reply')
+    parser.add_argument('--ms-per-token', type=float, default=2.0, help='ms per output token of a reply')
+    parser.add_argument('--db-latency', type=float, default=5.0, help='ms per Neo4j call')
+    parser.add_argument('--answer-words', type=int, default=50, help='length of the canned answers')
+    parser.add_argument('--caches', action='store_true', help='keep the answer, Cypher and result caches')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression against the baseline')
+    parser.add_argument('--record', action='store_true', help='record the Neo4j responses from the live database')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.answer_words)
+    if args.record:
+        recording = Recording()
+        record(load_pipeline(args, corpus, recording), corpus, recording)
+        return
+
+    if not RECORDING_FILE.exists():
+        print(f'No recording at {RECORDING_FILE}, run with --record first')
+        raise SystemExit(1)
+    recording = Recording.load(RECORDING_FILE)
+
+    eq = load_pipeline(args, corpus, recording)
+    runs = asyncio.run(run_benchmark_async(eq, corpus, args))
+    settings = {key: getattr(args, key) for key in ['mode', 'rounds', 'llm_latency', 'ms_per_token', 'db_latency',
+                                                    'answer_words', 'caches']}
+    # Questions that skipped the NER call or the Cypher generation, over all the runs
+    ner_stats, intent_stats = eq.ner_stats(), eq.intent_stats()
+    local_paths = {'dictionary_ner': ner_stats.get('fast_path', 0), 'intent_router': intent_stats.get('routed', 0)}
+    results = {'settings': settings, 'recording': recording.stats(), 'local_paths': local_paths, 'runs': runs}
+    report(runs)
+    print(f'\nrecorded responses: {recording.stats()["hits"]} hits, {recording.stats()["misses"]} misses')
+    print(f'answered locally: {local_paths["dictionary_ner"]} by the dictionary NER, '
+          f'{local_paths["intent_router"]} routed to a template')
+    # A query missing from the recording runs against empty records, the timings would not be comparable
+    if recording.stats()['misses']:
+        print(f'The replay ran queries that are not in {RECORDING_FILE}, run with --record to record them again')
+        raise SystemExit(1)
+    # The corpus has questions for both, none taking the local path means it is broken or was not measured.
+    # The single pass mode finds the entities and drafts the query in one LLM call, it has no local path
+    skipped = [path for path, stats in [('dictionary_ner', ner_stats), ('intent_router', intent_stats)]
+               if stats and not local_paths[path]
+               and eq.config['pipeline']['mode'] == GraphEduQuery.MODE_THREE_STAGE]
+    if skipped:
+        print(f'No question took the local path of {", ".join(skipped)}')
+        raise SystemExit(1)
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Saved the baseline to {BASELINE_FILE}')
+        return
+    if not BASELINE_FILE.exists():
+        print(f'No baseline at {BASELINE_FILE}, run with --save-baseline to store one')
+        raise SystemExit(1)
+
+    with open(BASELINE_FILE) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        raise SystemExit(1)
+    print(f'\nNo regression against the baseline (tolerance {args.tolerance:.0%})')
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,93 @@
+import json
+import statistics
+from pathlib import Path
+from typing import Any, Dict, List
+
+from src.graph_pipeline import GraphEduQuery
+import logging
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+# This script compares the three stage pipeline (entity recognition, Cypher generation and response as separate
+# LLM calls) with the single pass mode (one call for the entities and a draft query) on the labelled questions in
+# scripts/benchmark_questions.json. Run it after scripts/setup_neo4j.py has loaded the data.
+# Accuracy is execution accuracy: the records of the generated query match the records of the reference query
+
+QUESTIONS_FILE = Path(__file__).resolve().parent / 'benchmark_questions.json'
+MODES = [GraphEduQuery.MODE_THREE_STAGE, GraphEduQuery.MODE_SINGLE_PASS]
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def normalize_records(records: List[Dict[str, Any]]) -> List[tuple]:
+    """
+    Compares on the values only, in any row order, as the generated query may name its columns differently
+    """
+    def normalize(value: Any) -> Any:
+        if isinstance(value, float):
+            return round(value, 2)
+        if isinstance(value, (list, dict)):
+            return json.dumps(value, sort_keys=True, default=str)
+        return value
+
+    return sorted((tuple(sorted(map(str, map(normalize, record.values())))) for record in records))
+
+
+def run_mode(eq: GraphEduQuery, mode: str, questions: List[Dict[str, str]]) -> Dict[str, Any]:
+    eq.chain = eq.prepare_edu_query_chain(mode)
+    timings, tokens, llm_calls, correct, errors = [], [], [], 0, 0
+    for item in questions:
+        try:
+            _, trace = eq.ask_with_trace(item['question'])
+        except Exception as e:
+            logger.warning(f'{mode} failed on "{item["question"]}": {e}')
+            errors += 1
+            continue
+        timings.append(trace.total_ms)
+        tokens.append(trace.input_tokens + trace.output_tokens)
+        llm_calls.append(sum(stats.llm_calls for stats in trace.stages.values()))
+        try:
+            expected = normalize_records(eq.db.execute_read(item['query']))
+            if trace.query and normalize_records(eq.db.execute_read(trace.query)) == expected:
+                correct += 1
+        except Exception as e:
+            logger.warning(f'Could not compare the records for "{item["question"]}": {e}')
+    return {
+        'mode': mode,
+        'answered': len(timings),
+        'errors': errors,
+        'accuracy': correct / len(questions),
+        'mean_ms': statistics.mean(timings) if timings else 0.0,
+        'p50_ms': percentile(timings, 50) if timings else 0.0,
+        'p95_ms': percentile(timings, 95) if timings else 0.0,
+        'llm_calls': statistics.mean(llm_calls) if llm_calls else 0.0,
+        'tokens': statistics.mean(tokens) if tokens else 0.0
+    }
+
+
+def run_benchmark():
+    with open(QUESTIONS_FILE) as file:
+        questions = json.load(file)
+
+    eq = GraphEduQuery()
+    # Every question has to go through the LLM calls of the mode
+    eq.answer_cache = None
+    eq.cypher_cache = None
+    eq.result_cache = None
+
+    print(f'{"mode":<12} {"accuracy":>9} {"errors":>7} {"mean":>9} {"p50":>9} {"p95":>9} '
+          f'{"LLM calls":>10} {"tokens":>8}')
+    for mode in MODES:
+        result = run_mode(eq, mode, questions)
+        print(f'{result["mode"]:<12} {result["accuracy"]:>9.1%} {result["errors"]:>7} '
+              f'{result["mean_ms"]:>7.0f}ms {result["p50_ms"]:>7.0f}ms {result["p95_ms"]:>7.0f}ms '
+              f'{result["llm_calls"]:>10.1f} {result["tokens"]:>8.0f}')
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -1,9 +1,18 @@
+import argparse
 import yaml
 
-from src.datamodel.graph_db import Neo4jDB, CypherQueryRepository, QueryName
+from src.datamodel.graph_db import Neo4jDB, CypherQueryRepository, QueryName, chunked
+from src.datamodel.ingest_state import IngestionState, fingerprint_file, fingerprint_row
 from pathlib import Path
 import csv
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Tuple, Callable, Iterable, Any, Optional
 from src.api_keys import Neo4jDBConfig
+from neo4j.exceptions import ClientError
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -13,7 +22,8 @@ logger = logging.getLogger(__name__)
 # This script is used to load all courses in ./data folder into Neo4j DB
 # Opted for a functional approach than a single LOAD query so I can add any file-specific preprocessing if needed 
 
-def process_course_folder(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository) -> None:
+def process_course_folder(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository,
+                          writer: 'BulkWriter') -> bool:
     folder_name = course_folder.name
     course_id, semester, section_number = folder_name.split('_')
 
@@ -21,8 +31,9 @@ def process_course_folder(course_folder: Path, db: Neo4jDB, query_repo: CypherQu
     if is_course_created(course_id, semester, section_number, db, query_repo):
         logger.info(
             f'Course {course_id} for {semester} section {section_number} already exists. Skipping...')
-        return
+        return False
     create_course_node(course_id, semester, section_number, db, query_repo)
+    writer.add_written(1)
 
     # 2. Add Instructor Node
     instructors_file = course_folder / 'instructor.csv'
@@ -32,7 +43,7 @@ def process_course_folder(course_folder: Path, db: Neo4jDB, query_repo: CypherQu
     # 3. Add Student Nodes
     # Here we also create an extra relationship called ENROLLED to query faster
     students_file = course_folder / 'students.csv'
-    create_student_node(students_file, course_id, db, query_repo)
+    create_student_node(students_file, course_id, semester, section_number, db, query_repo)
 
     # 4. Add Assessment Nodes
     assessments_file = course_folder / 'assessments.csv'
@@ -51,14 +62,12 @@ def process_course_folder(course_folder: Path, db: Neo4jDB, query_repo: CypherQu
     # 7. Add Module Completion Edges
     module_completions_file = course_folder / 'student_module_completions.tsv'
     create_completed_module_relation(module_completions_file, db, query_repo)
-
-    # 8. Create nameIndex for DB matching Entities
-    create_name_index(db, query_repo)
+    return True
 
 
 def is_course_created(course_id: str, semester: str, section_number: str, db: Neo4jDB,
                       query_repo: CypherQueryRepository) -> bool:
-    result = db.run_query(query_repo.get_query(QueryName.COURSE_EXISTS), {
+    result = db.execute_read(query_repo.get_query(QueryName.COURSE_EXISTS), {
         "course_id": course_id,
         "semester": semester,
         "section_number": section_number
@@ -68,7 +77,7 @@ def is_course_created(course_id: str, semester: str, section_number: str, db: Ne
 
 def create_course_node(course_id: str, semester: str, section_number: str, db: Neo4jDB,
                        query_repo: CypherQueryRepository) -> None:
-    db.run_query(query_repo.get_query(QueryName.CREATE_COURSE), {
+    db.execute_write(query_repo.get_query(QueryName.CREATE_COURSE), {
         "course_id": course_id,
         "semester": semester,
         "section_number": section_number
@@ -78,7 +87,7 @@ def create_course_node(course_id: str, semester: str, section_number: str, db: N
 def create_instructor_node(file: Path, course_id: str, semester: str, section_number: str, db: Neo4jDB,
                            query_repo: CypherQueryRepository) -> None:
     def is_instructor_exist(instructor_id):
-        result = db.run_query(query_repo.get_query(QueryName.INSTRUCTOR_EXISTS), {
+        result = db.execute_read(query_repo.get_query(QueryName.INSTRUCTOR_EXISTS), {
             "instructor_id": instructor_id})
         return len(result) > 0
 
@@ -91,7 +100,7 @@ def create_instructor_node(file: Path, course_id: str, semester: str, section_nu
                         f'Instructor {row["instructor_id"]} already exists ans skipped')
                     continue  # skip
 
-                db.run_query(query_repo.get_query(QueryName.CREATE_INSTRUCTOR), {
+                db.execute_write(query_repo.get_query(QueryName.CREATE_INSTRUCTOR), {
                     "instructor_id": row["instructor_id"],
                     "instructor_name": row["instructor_name"],
                     "course_id": course_id,
@@ -101,9 +110,10 @@ def create_instructor_node(file: Path, course_id: str, semester: str, section_nu
         logger.info('Added Instructors')
 
 
-def create_student_node(file: Path, course_id: str, db: Neo4jDB, query_repo: CypherQueryRepository) -> None:
+def create_student_node(file: Path, course_id: str, semester: str, section_number: str, db: Neo4jDB,
+                        query_repo: CypherQueryRepository) -> None:
     def is_student_exists(student_id) -> bool:
-        result = db.run_query(query_repo.get_query(QueryName.STUDENT_EXISTS), {
+        result = db.execute_read(query_repo.get_query(QueryName.STUDENT_EXISTS), {
             "student_id": student_id})
         return len(result) > 0
 
@@ -115,14 +125,16 @@ def create_student_node(file: Path, course_id: str, db: Neo4jDB, query_repo: Cyp
                     logger.info(
                         f'Student {row["student_id"]} already exists, skipping node creation. But will be enrolled')
                 else:
-                    db.run_query(query_repo.get_query(QueryName.CREATE_STUDENT), {
+                    db.execute_write(query_repo.get_query(QueryName.CREATE_STUDENT), {
                         "student_id": row['student_id'],
                         "student_name": row['name']
                     })
 
-                db.run_query(query_repo.get_query(QueryName.CREATE_ENROLMENT), {
+                db.execute_write(query_repo.get_query(QueryName.CREATE_ENROLMENT), {
                     "student_id": row['student_id'],
-                    "course_id": course_id
+                    "course_id": course_id,
+                    "semester": semester,
+                    "section_number": section_number
                 })
         logger.info('Added Students')
 
@@ -132,7 +144,7 @@ def create_module_node(file: Path, course_id: str, db: Neo4jDB, query_repo: Cyph
         with open(file, mode='r') as f:
             reader = csv.DictReader(f)
             for row in reader:
-                db.run_query(query_repo.get_query(QueryName.CREATE_MODULE), {
+                db.execute_write(query_repo.get_query(QueryName.CREATE_MODULE), {
                     "module_id": row['module_id'],
                     "module_name": row['module_name'],
                     "course_id": course_id
@@ -145,7 +157,7 @@ def create_assessment_node(file: Path, course_id: str, db: Neo4jDB, query_repo:
         with open(file, mode='r') as f:
             reader = csv.DictReader(f)
             for row in reader:
-                db.run_query(query_repo.get_query(QueryName.CREATE_ASSESSMENT), {
+                db.execute_write(query_repo.get_query(QueryName.CREATE_ASSESSMENT), {
                     "assessment_id": row['assessment_id'],
                     "assessment_name": row['assessment_name'],
                     "course_id": course_id
@@ -158,7 +170,7 @@ def create_completed_assessment_relation(file: Path, db: Neo4jDB, query_repo: Cy
         with open(file, mode='r') as f:
             reader = csv.DictReader(f)
             for row in reader:
-                db.run_query(query_repo.get_query(QueryName.CREATE_COMPLETED_ASSESSMENT), {
+                db.execute_write(query_repo.get_query(QueryName.CREATE_COMPLETED_ASSESSMENT), {
                     "completion_id": row['completion_id'],
                     "assessment_id": row['assessment_id'],
                     "student_id": row['student_id'],
@@ -173,7 +185,7 @@ def create_completed_module_relation(file: Path, db: Neo4jDB, query_repo: Cypher
         with open(file, mode='r') as f:
             reader = csv.DictReader(f, delimiter='\t')
             for row in reader:
-                db.run_query(query_repo.get_query(QueryName.CREATE_COMPLETED_MODULE), {
+                db.execute_write(query_repo.get_query(QueryName.CREATE_COMPLETED_MODULE), {
                     "completion_id": row['completion_id'],
                     "student_id": row['student_id'],
                     "module_id": row['module_id'],
@@ -189,6 +201,751 @@ def create_name_index(db: Neo4jDB, query_repo: CypherQueryRepository) -> None:
     logger.info('Created Name Index')
 
 
+# Schema: every ingestion query and existence check looks nodes up by their ids. Without constraints or indexes each
+# lookup is a label scan, so the load time grows with the square of the data. The ids of Students and Instructors
+# are unique across courses and Courses are unique per (course_id, semester, section_number). Assessment and
+# Module ids are only unique within a course, so they get range indexes instead of constraints.
+
+SCHEMA_QUERIES = [
+    QueryName.CREATE_STUDENT_KEY,
+    QueryName.CREATE_INSTRUCTOR_KEY,
+    QueryName.CREATE_COURSE_KEY,
+    QueryName.CREATE_GRAPH_META_KEY,
+    QueryName.CREATE_COURSE_ID_INDEX,
+    QueryName.CREATE_ASSESSMENT_ID_INDEX,
+    QueryName.CREATE_MODULE_ID_INDEX
+]
+
+DROP_SCHEMA_QUERIES = [
+    QueryName.DEL_STUDENT_KEY,
+    QueryName.DEL_INSTRUCTOR_KEY,
+    QueryName.DEL_COURSE_KEY,
+    QueryName.DEL_GRAPH_META_KEY,
+    QueryName.DEL_COURSE_ID_INDEX,
+    QueryName.DEL_ASSESSMENT_ID_INDEX,
+    QueryName.DEL_MODULE_ID_INDEX
+]
+
+
+def create_schema(db: Neo4jDB, query_repo: CypherQueryRepository, timeout: float) -> None:
+    """
+    Creates the constraints and indexes that do not exist yet and waits until they are online
+    """
+    start = time.perf_counter()
+    for query_name in SCHEMA_QUERIES:
+        try:
+            db.run_query(query_repo.get_query(query_name))
+        except ClientError as e:
+            # A graph loaded without constraints may already hold duplicates, the load still works without it
+            logger.warning(f'Could not apply {query_name}, the existing data violates it: {e.message}')
+    db.run_query(query_repo.get_query(QueryName.AWAIT_INDEXES), {"timeout": timeout})
+    logger.info(f'Created constraints and indexes in {time.perf_counter() - start:.2f}s')
+
+
+def drop_schema(db: Neo4jDB, query_repo: CypherQueryRepository) -> None:
+    for query_name in DROP_SCHEMA_QUERIES:
+        db.run_query(query_repo.get_query(query_name))
+    logger.info('Dropped constraints and indexes')
+
+
+# Bulk ingestion: rows are streamed from the files and sent in chunks of batch_size as UNWIND queries,
+# each chunk committed in its own write transaction instead of one session per row.
+# Only one chunk per file is held in memory, so the size of the completion files does not matter.
+
+# Identify the Course node of a row, along with the key_fields of its file
+COURSE_KEY_FIELDS = ['course_id', 'semester', 'section_number']
+
+
+class BulkWriter:
+    """
+    Writes the rows of a course file with a batch query.
+    With an IngestionState the committed rows of every file are checkpointed after each chunk, and a load that was
+    interrupted resumes after the last committed chunk. A chunk that committed right before a crash is replayed,
+    which is harmless since the batch queries MERGE.
+    `written` counts the rows written or removed, a load that leaves it at 0 changed nothing in the graph.
+    """
+
+    def __init__(self, db: Neo4jDB, query_repo: CypherQueryRepository, batch_size: int,
+                 state: Optional[IngestionState] = None) -> None:
+        self.db = db
+        self.query_repo = query_repo
+        self.batch_size = batch_size
+        self.state = state
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def add_written(self, count: int) -> None:
+        with self._lock:
+            self.written += count
+
+    def _run_batch(self, query: str, rows: Iterable[Dict[str, Any]],
+                   on_commit: Optional[Callable[[int], None]] = None) -> int:
+        counted = 0
+
+        def commit(written: int) -> None:
+            # Counted per committed chunk, so the chunks that committed before a failure are counted too
+            nonlocal counted
+            self.add_written(written - counted)
+            counted = written
+            if on_commit is not None:
+                on_commit(written)
+
+        return self.db.run_batch(query, rows, self.batch_size, on_commit=commit)
+
+    def write(self, file: Path, rows: Iterable[Dict[str, Any]], query_name: str) -> int:
+        query = self.query_repo.get_query(query_name)
+        if self.state is None:
+            return self._run_batch(query, rows)
+
+        course, file_name = file.parent.name, file.name
+        if self.state.is_file_complete(course, file_name):
+            logger.info(f'{course}/{file_name} already loaded. Skipping...')
+            return 0
+        committed = self.state.get_committed_rows(course, file_name)
+        if committed:
+            logger.info(f'Resuming {course}/{file_name} after {committed} committed rows')
+            rows = islice(rows, committed, None)
+
+        count = self._run_batch(
+            query, rows,
+            on_commit=lambda written: self.state.save_checkpoint(course, file_name, committed + written)
+        )
+        self.state.mark_file_complete(course, file_name)
+        return count
+
+    def write_rows(self, rows: Iterable[Dict[str, Any]], query_name: str) -> int:
+        return self._run_batch(self.query_repo.get_query(query_name), rows)
+
+    def write_delta(self, file: Path, rows: Iterable[Dict[str, Any]], key_fields: List[str],
+                    upsert_query_name: str, delete_query_name: str) -> Tuple[int, int]:
+        """
+        Applies only the rows of the file that are new or changed since the last load, and removes the rows that
+        are no longer in the file. A row is identified by its key_fields. Returns the upserted and deleted counts.
+        Fingerprints are saved after the chunk they belong to commits, so an interrupted run picks up where it left.
+        """
+        course, file_name = file.parent.name, file.name
+        digest = fingerprint_file(file)
+        if self.state.get_file_digest(course, file_name) == digest:
+            logger.info(f'{course}/{file_name} is unchanged. Skipping...')
+            return 0, 0
+
+        generation = self.state.start_generation(course, file_name)
+        upsert_query = self.query_repo.get_query(upsert_query_name)
+        upserted = 0
+        for chunk in chunked(rows, self.batch_size):
+            fingerprints = {
+                '|'.join(row[field] for field in key_fields): (fingerprint_row(row), row) for row in chunk
+            }
+            stored = self.state.get_row_digests(course, file_name, list(fingerprints))
+            changed = [row for row_key, (row_digest, row) in fingerprints.items() if stored.get(row_key) != row_digest]
+            if changed:
+                self.state.add_stale_aggregates(aggregate_keys(course, changed))
+                upserted += self._run_batch(upsert_query, changed)
+            # Only the fields the delete queries and the aggregate refresh need are kept, not the free text
+            self.state.save_rows(course, file_name, generation,
+                                 [(row_key, row_digest, {field: row[field] for field in key_fields + COURSE_KEY_FIELDS
+                                                         if field in row})
+                                  for row_key, (row_digest, row) in fingerprints.items()])
+
+        delete_query = self.query_repo.get_query(delete_query_name)
+        deleted = 0
+        for chunk in self.state.iter_stale_rows(course, file_name, generation, self.batch_size):
+            stale = [row for _, row in chunk]
+            self.state.add_stale_aggregates(aggregate_keys(course, stale))
+            deleted += self._run_batch(delete_query, stale)
+            self.state.delete_rows(course, file_name, [row_key for row_key, _ in chunk])
+
+        self.state.save_file_digest(course, file_name, digest)
+        logger.info(f'{course}/{file_name}: {upserted} rows upserted, {deleted} rows removed')
+        return upserted, deleted
+
+
+def bulk_process_course_folder(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository,
+                               writer: BulkWriter) -> bool:
+    folder_name = course_folder.name
+    course_id, semester, section_number = parse_course_folder(course_folder)
+
+    # 1. Create course node. Skip if course already procesed, resume if it was interrupted.
+    if not should_load_course(course_folder, db, query_repo, writer.state):
+        return False
+    if writer.state is not None:
+        writer.state.start_course(folder_name)
+    if not is_course_created(course_id, semester, section_number, db, query_repo):
+        create_course_node(course_id, semester, section_number, db, query_repo)
+        writer.add_written(1)
+
+    # 2. Add Instructor Nodes
+    bulk_create_instructor_nodes(course_folder / 'instructor.csv', course_id, semester, section_number, writer)
+
+    # 3. Add Student Nodes along with the ENROLLED_IN relationship
+    bulk_create_student_nodes(course_folder / 'students.csv', course_id, semester, section_number, writer)
+
+    # 4. Add Assessment Nodes
+    bulk_create_assessment_nodes(course_folder / 'assessments.csv', course_id, writer)
+
+    # 5. Add Module Nodes
+    bulk_create_module_nodes(course_folder / 'modules.csv', course_id, writer)
+
+    # 6. Add Assessment Completion Edges
+    bulk_create_completed_assessment_relations(course_folder / 'student_assessment_completions.csv', writer)
+
+    # 7. Add Module Completion Edges
+    bulk_create_completed_module_relations(course_folder / 'student_module_completions.tsv', writer)
+
+    if writer.state is not None:
+        writer.state.mark_course_complete(folder_name)
+    return True
+
+
+def should_load_course(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository,
+                       state: Optional[IngestionState]) -> bool:
+    course_id, semester, section_number = parse_course_folder(course_folder)
+    if not is_course_created(course_id, semester, section_number, db, query_repo):
+        return True
+    # A course that exists without a checkpoint was loaded before checkpoints were kept
+    if state is not None and state.is_course_started(course_folder.name) \
+            and not state.is_course_complete(course_folder.name):
+        logger.info(f'Course {course_id} for {semester} section {section_number} was interrupted. Resuming...')
+        return True
+    logger.info(f'Course {course_id} for {semester} section {section_number} already exists. Skipping...')
+    return False
+
+
+def read_rows(file: Path, delimiter: str = ',') -> Iterator[Dict[str, str]]:
+    with open(file, mode='r', newline='') as f:
+        yield from csv.DictReader(f, delimiter=delimiter)
+
+
+def bulk_create_instructor_nodes(file: Path, course_id: str, semester: str, section_number: str,
+                                 writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "instructor_id": row["instructor_id"],
+            "instructor_name": row["instructor_name"],
+            "course_id": course_id,
+            "semester": semester,
+            "section_number": section_number
+        } for row in read_rows(file))
+        count = writer.write(file, rows, QueryName.CREATE_INSTRUCTOR_BATCH)
+        logger.info(f'Added {count} Instructors')
+        return count
+    return 0
+
+
+def bulk_create_student_nodes(file: Path, course_id: str, semester: str, section_number: str,
+                              writer: BulkWriter) -> int:
+    if file.exists():
+        # Enrolled in the section of the folder only, like the parallel and incremental loads
+        rows = ({
+            "student_id": row['student_id'],
+            "student_name": row['name'],
+            "course_id": course_id,
+            "semester": semester,
+            "section_number": section_number
+        } for row in read_rows(file))
+        count = writer.write(file, rows, QueryName.CREATE_STUDENT_ENROLMENT_BATCH)
+        logger.info(f'Added {count} Students')
+        return count
+    return 0
+
+
+def bulk_create_module_nodes(file: Path, course_id: str, writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "module_id": row['module_id'],
+            "module_name": row['module_name'],
+            "course_id": course_id
+        } for row in read_rows(file))
+        count = writer.write(file, rows, QueryName.CREATE_MODULE_BATCH)
+        logger.info(f'Added {count} Modules')
+        return count
+    return 0
+
+
+def bulk_create_assessment_nodes(file: Path, course_id: str, writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "assessment_id": row['assessment_id'],
+            "assessment_name": row['assessment_name'],
+            "course_id": course_id
+        } for row in read_rows(file))
+        count = writer.write(file, rows, QueryName.CREATE_ASSESSMENT_BATCH)
+        logger.info(f'Added {count} Assessments')
+        return count
+    return 0
+
+
+def bulk_create_completed_assessment_relations(file: Path, writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "completion_id": row['completion_id'],
+            "assessment_id": row['assessment_id'],
+            "student_id": row['student_id'],
+            "score": row['score'],
+            "attempts": row['attempts']
+        } for row in read_rows(file))
+        count = writer.write(file, rows, QueryName.CREATE_COMPLETED_ASSESSMENT_BATCH)
+        logger.info(f'Added {count} Assignment Submissions')
+        return count
+    return 0
+
+
+def bulk_create_completed_module_relations(file: Path, writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "completion_id": row['completion_id'],
+            "student_id": row['student_id'],
+            "module_id": row['module_id'],
+            "minutes_spent": row['minutes_spent'],
+            "feedback": row['feedback'],
+            "rating": row['rating']
+        } for row in read_rows(file, delimiter='\t'))
+        count = writer.write(file, rows, QueryName.CREATE_COMPLETED_MODULE_BATCH)
+        logger.info(f'Added {count} Module Completions')
+        return count
+    return 0
+
+
+# Parallel ingestion: independent course folders are loaded concurrently by a worker pool in three phases
+#   1. Courses along with their Assessments and Modules
+#   2. People. Student and Instructor nodes shared across courses are de-duplicated and merged once,
+#      then the TEACHES and ENROLLED_IN edges are added per course
+#   3. Completion edges
+# Each phase finishes for every course before the next one starts. Shared nodes (Assessments, Modules, Students
+# and Instructors) are merged once up front in chunks with disjoint keys, so no two workers ever MERGE the same
+# node and no duplicates are created even though the Assessment and Module keys have no uniqueness constraint.
+# The PART_OF edges go to every section of a course_id, so the folders of a course_id are handled by the same
+# worker one after another and never MERGE the same edge concurrently
+
+class FolderStats:
+    """
+    Rows written and time spent for a course folder across all phases
+    """
+
+    def __init__(self) -> None:
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, rows: int, seconds: float) -> None:
+        self.rows += rows
+        self.seconds += seconds
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def parse_course_folder(course_folder: Path) -> Tuple[str, str, str]:
+    course_id, semester, section_number = course_folder.name.split('_')
+    return course_id, semester, section_number
+
+
+def load_course_structure(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository,
+                          writer: BulkWriter) -> int:
+    course_id, semester, section_number = parse_course_folder(course_folder)
+    if not is_course_created(course_id, semester, section_number, db, query_repo):
+        create_course_node(course_id, semester, section_number, db, query_repo)
+        writer.add_written(1)
+    return 1 + sum([
+        bulk_create_assessment_relations(course_folder / 'assessments.csv', course_id, writer),
+        bulk_create_module_relations(course_folder / 'modules.csv', course_id, writer)
+    ])
+
+
+def load_people_relations(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository,
+                          writer: BulkWriter) -> int:
+    course_id, semester, section_number = parse_course_folder(course_folder)
+    return sum([
+        bulk_create_teaches_relations(course_folder / 'instructor.csv', course_id, semester, section_number, writer),
+        bulk_create_enrollment_relations(course_folder / 'students.csv', course_id, semester, section_number, writer)
+    ])
+
+
+def load_completions(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository,
+                     writer: BulkWriter) -> int:
+    return sum([
+        bulk_create_completed_assessment_relations(course_folder / 'student_assessment_completions.csv', writer),
+        bulk_create_completed_module_relations(course_folder / 'student_module_completions.tsv', writer)
+    ])
+
+
+def bulk_create_teaches_relations(file: Path, course_id: str, semester: str, section_number: str,
+                                  writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "instructor_id": row["instructor_id"],
+            "course_id": course_id,
+            "semester": semester,
+            "section_number": section_number
+        } for row in read_rows(file))
+        return writer.write(file, rows, QueryName.CREATE_TEACHES_BATCH)
+    return 0
+
+
+def bulk_create_enrollment_relations(file: Path, course_id: str, semester: str, section_number: str,
+                                     writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "student_id": row["student_id"],
+            "course_id": course_id,
+            "semester": semester,
+            "section_number": section_number
+        } for row in read_rows(file))
+        return writer.write(file, rows, QueryName.CREATE_ENROLMENT_BATCH)
+    return 0
+
+
+def bulk_create_assessment_relations(file: Path, course_id: str, writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "assessment_id": row['assessment_id'],
+            "assessment_name": row['assessment_name'],
+            "course_id": course_id
+        } for row in read_rows(file))
+        return writer.write(file, rows, QueryName.CREATE_ASSESSMENT_PART_OF_BATCH)
+    return 0
+
+
+def bulk_create_module_relations(file: Path, course_id: str, writer: BulkWriter) -> int:
+    if file.exists():
+        rows = ({
+            "module_id": row['module_id'],
+            "module_name": row['module_name'],
+            "course_id": course_id
+        } for row in read_rows(file))
+        return writer.write(file, rows, QueryName.CREATE_MODULE_PART_OF_BATCH)
+    return 0
+
+
+def merge_course_items(course_folders: List[Path], writer: BulkWriter, pool: ThreadPoolExecutor) -> None:
+    # The nodes are keyed by id and name, like the serial load
+    assessments = set()
+    modules = set()
+    for course_folder in course_folders:
+        if (course_folder / 'assessments.csv').exists():
+            for row in read_rows(course_folder / 'assessments.csv'):
+                assessments.add((row['assessment_id'], row['assessment_name']))
+        if (course_folder / 'modules.csv').exists():
+            for row in read_rows(course_folder / 'modules.csv'):
+                modules.add((row['module_id'], row['module_name']))
+
+    # Every chunk holds a disjoint set of keys, so concurrent MERGEs never race on the same node
+    futures = []
+    for query_name, item, keys in [
+        (QueryName.CREATE_ASSESSMENT_NODES_BATCH, 'assessment', assessments),
+        (QueryName.CREATE_MODULE_NODES_BATCH, 'module', modules)
+    ]:
+        rows = [{f'{item}_id': item_id, f'{item}_name': name} for item_id, name in sorted(keys)]
+        for chunk in chunked(rows, writer.batch_size):
+            futures.append(pool.submit(writer.write_rows, chunk, query_name))
+    for future in futures:
+        future.result()
+    logger.info(f'Merged {len(assessments)} Assessments and {len(modules)} Modules')
+
+
+def merge_people(course_folders: List[Path], writer: BulkWriter, pool: ThreadPoolExecutor) -> None:
+    # The first name seen for an id wins, same as ON CREATE SET in the queries
+    instructors: Dict[str, str] = {}
+    students: Dict[str, str] = {}
+    for course_folder in course_folders:
+        if (course_folder / 'instructor.csv').exists():
+            for row in read_rows(course_folder / 'instructor.csv'):
+                instructors.setdefault(row['instructor_id'], row['instructor_name'])
+        if (course_folder / 'students.csv').exists():
+            for row in read_rows(course_folder / 'students.csv'):
+                students.setdefault(row['student_id'], row['name'])
+
+    # Every chunk holds a disjoint set of ids, so concurrent MERGEs never race on the same node
+    futures = []
+    for query_name, key, name_key, people in [
+        (QueryName.CREATE_INSTRUCTOR_NODES_BATCH, 'instructor_id', 'instructor_name', instructors),
+        (QueryName.CREATE_STUDENT_NODES_BATCH, 'student_id', 'student_name', students)
+    ]:
+        rows = [{key: person_id, name_key: name} for person_id, name in people.items()]
+        for chunk in chunked(rows, writer.batch_size):
+            futures.append(pool.submit(writer.write_rows, chunk, query_name))
+    for future in futures:
+        future.result()
+    logger.info(f'Merged {len(instructors)} Instructors and {len(students)} Students')
+
+
+def run_phase(phase: Callable[..., int], course_groups: List[List[Path]], stats: Dict[str, FolderStats],
+              db: Neo4jDB, query_repo: CypherQueryRepository, writer: BulkWriter, pool: ThreadPoolExecutor) -> None:
+    def run_group(course_folders: List[Path]) -> None:
+        for course_folder in course_folders:
+            start = time.perf_counter()
+            rows = phase(course_folder, db, query_repo, writer)
+            stats[course_folder.name].add(rows, time.perf_counter() - start)
+
+    futures = [pool.submit(run_group, group) for group in course_groups]
+    for future in futures:
+        future.result()  # Re-raises the first failure
+    logger.info(f'Finished phase {phase.__name__}')
+
+
+def parallel_setup_courses(course_folders: List[Path], db: Neo4jDB, query_repo: CypherQueryRepository,
+                           writer: BulkWriter, workers: int) -> List[Path]:
+    pending = [course_folder for course_folder in course_folders
+               if should_load_course(course_folder, db, query_repo, writer.state)]
+    if writer.state is not None:
+        for course_folder in pending:
+            writer.state.start_course(course_folder.name)
+
+    course_groups: Dict[str, List[Path]] = {}
+    for course_folder in pending:
+        course_groups.setdefault(parse_course_folder(course_folder)[0], []).append(course_folder)
+    groups = list(course_groups.values())
+    stats = {course_folder.name: FolderStats() for course_folder in pending}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # 1. Assessments and Modules, then the courses and their PART_OF edges
+        merge_course_items(pending, writer, pool)
+        run_phase(load_course_structure, groups, stats, db, query_repo, writer, pool)
+
+        # 2. Students and Instructors, then their edges to the courses
+        merge_people(pending, writer, pool)
+        run_phase(load_people_relations, groups, stats, db, query_repo, writer, pool)
+
+        # 3. Assessment and Module Completion Edges
+        run_phase(load_completions, groups, stats, db, query_repo, writer, pool)
+    elapsed = time.perf_counter() - start
+
+    if writer.state is not None:
+        for course_folder in pending:
+            writer.state.mark_course_complete(course_folder.name)
+
+    for folder_name, folder_stats in stats.items():
+        logger.info(f'{folder_name}: {folder_stats.rows} rows in {folder_stats.seconds:.2f}s '
+                    f'({folder_stats.rows_per_second:.0f} rows/s)')
+    total_rows = sum(folder_stats.rows for folder_stats in stats.values())
+    logger.info(f'Loaded {len(pending)} course folders with {workers} workers: {total_rows} rows in {elapsed:.2f}s')
+    return pending
+
+
+# Incremental ingestion: instead of skipping a course that already exists, every file of the course folder is
+# compared against the fingerprints of the last load. Unchanged files are skipped, new or changed rows are
+# applied with MERGE/SET and the rows that were removed from a file are detached from the graph.
+# Every written or removed row marks the aggregates of its course, student, assessment and module as stale
+
+AGGREGATE_KEY_FIELDS = ['student_id', 'assessment_id', 'module_id']
+
+def incremental_process_course_folder(course_folder: Path, db: Neo4jDB, query_repo: CypherQueryRepository,
+                                      writer: BulkWriter) -> bool:
+    """
+    Syncs the course folder, returns whether anything was written
+    """
+    folder_name = course_folder.name
+    course_id, semester, section_number = parse_course_folder(course_folder)
+    written = writer.written
+
+    # 1. Create course node if it is new
+    writer.state.start_course(folder_name)
+    if not is_course_created(course_id, semester, section_number, db, query_repo):
+        db.execute_write(query_repo.get_query(QueryName.UPSERT_COURSE), {
+            "course_id": course_id,
+            "semester": semester,
+            "section_number": section_number
+        })
+        writer.state.add_stale_aggregates([('course', folder_name)])
+        writer.add_written(1)
+
+    # 2. Instructors and Students along with the TEACHES and ENROLLED_IN relationships
+    sync_instructors(course_folder / 'instructor.csv', course_id, semester, section_number, writer)
+    sync_students(course_folder / 'students.csv', course_id, semester, section_number, writer)
+
+    # 3. Assessments and Modules
+    sync_assessments(course_folder / 'assessments.csv', course_id, writer)
+    sync_modules(course_folder / 'modules.csv', course_id, writer)
+
+    # 4. Assessment and Module Completion Edges
+    sync_completed_assessments(course_folder / 'student_assessment_completions.csv', writer)
+    sync_completed_modules(course_folder / 'student_module_completions.tsv', writer)
+    writer.state.mark_course_complete(folder_name)
+    return writer.written > written
+
+
+def aggregate_keys(course: str, rows: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    """
+    Returns the (key_field, key_value) pairs of the course folder and of the ids in the rows that carry aggregates
+    """
+    keys = {('course', course)}
+    for row in rows:
+        keys.update((field, row[field]) for field in AGGREGATE_KEY_FIELDS if field in row)
+    return list(keys)
+
+
+def sync_instructors(file: Path, course_id: str, semester: str, section_number: str, writer: BulkWriter) -> None:
+    if file.exists():
+        rows = ({
+            "instructor_id": row["instructor_id"],
+            "instructor_name": row["instructor_name"],
+            "course_id": course_id,
+            "semester": semester,
+            "section_number": section_number
+        } for row in read_rows(file))
+        writer.write_delta(file, rows, ['instructor_id'],
+                           QueryName.UPSERT_INSTRUCTOR_BATCH, QueryName.DELETE_TEACHES_BATCH)
+
+
+def sync_students(file: Path, course_id: str, semester: str, section_number: str, writer: BulkWriter) -> None:
+    if file.exists():
+        rows = ({
+            "student_id": row['student_id'],
+            "student_name": row['name'],
+            "course_id": course_id,
+            "semester": semester,
+            "section_number": section_number
+        } for row in read_rows(file))
+        writer.write_delta(file, rows, ['student_id'],
+                           QueryName.UPSERT_STUDENT_ENROLMENT_BATCH, QueryName.DELETE_ENROLMENT_BATCH)
+
+
+def sync_assessments(file: Path, course_id: str, writer: BulkWriter) -> None:
+    if file.exists():
+        rows = ({
+            "assessment_id": row['assessment_id'],
+            "assessment_name": row['assessment_name'],
+            "course_id": course_id
+        } for row in read_rows(file))
+        # Assessments and Modules are merged on their id and shared by the courses that list it, a removed row only
+        # unlinks the node from this course. It is deleted along with its completions once no course links it
+        writer.write_delta(file, rows, ['assessment_id'],
+                           QueryName.UPSERT_ASSESSMENT_BATCH, QueryName.DELETE_ASSESSMENT_BATCH)
+
+
+def sync_modules(file: Path, course_id: str, writer: BulkWriter) -> None:
+    if file.exists():
+        rows = ({
+            "module_id": row['module_id'],
+            "module_name": row['module_name'],
+            "course_id": course_id
+        } for row in read_rows(file))
+        writer.write_delta(file, rows, ['module_id'],
+                           QueryName.UPSERT_MODULE_BATCH, QueryName.DELETE_MODULE_BATCH)
+
+
+def sync_completed_assessments(file: Path, writer: BulkWriter) -> None:
+    if file.exists():
+        rows = ({
+            "completion_id": row['completion_id'],
+            "assessment_id": row['assessment_id'],
+            "student_id": row['student_id'],
+            "score": row['score'],
+            "attempts": row['attempts']
+        } for row in read_rows(file))
+        # The relationship is merged on the (student, assessment) pair, so that is the row identity
+        writer.write_delta(file, rows, ['student_id', 'assessment_id'],
+                           QueryName.CREATE_COMPLETED_ASSESSMENT_BATCH, QueryName.DELETE_COMPLETED_ASSESSMENT_BATCH)
+
+
+def sync_completed_modules(file: Path, writer: BulkWriter) -> None:
+    if file.exists():
+        rows = ({
+            "completion_id": row['completion_id'],
+            "student_id": row['student_id'],
+            "module_id": row['module_id'],
+            "minutes_spent": row['minutes_spent'],
+            "feedback": row['feedback'],
+            "rating": row['rating']
+        } for row in read_rows(file, delimiter='\t'))
+        writer.write_delta(file, rows, ['student_id', 'module_id'],
+                           QueryName.CREATE_COMPLETED_MODULE_BATCH, QueryName.DELETE_COMPLETED_MODULE_BATCH)
+
+
+# Materialized aggregates: the completion properties are stored as numbers, and the Student, Assessment, Module and
+# Course nodes carry summary properties (counts, averages, totals), so the common questions read one node instead of
+# aggregating every completion. After a load only the aggregates of the loaded courses are recomputed, the
+# completions of those courses that were loaded as strings before are converted first.
+# After an incremental sync only the stale keys are recomputed: the courses, and the students, assessments and
+# modules of the rows that were written or removed
+
+AGGREGATE_QUERIES = [
+    QueryName.CAST_COMPLETED_ASSESSMENTS_BATCH,
+    QueryName.CAST_COMPLETED_MODULES_BATCH,
+    QueryName.REFRESH_ASSESSMENT_AGGREGATES_BATCH,
+    QueryName.REFRESH_MODULE_AGGREGATES_BATCH,
+    QueryName.REFRESH_STUDENT_AGGREGATES_BATCH,
+    QueryName.REFRESH_COURSE_AGGREGATES_BATCH
+]
+
+
+def refresh_aggregates(courses: List[Tuple[str, str, str]], db: Neo4jDB, query_repo: CypherQueryRepository,
+                       batch_size: int) -> int:
+    """
+    Recomputes the aggregates of the given courses, returns the number of rows written
+    """
+    rows = [{
+        "course_id": course_id,
+        "semester": semester,
+        "section_number": section_number
+    } for course_id, semester, section_number in courses]
+    if not rows:
+        return 0
+    start = time.perf_counter()
+    written = sum(db.run_batch(query_repo.get_query(query_name), rows, batch_size) for query_name in AGGREGATE_QUERIES)
+    logger.info(f'Refreshed the aggregates of {len(rows)} courses in {time.perf_counter() - start:.2f}s')
+    return written
+
+
+def refresh_stale_aggregates(state: IngestionState, db: Neo4jDB, query_repo: CypherQueryRepository,
+                             batch_size: int) -> int:
+    """
+    Recomputes the aggregates of the stale keys kept by the state, returns the number of rows written.
+    The keys are cleared once refreshed, so the ones left by an interrupted sync are refreshed on the next run.
+    """
+    keys = state.get_stale_aggregates()
+    if not keys:
+        return 0
+    start = time.perf_counter()
+    courses = [{
+        "course_id": course_id,
+        "semester": semester,
+        "section_number": section_number
+    } for course_id, semester, section_number in (parse_course_folder(Path(course))
+                                                  for course in sorted(keys.get('course', [])))]
+    batches = [
+        (QueryName.CAST_COMPLETED_ASSESSMENTS_BATCH, courses),
+        (QueryName.CAST_COMPLETED_MODULES_BATCH, courses)
+    ] + [
+        (query_name, [{field: value} for value in sorted(keys.get(field, []))])
+        for query_name, field in [(QueryName.REFRESH_ASSESSMENT_AGGREGATES_BY_ID_BATCH, 'assessment_id'),
+                                  (QueryName.REFRESH_MODULE_AGGREGATES_BY_ID_BATCH, 'module_id'),
+                                  (QueryName.REFRESH_STUDENT_AGGREGATES_BY_ID_BATCH, 'student_id')]
+    ] + [
+        (QueryName.REFRESH_COURSE_AGGREGATES_BATCH, courses)
+    ]
+    written = sum(db.run_batch(query_repo.get_query(query_name), rows, batch_size)
+                  for query_name, rows in batches if rows)
+    state.clear_stale_aggregates(keys)
+    logger.info(f'Refreshed the aggregates of {len(courses)} courses, {len(keys.get("student_id", []))} students, '
+                f'{len(keys.get("assessment_id", []))} assessments and {len(keys.get("module_id", []))} modules '
+                f'in {time.perf_counter() - start:.2f}s')
+    return written
+
+
+def bump_graph_version(db: Neo4jDB, query_repo: CypherQueryRepository) -> int:
+    # Lets running pipelines know that their caches are stale
+    result = db.execute_write(query_repo.get_query(QueryName.BUMP_GRAPH_VERSION))
+    logger.info(f'Graph data version is now {result[0]["version"]}')
+    return result[0]['version']
+
+
+def clear_graph(db: Neo4jDB, query_repo: CypherQueryRepository) -> None:
+    # 1. Delete Name index
+    db.run_query(query_repo.get_query(QueryName.DEL_NAME_INDEX))
+    logger.info('Deleted Name Index')
+
+    # 2. Delete Nodes and relationships. The GraphMeta node is kept, so the version keeps counting up and a
+    # number that keyed the answer and schema caches before the clean up is never handed out again
+    db.run_query(query_repo.get_query(QueryName.DEL_NODES_RELATIONSHIPS))
+    logger.info('Dropped all nodes and relationships')
+
+    # 3. Delete constraints and indexes, then stamp the next version
+    drop_schema(db, query_repo)
+    bump_graph_version(db, query_repo)
+
+
 def clean_up() -> None:
     root_folder = Path(__file__).resolve().parent.parent
 
@@ -200,54 +957,159 @@ def clean_up() -> None:
         queries_file=config['db']['neo4j']['queries_file']
     )
 
-    with Neo4jDB(Neo4jDBConfig.NEO4J_URI, Neo4jDBConfig.NEO4J_USER, Neo4jDBConfig.NEO4J_PASSWORD) as db:
+    with Neo4jDB(Neo4jDBConfig.NEO4J_URI, Neo4jDBConfig.NEO4J_USER, Neo4jDBConfig.NEO4J_PASSWORD,
+                 database=Neo4jDBConfig.NEO4J_DATABASE, **config['db']['neo4j']['driver']) as db:
+        clear_graph(db, query_repo)
 
-        # 1. Delete Name index
-        db.run_query(query_repo.get_query(QueryName.DEL_NAME_INDEX))
-        logger.info('Deleted Name Index')
+    # 4. Reset the ingestion checkpoints
+    with IngestionState(root_folder / config['ingestion']['state_file']) as state:
+        state.clear()
+        logger.info('Cleared ingestion checkpoints')
 
-        # 2. Delete Nodes and relationships
-        db.run_query(query_repo.get_query(QueryName.DEL_NODES_RELATIONSHIPS))
-        logger.info('Dropped all nodes and relationships')
 
+def load_courses(root_folder: Path, ingestion_cfg: Dict[str, Any], writer: BulkWriter) -> List[Path]:
+    """
+    Loads the course folders in ./data, returns the ones that were loaded, or changed by an incremental sync
+    """
+    courses_folder = root_folder / 'data'
+    db, query_repo = writer.db, writer.query_repo
 
-def setup_db():
-    root_folder = Path(__file__).resolve().parent.parent
-
-    with open(root_folder / 'config'/ 'app_config.yaml') as file:
-        config = yaml.safe_load(file)
-    # 1. Initialize Database
-    with Neo4jDB(Neo4jDBConfig.NEO4J_URI, Neo4jDBConfig.NEO4J_USER, Neo4jDBConfig.NEO4J_PASSWORD) as db:
-        query_repo = CypherQueryRepository(
-            examples_file=config['db']['neo4j']['examples_file'],
-            queries_file=config['db']['neo4j']['queries_file']
-        )
-        # 2. Populate data from CSV Files
-        courses_folder = root_folder / 'data'
-
+    if ingestion_cfg['mode'] == 'row':
+        loaded = []
         for course_folder in courses_folder.iterdir():
             if course_folder.is_dir():
                 try:
                     logger.info(
                         f'Processing course folder: {course_folder.name}')
-                    process_course_folder(course_folder, db, query_repo)
+                    if process_course_folder(course_folder, db, query_repo, writer):
+                        loaded.append(course_folder)
                 except Exception as e:
                     logger.warning(
                         f'Exception occurred while creating KG for {course_folder.name}')
                     raise e
             else:
                 logger.info(f'Skipping non-directory item: {course_folder}')
+        return loaded
+
+    course_folders = []
+    for course_folder in sorted(courses_folder.iterdir()):
+        if course_folder.is_dir():
+            course_folders.append(course_folder)
+        else:
+            logger.info(f'Skipping non-directory item: {course_folder}')
+
+    if ingestion_cfg['mode'] == 'incremental':
+        synced = []
+        for course_folder in course_folders:
+            logger.info(f'Syncing course folder: {course_folder.name}')
+            if incremental_process_course_folder(course_folder, db, query_repo, writer):
+                synced.append(course_folder)
+        return synced
+
+    if ingestion_cfg['workers'] > 1:
+        return parallel_setup_courses(course_folders, db, query_repo, writer, ingestion_cfg['workers'])
+
+    loaded = []
+    for course_folder in course_folders:
+        try:
+            logger.info(f'Processing course folder: {course_folder.name}')
+            if bulk_process_course_folder(course_folder, db, query_repo, writer):
+                loaded.append(course_folder)
+        except Exception as e:
+            logger.warning(
+                f'Exception occurred while creating KG for {course_folder.name}. '
+                f'Run the setup again to resume from the last checkpoint')
+            raise e
+    return loaded
+
+
+def refresh_all_aggregates() -> None:
+    root_folder = Path(__file__).resolve().parent.parent
+
+    with open(root_folder / 'config'/ 'app_config.yaml') as file:
+        config = yaml.safe_load(file)
+
+    query_repo = CypherQueryRepository(
+        examples_file=config['db']['neo4j']['examples_file'],
+        queries_file=config['db']['neo4j']['queries_file']
+    )
+
+    # Also converts the completions of data loaded before the properties were stored as numbers
+    with Neo4jDB(Neo4jDBConfig.NEO4J_URI, Neo4jDBConfig.NEO4J_USER, Neo4jDBConfig.NEO4J_PASSWORD,
+                 database=Neo4jDBConfig.NEO4J_DATABASE, **config['db']['neo4j']['driver']) as db:
+        courses = db.execute_read(query_repo.get_query(QueryName.ALL_COURSES))
+        refresh_aggregates([(course['course_id'], course['semester'], course['section_number']) for course in courses],
+                           db, query_repo, config['ingestion']['aggregate_batch_size'])
+        bump_graph_version(db, query_repo)
+
+
+def setup_db(schema: bool = True):
+    root_folder = Path(__file__).resolve().parent.parent
+
+    with open(root_folder / 'config'/ 'app_config.yaml') as file:
+        config = yaml.safe_load(file)
+    # 1. Initialize Database
+    with Neo4jDB(Neo4jDBConfig.NEO4J_URI, Neo4jDBConfig.NEO4J_USER, Neo4jDBConfig.NEO4J_PASSWORD,
+                 database=Neo4jDBConfig.NEO4J_DATABASE, **config['db']['neo4j']['driver']) as db:
+        query_repo = CypherQueryRepository(
+            examples_file=config['db']['neo4j']['examples_file'],
+            queries_file=config['db']['neo4j']['queries_file']
+        )
+        # 2. Constraints and indexes of the ids, before the data so every lookup of the load uses them
+        ingestion_cfg = config['ingestion']
+        ingestion_cfg['schema'] = ingestion_cfg['schema'] and schema
+        if ingestion_cfg['schema']:
+            create_schema(db, query_repo, ingestion_cfg['index_timeout'])
+        else:
+            logger.info('Loading without constraints and indexes')
+
+        # 3. Populate data from CSV Files, the checkpoints are only kept by the batch modes
+        state_file = root_folder / ingestion_cfg['state_file']
+        with (nullcontext() if ingestion_cfg['mode'] == 'row' else IngestionState(state_file)) as state:
+            writer = BulkWriter(db, query_repo, ingestion_cfg['batch_size'], state)
+            try:
+                start = time.perf_counter()
+                loaded = load_courses(root_folder, ingestion_cfg, writer)
+                schema = 'on' if ingestion_cfg['schema'] else 'off'
+                logger.info(f'Loaded {len(loaded)} course folders in {time.perf_counter() - start:.2f}s '
+                            f'({ingestion_cfg["mode"]} mode, constraints and indexes {schema})')
+
+                # 4. Create nameIndex for DB matching Entities, once for all courses
+                create_name_index(db, query_repo)
+
+                # 5. Recompute the aggregates of the loaded courses, or of the keys an incremental sync touched
+                if ingestion_cfg['mode'] == 'incremental':
+                    refreshed = refresh_stale_aggregates(state, db, query_repo, ingestion_cfg['aggregate_batch_size'])
+                else:
+                    refreshed = refresh_aggregates([parse_course_folder(course_folder) for course_folder in loaded],
+                                                   db, query_repo, ingestion_cfg['aggregate_batch_size'])
+                writer.add_written(refreshed)
+            finally:
+                # 6. Even a partial load changes the data, so the pipeline caches have to be invalidated.
+                # A run that wrote nothing, failed early or found every course loaded keeps the caches warm
+                if writer.written:
+                    bump_graph_version(db, query_repo)
+                else:
+                    logger.info('No data was written, the graph data version is unchanged')
 
 
 if __name__ == '__main__':
-    print("Select one of the options below (1 or 2):\n",
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-schema', action='store_true',
+                        help='load without the constraints and indexes, to compare the logged load time with them')
+    args = parser.parse_args()
+
+    print("Select one of the options below (1, 2 or 3):\n",
           "\t 1. Clean up database\n",
-          "\t 2. Setup database\n"
+          "\t 2. Setup database\n",
+          "\t 3. Recompute the aggregates of all courses\n"
           )
     choice = input("Your option: ")
     if choice == "1":
         clean_up()
+    elif choice == "3":
+        refresh_all_aggregates()
     else:
-        setup_db()
+        setup_db(schema=not args.no_schema)
 
 
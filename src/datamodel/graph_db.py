@@ -1,12 +1,28 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncGraphDatabase, Query, READ_ACCESS, WRITE_ACCESS, unit_of_work
+from neo4j.exceptions import TransientError, ServiceUnavailable, SessionExpired
+import asyncio
 import logging
+import time
 from pathlib import Path
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Iterable, Iterator, Callable, Optional, Tuple, Awaitable
+from itertools import islice
 import json
 
 logger = logging.getLogger(__name__)
 
 
+def chunked(rows: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """
+    Splits an iterable into lists of at most `size` items without materializing the whole iterable
+    """
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class QueryName:
     """
     This class has the keys for the queries that are stored in JSON file 
@@ -27,18 +43,91 @@ class QueryName:
     CREATE_COMPLETED_ASSESSMENT = 'create_completed_assessment'
     CREATE_COMPLETED_MODULE = 'create_completed_module'
 
+    # Bulk Create Queries (UNWIND over $rows)
+    CREATE_INSTRUCTOR_BATCH = 'create_instructor_batch'
+    CREATE_ASSESSMENT_BATCH = 'create_assessment_batch'
+    CREATE_MODULE_BATCH = 'create_module_batch'
+    CREATE_STUDENT_ENROLMENT_BATCH = 'create_student_enrollment_batch'
+    CREATE_INSTRUCTOR_NODES_BATCH = 'create_instructor_nodes_batch'
+    CREATE_STUDENT_NODES_BATCH = 'create_student_nodes_batch'
+    CREATE_ASSESSMENT_NODES_BATCH = 'create_assessment_nodes_batch'
+    CREATE_MODULE_NODES_BATCH = 'create_module_nodes_batch'
+    CREATE_TEACHES_BATCH = 'create_teaches_batch'
+    CREATE_ENROLMENT_BATCH = 'create_enrollment_batch'
+    CREATE_ASSESSMENT_PART_OF_BATCH = 'create_assessment_part_of_batch'
+    CREATE_MODULE_PART_OF_BATCH = 'create_module_part_of_batch'
+    CREATE_COMPLETED_ASSESSMENT_BATCH = 'create_completed_assessment_batch'
+    CREATE_COMPLETED_MODULE_BATCH = 'create_completed_module_batch'
+
+    # Incremental Load Queries
+    UPSERT_COURSE = 'upsert_course'
+    UPSERT_INSTRUCTOR_BATCH = 'upsert_instructor_batch'
+    UPSERT_STUDENT_ENROLMENT_BATCH = 'upsert_student_enrollment_batch'
+    UPSERT_ASSESSMENT_BATCH = 'upsert_assessment_batch'
+    UPSERT_MODULE_BATCH = 'upsert_module_batch'
+    DELETE_TEACHES_BATCH = 'delete_teaches_batch'
+    DELETE_ENROLMENT_BATCH = 'delete_enrollment_batch'
+    DELETE_ASSESSMENT_BATCH = 'delete_assessment_batch'
+    DELETE_MODULE_BATCH = 'delete_module_batch'
+    DELETE_COMPLETED_ASSESSMENT_BATCH = 'delete_completed_assessment_batch'
+    DELETE_COMPLETED_MODULE_BATCH = 'delete_completed_module_batch'
+
+    # Materialized aggregates, recomputed for the loaded courses ($rows of course keys)
+    ALL_COURSES = 'all_courses'
+    CAST_COMPLETED_ASSESSMENTS_BATCH = 'cast_completed_assessments_batch'
+    CAST_COMPLETED_MODULES_BATCH = 'cast_completed_modules_batch'
+    REFRESH_ASSESSMENT_AGGREGATES_BATCH = 'refresh_assessment_aggregates_batch'
+    REFRESH_MODULE_AGGREGATES_BATCH = 'refresh_module_aggregates_batch'
+    REFRESH_STUDENT_AGGREGATES_BATCH = 'refresh_student_aggregates_batch'
+    REFRESH_COURSE_AGGREGATES_BATCH = 'refresh_course_aggregates_batch'
+    # Recomputed for the students, assessments and modules touched by an incremental sync ($rows of ids)
+    REFRESH_ASSESSMENT_AGGREGATES_BY_ID_BATCH = 'refresh_assessment_aggregates_by_id_batch'
+    REFRESH_MODULE_AGGREGATES_BY_ID_BATCH = 'refresh_module_aggregates_by_id_batch'
+    REFRESH_STUDENT_AGGREGATES_BY_ID_BATCH = 'refresh_student_aggregates_by_id_batch'
+
+    # Schema: uniqueness constraints and range indexes of the id properties the ingestion queries look up
+    CREATE_STUDENT_KEY = 'create_student_key'
+    CREATE_INSTRUCTOR_KEY = 'create_instructor_key'
+    CREATE_COURSE_KEY = 'create_course_key'
+    CREATE_GRAPH_META_KEY = 'create_graph_meta_key'
+    CREATE_COURSE_ID_INDEX = 'create_course_id_index'
+    CREATE_ASSESSMENT_ID_INDEX = 'create_assessment_id_index'
+    CREATE_MODULE_ID_INDEX = 'create_module_id_index'
+    AWAIT_INDEXES = 'await_indexes'
+
     # Create name index for DB matching
     CREATE_NAME_INDEX = 'create_name_index'
 
     # Clean up
     DEL_NODES_RELATIONSHIPS = 'del_nodes_relationships'
     DEL_NAME_INDEX = 'del_name_index'
+    DEL_STUDENT_KEY = 'del_student_key'
+    DEL_INSTRUCTOR_KEY = 'del_instructor_key'
+    DEL_COURSE_KEY = 'del_course_key'
+    DEL_GRAPH_META_KEY = 'del_graph_meta_key'
+    DEL_COURSE_ID_INDEX = 'del_course_id_index'
+    DEL_ASSESSMENT_ID_INDEX = 'del_assessment_id_index'
+    DEL_MODULE_ID_INDEX = 'del_module_id_index'
+
+    # Graph data version, bumped after every load so the pipeline can invalidate its caches
+    GET_GRAPH_VERSION = 'get_graph_version'
+    BUMP_GRAPH_VERSION = 'bump_graph_version'
 
     # Pipeline Queries 
     ENTITY_DB_FULLTEXT_SEARCH = 'entity_db_fulltext_search'
+    ENTITY_DB_FULLTEXT_SEARCH_BATCH = 'entity_db_fulltext_search_batch'
+    ENTITY_NAMES_ALL = 'entity_names_all'
 
-    # [TODO] LLM tool queries
+    # Parameterized queries of the intent templates
     QA_STUDENT_PERFORMANCE = 'qa_student_performance'
+    QA_STUDENT_ASSESSMENT_RESULT = 'qa_student_assessment_result'
+    QA_ASSESSMENT_SUMMARY = 'qa_assessment_summary'
+    QA_ASSESSMENT_AVERAGE_SCORE = 'qa_assessment_average_score'
+    QA_MODULE_FEEDBACK = 'qa_module_feedback'
+    QA_MODULE_TIME_SPENT = 'qa_module_time_spent'
+    QA_COURSE_ENROLMENT = 'qa_course_enrolment'
+    QA_COURSE_COMPLETION = 'qa_course_completion'
+    QA_INSTRUCTOR_COURSES = 'qa_instructor_courses'
 
     # @Deprecated
     # ENTITY_DB_MATCH_QUERY = 'entity_db_match_query'
@@ -54,19 +143,21 @@ class CypherQueryRepository:
     """
     _instance = None
 
-    def __new__(cls, examples_file: str = None, queries_file: str = None):
+    def __new__(cls, examples_file: str = None, queries_file: str = None, templates_file: str = None):
         if cls._instance is None:
             cls._instance = super(CypherQueryRepository, cls).__new__(cls)
-            cls._instance._initialize(examples_file, queries_file)
+            cls._instance._initialize(examples_file, queries_file, templates_file)
         return cls._instance
 
-    def _initialize(self, examples_file: str, queries_file: str) -> None:
+    def _initialize(self, examples_file: str, queries_file: str, templates_file: str = None) -> None:
         if examples_file is None or queries_file is None:
             raise ValueError('File names must be provided on the first instantiation.')
 
         query_folder_path = Path(__file__).resolve().parent / 'queries'
         self.examples = self._load_json(query_folder_path / examples_file)
         self.queries = self._load_json(query_folder_path / queries_file)
+        # Intent templates are optional, only the question answering pipeline uses them
+        self.templates = self._load_json(query_folder_path / templates_file) if templates_file else {}
 
     def get_query(self, query_name: str) -> str:
         """
@@ -81,6 +172,9 @@ class CypherQueryRepository:
     def getExamples(self) -> List[Dict[str, str]]:
         return self.examples
 
+    def get_templates(self) -> Dict[str, Dict[str, Any]]:
+        return self.templates
+
     def _load_json(self, file_path: Path) -> Any:
         try:
             with open(file_path, 'r') as file:
@@ -94,12 +188,29 @@ class CypherQueryRepository:
 
 class Neo4jDB:
     """
-    This Class is used to perform CRUD operations on Neo4j Database
+    This Class is used to perform CRUD operations on Neo4j Database.
+    A single driver and its connection pool are shared by all the calls. Reads and writes run as managed
+    transactions with a timeout, and are retried with exponential backoff when the database is unavailable
+    or reports a transient error.
     """
 
-    def __init__(self, uri, user, password) -> None:
+    RETRYABLE_ERRORS = (TransientError, ServiceUnavailable, SessionExpired)
+
+    def __init__(self, uri, user, password, database: str = None, max_connection_pool_size: int = 100,
+                 connection_acquisition_timeout: float = 60.0, max_transaction_retry_time: float = 30.0,
+                 query_timeout: float = None, max_retries: int = 3, retry_backoff: float = 0.5) -> None:
+        self.driver = None
+        self.database = database or None  # Server default database
+        self.query_timeout = query_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
         try:
-            self.driver = GraphDatabase.driver(uri, auth=(user, password))
+            self.driver = GraphDatabase.driver(
+                uri, auth=(user, password),
+                max_connection_pool_size=max_connection_pool_size,
+                connection_acquisition_timeout=connection_acquisition_timeout,
+                max_transaction_retry_time=max_transaction_retry_time
+            )
         except Exception as e:
             logger.error(f'Failed to initialize Neo4j DB {e}')
 
@@ -114,7 +225,194 @@ class Neo4jDB:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
-    def run_query(self, query, parameters=None) -> List:
-        with self.driver.session() as session:
-            result = session.run(query, parameters)
+    def session(self, **kwargs):
+        return self.driver.session(database=self.database, **kwargs)
+
+    def run_query(self, query, parameters=None, timeout: float = None) -> List:
+        """
+        Runs the query in an auto-commit transaction. Used for schema changes like creating indexes.
+        """
+        with self.session() as session:
+            result = session.run(Query(query, timeout=timeout or self.query_timeout), parameters)
             return result.data()
+
+    def execute_read(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None,
+                     max_rows: int = None) -> List[Dict]:
+        """
+        Runs the query in a managed read transaction, which is routed to a reader in a cluster.
+        With `max_rows` the records are streamed and the read stops after that many.
+        """
+        return self._execute(READ_ACCESS, [(query, parameters)], timeout, max_rows)[0]
+
+    def explain(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None) -> Dict[str, Any]:
+        """
+        Plans the query with EXPLAIN without running it, returns the plan tree with the estimated rows per operator
+        """
+        @unit_of_work(timeout=timeout or self.query_timeout)
+        def work(tx):
+            return tx.run('EXPLAIN ' + query, parameters).consume().plan
+
+        def attempt():
+            with self.session() as session:
+                return session.execute_read(work)
+
+        return self._with_retry(attempt)
+
+    def execute_write(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None) -> List[Dict]:
+        """
+        Runs the query in a managed write transaction
+        """
+        return self._execute(WRITE_ACCESS, [(query, parameters)], timeout)[0]
+
+    def run_many(self, statements: List[Tuple[str, Optional[Dict[str, Any]]]],
+                 timeout: float = None) -> List[List[Dict]]:
+        """
+        Runs the (query, parameters) statements in order in one write transaction, either all of them commit or none.
+        Returns the records of every statement.
+        """
+        return self._execute(WRITE_ACCESS, statements, timeout)
+
+    def run_batch(self, query: str, rows: Iterable[Dict[str, Any]], batch_size: int = 1000,
+                  on_commit: Optional[Callable[[int], None]] = None) -> int:
+        """
+        Runs an UNWIND query over the rows in chunks of `batch_size`.
+        Each chunk is passed as the $rows parameter and committed in its own write transaction.
+        `on_commit` is called with the number of rows written so far after every committed chunk.
+        Returns the number of rows written.
+        """
+        count = 0
+        for chunk in chunked(rows, batch_size):
+            self._execute(WRITE_ACCESS, [(query, {'rows': chunk})])
+            count += len(chunk)
+            if on_commit is not None:
+                on_commit(count)
+        return count
+
+    def _execute(self, access_mode: str, statements: List[Tuple[str, Optional[Dict[str, Any]]]],
+                 timeout: float = None, max_rows: int = None) -> List[List[Dict]]:
+        @unit_of_work(timeout=timeout or self.query_timeout)
+        def work(tx):
+            return [self._records(tx.run(query, parameters), max_rows) for query, parameters in statements]
+
+        def attempt():
+            with self.session() as session:
+                if access_mode == READ_ACCESS:
+                    return session.execute_read(work)
+                return session.execute_write(work)
+
+        return self._with_retry(attempt)
+
+    @staticmethod
+    def _records(result: Any, max_rows: Optional[int]) -> List[Dict]:
+        if max_rows is None:
+            return result.data()
+        # The rest of the result is discarded with the transaction, only the fetched batches crossed the wire
+        return [record.data() for record in islice(result, max_rows)]
+
+    def _with_retry(self, fn: Callable[[], Any]) -> Any:
+        # The driver already retries transactions on transient errors for max_transaction_retry_time,
+        # this also covers failing to get a connection or losing the session
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn()
+            except self.RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning(f'Neo4j call failed with {type(e).__name__}: {e}. Retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+
+class AsyncNeo4jDB:
+    """
+    Async counterpart of Neo4jDB built on the async driver, so many questions can be served on one event loop.
+    It has the same pooling, timeout and retry behaviour. It must be created and used on the same event loop.
+    """
+
+    def __init__(self, uri, user, password, database: str = None, max_connection_pool_size: int = 100,
+                 connection_acquisition_timeout: float = 60.0, max_transaction_retry_time: float = 30.0,
+                 query_timeout: float = None, max_retries: int = 3, retry_backoff: float = 0.5) -> None:
+        self.database = database or None  # Server default database
+        self.query_timeout = query_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.driver = AsyncGraphDatabase.driver(
+            uri, auth=(user, password),
+            max_connection_pool_size=max_connection_pool_size,
+            connection_acquisition_timeout=connection_acquisition_timeout,
+            max_transaction_retry_time=max_transaction_retry_time
+        )
+
+    async def close(self):
+        await self.driver.close()
+
+    # Context Management
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def session(self, **kwargs):
+        return self.driver.session(database=self.database, **kwargs)
+
+    async def execute_read(self, query: str, parameters: Dict[str, Any] = None,
+                           timeout: float = None, max_rows: int = None) -> List[Dict]:
+        return (await self._execute(READ_ACCESS, [(query, parameters)], timeout, max_rows))[0]
+
+    async def explain(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None) -> Dict[str, Any]:
+        @unit_of_work(timeout=timeout or self.query_timeout)
+        async def work(tx):
+            result = await tx.run('EXPLAIN ' + query, parameters)
+            return (await result.consume()).plan
+
+        async def attempt():
+            async with self.session() as session:
+                return await session.execute_read(work)
+
+        return await self._with_retry(attempt)
+
+    async def execute_write(self, query: str, parameters: Dict[str, Any] = None,
+                            timeout: float = None) -> List[Dict]:
+        return (await self._execute(WRITE_ACCESS, [(query, parameters)], timeout))[0]
+
+    async def run_many(self, statements: List[Tuple[str, Optional[Dict[str, Any]]]],
+                       timeout: float = None) -> List[List[Dict]]:
+        return await self._execute(WRITE_ACCESS, statements, timeout)
+
+    async def _execute(self, access_mode: str, statements: List[Tuple[str, Optional[Dict[str, Any]]]],
+                       timeout: float = None, max_rows: int = None) -> List[List[Dict]]:
+        @unit_of_work(timeout=timeout or self.query_timeout)
+        async def work(tx):
+            records = []
+            for query, parameters in statements:
+                result = await tx.run(query, parameters)
+                if max_rows is None:
+                    records.append(await result.data())
+                    continue
+                rows = []
+                async for record in result:
+                    rows.append(record.data())
+                    if len(rows) >= max_rows:
+                        break
+                records.append(rows)
+            return records
+
+        async def attempt():
+            async with self.session() as session:
+                if access_mode == READ_ACCESS:
+                    return await session.execute_read(work)
+                return await session.execute_write(work)
+
+        return await self._with_retry(attempt)
+
+    async def _with_retry(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        for retry in range(self.max_retries + 1):
+            try:
+                return await fn()
+            except Neo4jDB.RETRYABLE_ERRORS as e:
+                if retry == self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2 ** retry
+                logger.warning(f'Neo4j call failed with {type(e).__name__}: {e}. Retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of host parameters in a statement
+_MAX_KEYS_PER_QUERY = 500
+
+
+def fingerprint_file(file: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint_row(row: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps(row, sort_keys=True).encode()).hexdigest()
+
+
+class IngestionState:
+    """
+    Keeps track of the ingestion progress in a local SQLite file so that an interrupted load can be resumed.
+    A checkpoint is the number of rows of a course file that are committed to the database.
+    For incremental loads it also keeps a fingerprint of every file and of every row, keyed by the row identity,
+    along with the generation (load number) in which the row was last seen. Only the identity fields of a row are
+    stored next to its fingerprint, enough to remove it from the graph, never the row itself.
+    The keys (course folder, student, assessment and module ids) whose aggregates are stale are kept until they
+    are refreshed, so a sync that was interrupted before its refresh catches up on the next run.
+    This Class is thread safe, the parallel loader shares one instance between the workers.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS courses (
+            course TEXT PRIMARY KEY,
+            complete INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS file_checkpoints (
+            course TEXT NOT NULL,
+            file TEXT NOT NULL,
+            rows_committed INTEGER NOT NULL DEFAULT 0,
+            complete INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (course, file)
+        );
+        CREATE TABLE IF NOT EXISTS file_fingerprints (
+            course TEXT NOT NULL,
+            file TEXT NOT NULL,
+            digest TEXT,
+            generation INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (course, file)
+        );
+        CREATE TABLE IF NOT EXISTS row_fingerprints (
+            course TEXT NOT NULL,
+            file TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            PRIMARY KEY (course, file, row_key)
+        );
+        CREATE TABLE IF NOT EXISTS stale_aggregates (
+            key_field TEXT NOT NULL,
+            key_value TEXT NOT NULL,
+            PRIMARY KEY (key_field, key_value)
+        );
+    """
+
+    def __init__(self, state_file: Path) -> None:
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(state_file), check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(self._SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    # Context Management
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Courses
+    def start_course(self, course: str) -> None:
+        self._execute('INSERT OR IGNORE INTO courses (course) VALUES (?)', (course,))
+
+    def is_course_started(self, course: str) -> bool:
+        return self._fetch_one('SELECT 1 FROM courses WHERE course = ?', (course,)) is not None
+
+    def is_course_complete(self, course: str) -> bool:
+        row = self._fetch_one('SELECT complete FROM courses WHERE course = ?', (course,))
+        return row is not None and bool(row[0])
+
+    def mark_course_complete(self, course: str) -> None:
+        self._execute('UPDATE courses SET complete = 1 WHERE course = ?', (course,))
+        logger.info(f'Checkpoint: course {course} complete')
+
+    # Files
+    def get_committed_rows(self, course: str, file: str) -> int:
+        row = self._fetch_one('SELECT rows_committed FROM file_checkpoints WHERE course = ? AND file = ?',
+                              (course, file))
+        return row[0] if row else 0
+
+    def is_file_complete(self, course: str, file: str) -> bool:
+        row = self._fetch_one('SELECT complete FROM file_checkpoints WHERE course = ? AND file = ?', (course, file))
+        return row is not None and bool(row[0])
+
+    def save_checkpoint(self, course: str, file: str, rows_committed: int) -> None:
+        self._execute(
+            'INSERT INTO file_checkpoints (course, file, rows_committed) VALUES (?, ?, ?) '
+            'ON CONFLICT (course, file) DO UPDATE SET rows_committed = excluded.rows_committed',
+            (course, file, rows_committed))
+
+    def mark_file_complete(self, course: str, file: str) -> None:
+        self._execute(
+            'INSERT INTO file_checkpoints (course, file, complete) VALUES (?, ?, 1) '
+            'ON CONFLICT (course, file) DO UPDATE SET complete = 1', (course, file))
+
+    # Fingerprints
+    def get_file_digest(self, course: str, file: str) -> Optional[str]:
+        row = self._fetch_one('SELECT digest FROM file_fingerprints WHERE course = ? AND file = ?', (course, file))
+        return row[0] if row else None
+
+    def save_file_digest(self, course: str, file: str, digest: str) -> None:
+        self._execute('UPDATE file_fingerprints SET digest = ? WHERE course = ? AND file = ?', (digest, course, file))
+
+    def start_generation(self, course: str, file: str) -> int:
+        """
+        Starts a new load of the file and returns its generation number
+        """
+        with self._lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO file_fingerprints (course, file, generation) VALUES (?, ?, 1) '
+                'ON CONFLICT (course, file) DO UPDATE SET generation = generation + 1', (course, file))
+            return self.conn.execute('SELECT generation FROM file_fingerprints WHERE course = ? AND file = ?',
+                                     (course, file)).fetchone()[0]
+
+    def get_row_digests(self, course: str, file: str, row_keys: List[str]) -> Dict[str, str]:
+        digests = {}
+        with self._lock:
+            for start in range(0, len(row_keys), _MAX_KEYS_PER_QUERY):
+                keys = row_keys[start:start + _MAX_KEYS_PER_QUERY]
+                placeholders = ', '.join('?' * len(keys))
+                digests.update(self.conn.execute(
+                    f'SELECT row_key, digest FROM row_fingerprints '
+                    f'WHERE course = ? AND file = ? AND row_key IN ({placeholders})',
+                    (course, file, *keys)).fetchall())
+        return digests
+
+    def save_rows(self, course: str, file: str, generation: int,
+                  rows: List[Tuple[str, str, Dict[str, Any]]]) -> None:
+        """
+        Stores the (row_key, digest, keys) of the rows seen in this generation, keys are the identity fields
+        """
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO row_fingerprints (course, file, row_key, digest, payload, generation) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (course, file, row_key) DO UPDATE SET '
+                'digest = excluded.digest, payload = excluded.payload, generation = excluded.generation',
+                [(course, file, row_key, digest, json.dumps(payload), generation)
+                 for row_key, digest, payload in rows])
+
+    def iter_stale_rows(self, course: str, file: str, generation: int,
+                        page_size: int) -> Iterator[List[Tuple[str, Dict[str, Any]]]]:
+        """
+        Yields the (row_key, keys) of the rows that were not seen in this generation, page_size rows at a time.
+        Every page is a new query that starts after the last row_key of the previous one, so the lock is not held
+        between pages and the caller can delete the rows of a page before it asks for the next one
+        """
+        last_key = ''
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    'SELECT row_key, payload FROM row_fingerprints '
+                    'WHERE course = ? AND file = ? AND generation < ? AND row_key > ? ORDER BY row_key LIMIT ?',
+                    (course, file, generation, last_key, page_size)).fetchall()
+            if not rows:
+                return
+            yield [(row_key, json.loads(payload)) for row_key, payload in rows]
+            last_key = rows[-1][0]
+
+    def delete_rows(self, course: str, file: str, row_keys: List[str]) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany('DELETE FROM row_fingerprints WHERE course = ? AND file = ? AND row_key = ?',
+                                  [(course, file, row_key) for row_key in row_keys])
+
+    # Aggregates
+    def add_stale_aggregates(self, keys: Iterable[Tuple[str, str]]) -> None:
+        """
+        Stores the (key_field, key_value) pairs whose aggregates have to be recomputed
+        """
+        with self._lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO stale_aggregates (key_field, key_value) VALUES (?, ?)',
+                                  list(keys))
+
+    def get_stale_aggregates(self) -> Dict[str, Set[str]]:
+        with self._lock:
+            rows = self.conn.execute('SELECT key_field, key_value FROM stale_aggregates').fetchall()
+        keys: Dict[str, Set[str]] = {}
+        for key_field, key_value in rows:
+            keys.setdefault(key_field, set()).add(key_value)
+        return keys
+
+    def clear_stale_aggregates(self, keys: Dict[str, Set[str]]) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany('DELETE FROM stale_aggregates WHERE key_field = ? AND key_value = ?',
+                                  [(key_field, key_value) for key_field, values in keys.items()
+                                   for key_value in values])
+
+    def clear(self) -> None:
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM stale_aggregates')
+            self.conn.execute('DELETE FROM row_fingerprints')
+            self.conn.execute('DELETE FROM file_fingerprints')
+            self.conn.execute('DELETE FROM file_checkpoints')
+            self.conn.execute('DELETE FROM courses')
+
+    def _execute(self, statement: str, parameters: tuple) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(statement, parameters)
+
+    def _fetch_one(self, statement: str, parameters: tuple):
+        with self._lock:
+            return self.conn.execute(statement, parameters).fetchone()
@@ -1,18 +1,39 @@
 from pathlib import Path
 import yaml
-from typing import Dict, Any, List
-from src.datamodel.graph_db import CypherQueryRepository, QueryName
-from langchain_core.runnables import RunnablePassthrough
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from functools import partial
+from typing import Dict, Any, List, Tuple, Iterator, AsyncIterator, Callable
+from src.datamodel.graph_db import CypherQueryRepository, QueryName, Neo4jDB, AsyncNeo4jDB
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableBranch
 from src.pipeline.llm import LLMFactory
-from src.pipeline.edu_query import EduQuery, PromptRepository, Entities
+from src.pipeline.cache import LRUCache, GraphVersion
+from src.pipeline.cypher_cache import CypherCache
+from src.pipeline.result_cache import ResultCache
+from src.pipeline.result_guard import ResultGuard
+from src.pipeline.cost_guard import CostGuard
+from src.pipeline.answer_cache import AnswerCache, MemoryAnswerBackend, DiskAnswerBackend, AnswerCacheBackend
+from src.pipeline.entity_index import EntityIndex
+from src.pipeline.dictionary_ner import DictionaryNER
+from src.pipeline.intent_router import IntentRouter
+from src.pipeline.example_selector import TfidfExampleSelector
+from src.pipeline.schema_cache import SchemaCache
+from src.pipeline.prompt_builder import CypherPromptBuilder
+from src.pipeline.tracing import QueryTrace, StageTraceHandler, PipelineMetrics, CURRENT_TRACE, db_timer
+from src.pipeline.streaming import StreamEvent, StreamEventHandler, StreamCancelHandler
+from src.pipeline.edu_query import EduQuery, PromptRepository, Entities, EntitiesAndCypher
+from src.pipeline.cypher_patch import patch_entity_literals
 from langchain_core.utils.function_calling import convert_to_openai_function
 from langchain_community.graphs import Neo4jGraph
-from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessage, get_buffer_string
+from langchain_core.language_models import BaseChatModel
 from src.api_keys import Neo4jDBConfig
-from langchain_community.chains.graph_qa.cypher_utils import CypherQueryCorrector, Schema
 from langchain_core.output_parsers import StrOutputParser
 from langchain.callbacks.tracers import ConsoleCallbackHandler
-from langchain_core.prompts import ChatPromptTemplate, FewShotChatMessagePromptTemplate
+from langchain_core.prompts import ChatPromptTemplate
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -24,10 +45,31 @@ class GraphEduQuery(EduQuery):
     EduQuery pipeline which uses Neo4j database as the backend
     """
 
-    def __init__(self) -> None:
-        self.config = self._load_config()
-        self.graph = self._load_graph()
-        self.llm = LLMFactory().get_LLM(
+    # Named runs of the chain that are timed in the QueryTrace of every question
+    STAGES = ['dictionary_ner', 'ner', 'entity_mapping', 'intent_router', 'cypher_cache', 'prompt_builder', 'cypher_generation',
+              'single_pass', 'cypher_patch', 'validation', 'cost_guard', 'db_execution', 'result_guard', 'response_generation']
+
+    # Pipeline modes, see pipeline.mode in app_config.yaml
+    MODE_THREE_STAGE = 'three_stage'
+    MODE_SINGLE_PASS = 'single_pass'
+
+    # Where the Cypher query of a question comes from, only generated queries are validated and cached
+    CYPHER_GENERATED = 'generated'
+    CYPHER_CACHED = 'cache'
+    CYPHER_TEMPLATE = 'template'
+
+    def __init__(self, config: Dict[str, Any] = None, llm: BaseChatModel = None, graph: Neo4jGraph = None,
+                 db: Neo4jDB = None, async_db_factory: Callable[[], AsyncNeo4jDB] = None) -> None:
+        """
+        The config, LLM, graph and databases are built from app_config.yaml and the environment unless they are
+        passed in, scripts/benchmark_offline.py passes stand-ins to run the pipeline without Gemini and Neo4j
+        """
+        self.config = config or self._load_config()
+        self.graph = graph or self._load_graph()
+        self.db = db or self._load_db()
+        self.async_dbs: Dict[asyncio.AbstractEventLoop, AsyncNeo4jDB] = {}  # One per event loop, created on first use
+        self._async_db_factory = async_db_factory or self._load_async_db
+        self.llm = llm or LLMFactory().get_LLM(
             llm_provider=self.config['use_llm'],
             cfg=self.config['llm'][self.config['use_llm']]
         )
@@ -36,9 +78,86 @@ class GraphEduQuery(EduQuery):
         )
         self.query_repo = CypherQueryRepository(
             examples_file=self.config['db']['neo4j']['examples_file'],
-            queries_file=self.config['db']['neo4j']['queries_file']
+            queries_file=self.config['db']['neo4j']['queries_file'],
+            templates_file=self.config['db']['neo4j']['templates_file']
         )
         self.chain = None
+        self.stream_chains = None  # The chain up to the DB results and the response chain, see ask_stream
+        self.metrics = PipelineMetrics()
+
+        # Caches are invalidated when scripts/setup_neo4j.py bumps the graph data version
+        self.graph_version = GraphVersion(
+            self._fetch_graph_version, self._afetch_graph_version,
+            check_interval=self.config['pipeline']['graph_version_check_interval']
+        )
+        entity_cfg = self.config['pipeline']['entity_resolution']
+        self.entity_cache = LRUCache(max_entries=entity_cfg['cache_size'], ttl=entity_cfg['cache_ttl'])
+        self.graph_version.add_listener(lambda _: self.entity_cache.clear())
+
+        # Optional router that answers the questions matching an intent template with its parameterized query
+        self.intent_router = None
+        if self.config['pipeline']['intent_router']['enabled']:
+            self.intent_router = IntentRouter(self.query_repo.get_templates(), self.query_repo.get_query,
+                                              ambiguity_ratio=entity_cfg['ambiguity_ratio'])
+
+        # Optional cache of the validated Cypher per question template and resolved entities, pinned entries are kept
+        self.cypher_cache = None
+        if self.config['pipeline']['cypher_cache']['enabled']:
+            self.cypher_cache = CypherCache(max_entries=self.config['pipeline']['cypher_cache']['cache_size'])
+            self.graph_version.add_listener(lambda _: self.cypher_cache.clear())
+
+        # Optional read-through cache of the records of the generated queries, bounded in entries and bytes
+        self.result_cache = None
+        result_cfg = self.config['pipeline']['result_cache']
+        if result_cfg['enabled']:
+            self.result_cache = ResultCache(max_entries=result_cfg['cache_size'], max_bytes=result_cfg['max_bytes'],
+                                            max_result_bytes=result_cfg['max_result_bytes'])
+            self.graph_version.add_listener(lambda _: self.result_cache.clear())
+
+        # Caps the rows read for a question, larger results are summarized before the response prompt
+        guard_cfg = self.config['pipeline']['result_guard']
+        self.result_guard = ResultGuard(max_rows=guard_cfg['max_rows'], max_prompt_rows=guard_cfg['max_prompt_rows'],
+                                        top_k=guard_cfg['top_k'])
+
+        # Optional preflight that plans the generated queries with EXPLAIN and rejects or rewrites the expensive ones
+        self.cost_guard = None
+        guard_cfg = self.config['pipeline']['cost_guard']
+        if guard_cfg['enabled']:
+            plan_log = guard_cfg['plan_log']
+            self.cost_guard = CostGuard(
+                max_estimated_rows=guard_cfg['max_estimated_rows'], max_label_scans=guard_cfg['max_label_scans'],
+                max_cartesian_products=guard_cfg['max_cartesian_products'],
+                allow_all_nodes_scan=guard_cfg['allow_all_nodes_scan'], max_hops=guard_cfg['max_hops'],
+                cache_size=guard_cfg['cache_size'],
+                plan_log=Path(__file__).resolve().parent.parent / plan_log if plan_log else None
+            )
+            self.graph_version.add_listener(lambda _: self.cost_guard.clear())
+
+        # Optional end-to-end cache of the answers, keyed on the question and the data version
+        self.answer_cache = None
+        if self.config['pipeline']['answer_cache']['enabled']:
+            self.answer_cache = AnswerCache(self._load_answer_backend())
+            self.graph_version.add_listener(lambda _: self.answer_cache.clear())
+
+        # Optional local index that resolves names without a DB round trip, and optional dictionary of the names
+        # that extracts them without the NER LLM call. Both are synced on the next question after a load
+        self.entity_index = None
+        if self.config['pipeline']['entity_index']['enabled']:
+            self.entity_index = EntityIndex(min_similarity=self.config['pipeline']['entity_index']['min_similarity'])
+        self.dictionary_ner = DictionaryNER() if self.config['pipeline']['dictionary_ner']['enabled'] else None
+        self._local_entities_stale = True
+        self.graph_version.add_listener(lambda _: setattr(self, '_local_entities_stale', True))
+
+        # Schema for the Cypher prompt and the corrector, re-read only when the data version changes
+        snapshot_file = self.config['pipeline']['schema_snapshot']
+        self.schema_cache = SchemaCache(
+            self.graph, snapshot_file=Path(__file__).resolve().parent.parent / snapshot_file if snapshot_file else None
+        )
+        self.schema_cache.load(self.graph_version.current())
+        self.graph_version.add_listener(self.schema_cache.refresh)
+
+        # Schema and examples of the Cypher prompt, pruned to the question and kept within the token budget
+        self.prompt_builder = self._load_prompt_builder()
 
     # Step 1: Named Entity Recognition
     def prepare_ner_chain(self):
@@ -52,91 +171,632 @@ class GraphEduQuery(EduQuery):
 
     # Step 2: Matching Entities with Nodes and Relations
     def map_to_database(self, values: List[str]) -> str:
-        match_query = self.query_repo.get_query(QueryName.ENTITY_DB_FULLTEXT_SEARCH)
-        result = ""
+        return self._format_entity_matches(self.resolve_entities(values))
+
+    async def amap_to_database(self, values: List[str]) -> str:
+        return self._format_entity_matches(await self.aresolve_entities(values))
+
+    def resolve_entities(self, values: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Resolves the names against the local entity index when enabled, then the entity cache, and sends the
+        remaining names to the nameIndex in one round trip.
+        Returns the top-k candidates per name as {'result': node, 'type': label, 'score': score}, best first.
+        """
+        self.refresh_local_entities('entity_mapping')
+        matches, missing = self._get_local_entities(values)
+        if missing:
+            with db_timer('entity_mapping'):
+                records = self.db.execute_read(self.query_repo.get_query(QueryName.ENTITY_DB_FULLTEXT_SEARCH_BATCH),
+                                               self._entity_search_params(missing))
+            matches.update(self._cache_entities(missing, records))
+        return {value: matches[value] for value in values}
+
+    async def aresolve_entities(self, values: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        await self.arefresh_local_entities('entity_mapping')
+        matches, missing = self._get_local_entities(values)
+        if missing:
+            with db_timer('entity_mapping'):
+                records = await self._get_async_db().execute_read(
+                    self.query_repo.get_query(QueryName.ENTITY_DB_FULLTEXT_SEARCH_BATCH),
+                    self._entity_search_params(missing))
+            matches.update(self._cache_entities(missing, records))
+        return {value: matches[value] for value in values}
+
+    def refresh_local_entities(self, stage: str) -> None:
+        """
+        Checks the graph data version and syncs the entity index and the dictionary NER with the names in the graph
+        when they are stale. The DB time goes to `stage` of the trace.
+        """
+        with db_timer(stage):
+            self.graph_version.current()
+            records = None
+            if self._local_entities_stale and (self.entity_index is not None or self.dictionary_ner is not None):
+                records = self.db.execute_read(self.query_repo.get_query(QueryName.ENTITY_NAMES_ALL))
+        if records is not None:
+            self._sync_local_entities(records)
+
+    async def arefresh_local_entities(self, stage: str) -> None:
+        with db_timer(stage):
+            await self.graph_version.acurrent()
+            records = None
+            if self._local_entities_stale and (self.entity_index is not None or self.dictionary_ner is not None):
+                records = await self._get_async_db().execute_read(
+                    self.query_repo.get_query(QueryName.ENTITY_NAMES_ALL))
+        if records is not None:
+            self._sync_local_entities(records)
+
+    def _sync_local_entities(self, records: List[Dict[str, Any]]) -> None:
+        self._local_entities_stale = False
+        if self.entity_index is not None:
+            self.entity_index.sync(records)
+        if self.dictionary_ner is not None:
+            self.dictionary_ner.sync(records)
+
+    # Step 1 without the LLM: names found in the dictionary, in the same format as the NER chain output
+    def extract_known_entities(self, question: str) -> Any:
+        if self.dictionary_ner is None:
+            return None
+        self.refresh_local_entities('dictionary_ner')
+        names = self.dictionary_ner.extract(question)
+        return None if names is None else [{'args': {'names': names}, 'type': Entities.__name__}]
+
+    async def aextract_known_entities(self, question: str) -> Any:
+        if self.dictionary_ner is None:
+            return None
+        await self.arefresh_local_entities('dictionary_ner')
+        names = self.dictionary_ner.extract(question)
+        return None if names is None else [{'args': {'names': names}, 'type': Entities.__name__}]
+
+    def _get_local_entities(self, values: List[str]) -> Tuple[Dict[str, List[Dict[str, Any]]], List[str]]:
+        matches, remaining = {}, values
+        if self.entity_index is not None:
+            top_k = self.config['pipeline']['entity_resolution']['top_k']
+            remaining = []
+            for value in values:
+                candidates = self.entity_index.lookup(value, top_k)
+                if candidates:
+                    matches[value] = candidates
+                else:
+                    remaining.append(value)
+
+        cached, missing = self._get_cached_entities(remaining)
+        matches.update(cached)
+        return matches, missing
+
+    def _get_cached_entities(self, values: List[str]) -> Tuple[Dict[str, List[Dict[str, Any]]], List[str]]:
+        matches, missing = {}, []
         for value in values:
-            response = self.graph.query(match_query, {"value": value})
-            try:
-                result += f"{value} maps to {response[0]['type']} node with properties: {response[0]['result']} in database\n"
-            except IndexError:
-                pass
+            candidates = self.entity_cache.get(self._normalize_entity(value))
+            if candidates is None:
+                missing.append(value)
+            else:
+                matches[value] = candidates
+        return matches, missing
+
+    def _cache_entities(self, values: List[str], records: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        # Names without any match are cached too, until the next data load
+        candidates = self._collect_candidates(values, records)
+        for value, value_candidates in candidates.items():
+            self.entity_cache.put(self._normalize_entity(value), value_candidates)
+        return candidates
+
+    @staticmethod
+    def _normalize_entity(value: str) -> str:
+        return ' '.join(value.casefold().split())
+
+    def _entity_search_params(self, values: List[str]) -> Dict[str, Any]:
+        return {"values": values, "top_k": self.config['pipeline']['entity_resolution']['top_k']}
+
+    def _collect_candidates(self, values: List[str], records: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        # Names without any match are not returned by the query
+        candidates = {record['value']: record['candidates'] for record in records}
+        return {value: candidates.get(value, []) for value in values}
+
+    def _format_entity_matches(self, matches: Dict[str, List[Dict[str, Any]]]) -> str:
+        ambiguity_ratio = self.config['pipeline']['entity_resolution']['ambiguity_ratio']
+        result = ""
+        for value, candidates in matches.items():
+            if not candidates:
+                continue
+            best = candidates[0]
+            result += f"{value} maps to {best['type']} node with properties: {best['result']} in database\n"
+
+            # Surface the other candidates that scored close to the best one
+            close = [c for c in candidates[1:] if c['score'] >= ambiguity_ratio * best['score']]
+            if close:
+                logger.info(f'Ambiguous entity {value}: {len(close) + 1} close matches')
+                result += f"{value} could also map to: " + "; ".join(
+                    f"{c['type']} node with properties: {c['result']}" for c in close) + "\n"
         return result
 
     # Step 3: Prepare cypher query based on identified entities and db match
     def prepare_cypher_response(self, entity_chain):
 
-        # 1. Few-shot Examples - pull examples from the repository
-        example_prompt = ChatPromptTemplate.from_messages(
-            [(self.HUMAN_MESSAGE, "{question}"), (self.SYSTEM_MESSAGE, "{query}")]
+        # 1. Create Prompt
+        system, human = self.prompt_repo.get_cypher_prompt()
+        cypher_prompt = ChatPromptTemplate.from_messages([(self.SYSTEM_MESSAGE, system), (self.HUMAN_MESSAGE, human)])
+
+        # 2. Prepare chain
+        async def aresolve(x):
+            return await self.aresolve_entities(self._entity_names(x))
+
+        generate_cypher = (
+                RunnableLambda(self._build_cypher_prompt, name='prompt_builder')
+                | RunnablePassthrough.assign(
+            query=(cypher_prompt
+                   | self.llm.bind(stop=["\nCypherResult:"])
+                   | self._clean_cypher_output).with_config(run_name='cypher_generation')
+        )
         )
 
-        # [TODO] When the number of examples increases, migrate to SemanticSimilarityExampleSelector
-        few_shot_prompt = FewShotChatMessagePromptTemplate(
-            examples=self.query_repo.getExamples(),
-            example_prompt=example_prompt,
+        async def aextract(x):
+            return await self.aextract_known_entities(x['question'])
+
+        # Every step is a named run, timed by the StageTraceHandler.
+        # The NER LLM call only runs when the dictionary is not confident,
+        # questions matching an intent template or found in the Cypher cache skip the generation step
+        cypher_response = (
+                RunnablePassthrough.assign(known_names=RunnableLambda(
+            lambda x: self.extract_known_entities(x['question']), afunc=aextract, name='dictionary_ner'
+        ))
+                | RunnablePassthrough.assign(names=RunnableBranch(
+            (lambda x: x['known_names'] is not None, lambda x: x['known_names']),
+            entity_chain.with_config(run_name='ner')
+        ))
+                | RunnablePassthrough.assign(
+            entity_matches=RunnableLambda(
+                lambda x: self.resolve_entities(self._entity_names(x)),
+                afunc=aresolve,
+                name='entity_mapping'
+            ))
+                | RunnableLambda(self._route_intent, name='intent_router')
+                | RunnableLambda(self._lookup_cypher, name='cypher_cache')
+                | RunnableBranch((lambda x: x['cypher_source'] != self.CYPHER_GENERATED, RunnablePassthrough()),
+                                 generate_cypher)
         )
+        return cypher_response
 
-        # 2. Create Prompt
-        system, human = self.prompt_repo.get_cypher_prompt()
-        cypher_prompt = ChatPromptTemplate.from_messages([(self.SYSTEM_MESSAGE, system), (self.HUMAN_MESSAGE, human)])
+    @staticmethod
+    def _entity_names(x: Dict[str, Any]) -> List[str]:
+        return x['names'][0]['args']['names']
+
+    def _build_cypher_prompt(self, x: Dict[str, Any]) -> Dict[str, Any]:
+        entities_list = self._format_entity_matches(x['entity_matches'])
+        return {**x, 'entities_list': entities_list,
+                **self.prompt_builder.build(x['question'], x['entity_matches'], entities_list)}
+
+    def _route_intent(self, x: Dict[str, Any]) -> Dict[str, Any]:
+        routed = None
+        if self.intent_router is not None:
+            routed = self.intent_router.route(x['question'], self._entity_names(x), x['entity_matches'])
+        if routed is None:
+            return {**x, 'cypher_source': self.CYPHER_GENERATED, 'params': None}
+        intent, query, params = routed
+        logger.info(f'Routed to the {intent} template with {params}')
+        return {**x, 'cypher_source': self.CYPHER_TEMPLATE, 'query': query, 'params': params}
 
-        # 3. Prepare chain
+    def _lookup_cypher(self, x: Dict[str, Any]) -> Dict[str, Any]:
+        if self.cypher_cache is None or x['cypher_source'] != self.CYPHER_GENERATED:
+            return {**x, 'cypher_key': None}
+        key = self.cypher_cache.key(x['question'], self._entity_names(x), x['entity_matches'])
+        query = self.cypher_cache.get(key)
+        if query is None:
+            return {**x, 'cypher_key': key}
+        return {**x, 'cypher_key': key, 'cypher_source': self.CYPHER_CACHED, 'query': query}
+
+    def pin_cypher(self, question: str, query: str) -> None:
+        """
+        Pins a known-good Cypher query for the question, and for the questions that only differ from it in wording.
+        The question goes through the same entity recognition and resolution as ask() to build the cache key.
+        Cached queries skip the validation and the guards at lookup, so the query is corrected, limited and planned
+        here. Raises QueryCostError when it is over the budget of the cost guard.
+        """
+        if self.cypher_cache is None:
+            raise ValueError('The Cypher cache is disabled in the config')
+        entities = self.extract_known_entities(question)
+        if entities is None:
+            entities = self.prepare_ner_chain().invoke({'question': question})
+        names = self._entity_names({'names': entities})
+        key = self.cypher_cache.key(question, names, self.resolve_entities(names))
+        query = self.result_guard.limit(self.schema_cache.corrector(query))
+        if self.cost_guard is not None:
+            query = self.cost_guard.check(question, query, None, self.db.explain)
+        self.cypher_cache.pin(key, query)
+
+    # Step 1 to 3 in single pass mode: one LLM call extracts the entities and drafts the Cypher query,
+    # the entity names in the draft are then patched with the values of the nodes they resolved to
+    def prepare_single_pass_response(self):
+        system, human = self.prompt_repo.get_single_pass_prompt()
+        single_pass_prompt = ChatPromptTemplate.from_messages(
+            [(self.SYSTEM_MESSAGE, system), (self.HUMAN_MESSAGE, human)]
+        )
+
+        async def aresolve(x):
+            return await self.aresolve_entities(x['draft'].names)
+
+        def patch(x):
+            query = patch_entity_literals(self._clean_cypher(x['draft'].query), x['draft'].names, x['entity_matches'])
+            logger.info(query)
+            return {**x, 'query': query, 'params': None, 'cypher_key': None, 'cypher_source': self.CYPHER_GENERATED}
+
+        # The entities are not known before the LLM call, the schema is pruned to the labels the question names
         cypher_response = (
-                RunnablePassthrough.assign(names=entity_chain)
+                RunnableLambda(lambda x: {**x, **self.prompt_builder.build(x['question'], {}, '')},
+                               name='prompt_builder')
                 | RunnablePassthrough.assign(
-            entities_list=lambda x: self.map_to_database(x['names'][0]['args']['names']),
-            schema=lambda _: self.graph.get_schema)
+            draft=(single_pass_prompt
+                   | self.llm.with_structured_output(EntitiesAndCypher)).with_config(run_name='single_pass')
+        )
                 | RunnablePassthrough.assign(
-            examples=lambda _: few_shot_prompt.format()
+            entity_matches=RunnableLambda(
+                lambda x: self.resolve_entities(x['draft'].names),
+                afunc=aresolve,
+                name='entity_mapping'
+            )
         )
-                | cypher_prompt
-                | self.llm.bind(stop=["\nCypherResult:"])
-                | self._clean_cypher_output
+                | RunnableLambda(patch, name='cypher_patch')
         )
         return cypher_response
 
+    def _load_prompt_builder(self) -> CypherPromptBuilder:
+        example_prompt = ChatPromptTemplate.from_messages(
+            [(self.HUMAN_MESSAGE, "{question}"), (self.SYSTEM_MESSAGE, "{query}")]
+        )
+
+        # With the selector only the k examples closest to the question go into the prompt
+        examples = self.query_repo.getExamples()
+        selector_cfg = self.config['pipeline']['example_selector']
+        if selector_cfg['enabled']:
+            selector = TfidfExampleSelector(examples, k=selector_cfg['k'], n_features=selector_cfg['n_features'])
+            select_examples = lambda question: selector.select_examples({'question': question})
+        else:
+            select_examples = lambda _: examples
+
+        prompt_cfg = self.config['pipeline']['cypher_prompt']
+        return CypherPromptBuilder(
+            self.schema_cache,
+            select_examples=select_examples,
+            format_example=lambda example: get_buffer_string(example_prompt.format_messages(**example)),
+            hops=prompt_cfg['schema_hops'],
+            max_tokens=prompt_cfg['max_tokens']
+        )
+
     # Step 4. Validate Cypher and Create Final Response
     def prepare_response_chain(self, cypher_response):
-        # Cypher Validation
-        corrector_schema = [
-            Schema(el["start"], el["type"], el["end"])
-            for el in self.graph.structured_schema.get("relationships")
-        ]
-        cypher_validation = CypherQueryCorrector(corrector_schema)
+        return self.prepare_context_chain(cypher_response) | self.prepare_answer_chain()
 
-        # Prompt
-        system, human = self.prompt_repo.get_response_prompt()
-        response_prompt = ChatPromptTemplate.from_messages(
-            [(self.SYSTEM_MESSAGE, system), (self.HUMAN_MESSAGE, human)]
-        )
+    def prepare_context_chain(self, cypher_response):
+        # Cypher Validation, the corrector is shared and rebuilt along with the schema
+        def cypher_validation(query: str) -> str:
+            return self.schema_cache.corrector(query)
+
+        # Queries already run on the current data version are answered from the result cache.
+        # At most max_rows records are read, the rest of the result is never fetched
+        max_rows = self.result_guard.max_rows
+
+        def execute_read(query, params, timeout=None):
+            return self.db.execute_read(query, params, timeout=timeout, max_rows=max_rows)
+
+        async def aexecute_read(query, params, timeout=None):
+            return await self._get_async_db().execute_read(query, params, timeout=timeout, max_rows=max_rows)
+
+        def run_cypher(x):
+            self._trace_query(x["query"])
+            run = partial(execute_read, timeout=self._query_timeout(x))
+            with db_timer('db_execution'):
+                if self.result_cache is None:
+                    return run(x["query"], x["params"])
+                return self.result_cache.read(x["query"], x["params"], self.graph_version.current(), run)
+
+        async def arun_cypher(x):
+            self._trace_query(x["query"])
+            run = partial(aexecute_read, timeout=self._query_timeout(x))
+            with db_timer('db_execution'):
+                if self.result_cache is None:
+                    return await run(x["query"], x["params"])
+                return await self.result_cache.aread(x["query"], x["params"], await self.graph_version.acurrent(),
+                                                     run)
+
+        # Template queries and queries from the Cypher cache are not validated again.
+        # A generated query is cached once it ran, the response prompt gets the corrected and limited query
+        def validate(x):
+            if x["cypher_source"] != self.CYPHER_GENERATED:
+                return x["query"]
+            return self.result_guard.limit(cypher_validation(x["query"]))
+
+        # Generated queries are planned before they run, the guard returns the query or its rewrite
+        def preflight(x):
+            if self.cost_guard is None or x["cypher_source"] != self.CYPHER_GENERATED:
+                return x["query"]
+            with db_timer('cost_guard'):
+                return self.cost_guard.check(x["question"], x["query"], x["params"], self.db.explain)
+
+        async def apreflight(x):
+            if self.cost_guard is None or x["cypher_source"] != self.CYPHER_GENERATED:
+                return x["query"]
+            with db_timer('cost_guard'):
+                return await self.cost_guard.acheck(x["question"], x["query"], x["params"],
+                                                    self._get_async_db().explain)
+
+        # Oversized results are summarized, the rows fetched and sent are recorded in the trace
+        def guard_result(x):
+            response, sent = self.result_guard.prepare(x["response"])
+            self._trace_rows(len(x["response"]), sent)
+            return {**x, "response": response}
+
+        def cache_cypher(x):
+            if self.cypher_cache is not None and x["cypher_key"] is not None \
+                    and x["cypher_source"] == self.CYPHER_GENERATED:
+                self.cypher_cache.put(x["cypher_key"], x["query"])
+            return x
 
         chain = (
-                RunnablePassthrough.assign(query=cypher_response)
+                cypher_response
+                | RunnablePassthrough.assign(query=RunnableLambda(validate, name='validation'))
+                | RunnablePassthrough.assign(query=RunnableLambda(preflight, afunc=apreflight, name='cost_guard'))
                 | RunnablePassthrough.assign(
-            response=lambda x: self.graph.query(cypher_validation(x["query"])),
+            response=RunnableLambda(run_cypher, afunc=arun_cypher, name='db_execution'),
         )
-                | response_prompt
-                | self.llm
-                | StrOutputParser()
+                | RunnableLambda(guard_result, name='result_guard')
+                | cache_cypher
         )
         return chain
 
+    def prepare_answer_chain(self):
+        # Prompt
+        system, human = self.prompt_repo.get_response_prompt()
+        response_prompt = ChatPromptTemplate.from_messages(
+            [(self.SYSTEM_MESSAGE, system), (self.HUMAN_MESSAGE, human)]
+        )
+        return (response_prompt
+                | self.llm
+                | StrOutputParser()).with_config(run_name='response_generation')
+
+    @staticmethod
+    def _trace_query(query: str) -> None:
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.query = query
+
+    def _query_timeout(self, x: Dict[str, Any]) -> Any:
+        # LLM written queries get the stricter timeout of the cost guard, the others the driver's query_timeout
+        if self.cost_guard is None or x["cypher_source"] == self.CYPHER_TEMPLATE:
+            return None
+        return self.config['pipeline']['cost_guard']['query_timeout']
+
+    @staticmethod
+    def _trace_rows(fetched: int, sent: int) -> None:
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.rows_fetched, trace.rows_sent = fetched, sent
+
     # Putting it all together
-    def prepare_edu_query_chain(self):
-        entity_chain = self.prepare_ner_chain()  # Step 1
-        cypher_response = self.prepare_cypher_response(entity_chain)  # Step 2, 3
-        edu_query_chain = self.prepare_response_chain(cypher_response)  # Step 4
+    def prepare_edu_query_chain(self, mode: str = None):
+        edu_query_chain = self.prepare_response_chain(self._prepare_cypher_chain(mode))  # Step 4
         return edu_query_chain
 
+    def _prepare_cypher_chain(self, mode: str = None):
+        mode = mode or self.config['pipeline']['mode']
+        if mode == self.MODE_SINGLE_PASS:
+            return self.prepare_single_pass_response()  # Step 1, 2, 3
+        if mode == self.MODE_THREE_STAGE:
+            entity_chain = self.prepare_ner_chain()  # Step 1
+            return self.prepare_cypher_response(entity_chain)  # Step 2, 3
+        raise ValueError(f'Unknown pipeline mode {mode}')
+
     def ask(self, question: str, verbose: bool = False) -> str:
-        # Lazy Load 
+        return self.ask_with_trace(question, verbose)[0]
+
+    def ask_with_trace(self, question: str, verbose: bool = False) -> Tuple[str, QueryTrace]:
+        """
+        Answers the question and returns the QueryTrace with the wall time, DB time and tokens of every stage.
+        In verbose mode the console callback is attached to the same run, the chain is invoked only once.
+        """
+        # Lazy Load
+        if self.chain is None:
+            self.chain = self.prepare_edu_query_chain()
+
+        trace, config = self._start_trace(question, verbose)
+        token = CURRENT_TRACE.set(trace)
+        start = time.perf_counter()
+        try:
+            if self.answer_cache is None:
+                answer = self.chain.invoke({"question": question}, config=config)
+            else:
+                answer, trace.cached = self.answer_cache.get_or_compute(
+                    question, self.graph_version.current(),
+                    lambda: self.chain.invoke({"question": question}, config=config))
+        except Exception as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            self._finish_trace(trace, start)
+            CURRENT_TRACE.reset(token)
+        return answer, trace
+
+    async def aask(self, question: str, verbose: bool = False) -> str:
+        return (await self.aask_with_trace(question, verbose))[0]
+
+    async def aask_with_trace(self, question: str, verbose: bool = False) -> Tuple[str, QueryTrace]:
+        # The LLM calls go through ainvoke and the DB calls through the async driver,
+        # so many questions can be in flight on one event loop
         if self.chain is None:
             self.chain = self.prepare_edu_query_chain()
 
+        trace, config = self._start_trace(question, verbose)
+        token = CURRENT_TRACE.set(trace)
+        start = time.perf_counter()
+        try:
+            if self.answer_cache is None:
+                answer = await self.chain.ainvoke({"question": question}, config=config)
+            else:
+                answer, trace.cached = await self.answer_cache.aget_or_compute(
+                    question, await self.graph_version.acurrent(),
+                    lambda: self.chain.ainvoke({"question": question}, config=config))
+        except Exception as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            self._finish_trace(trace, start)
+            CURRENT_TRACE.reset(token)
+        return answer, trace
+
+    def ask_stream(self, question: str, verbose: bool = False) -> Iterator[StreamEvent]:
+        """
+        Answers the question as a stream of events: the resolved entities, the Cypher query, the number of rows,
+        then the answer tokens as the response LLM produces them, and a done event with the answer and the trace.
+        The pipeline runs in a worker thread, its events are yielded as they arrive. Errors are raised.
+        """
+        events = queue.Queue()
+        cancelled = threading.Event()
+
+        def emit(event: StreamEvent) -> None:
+            # Nothing is queued once the consumer stopped
+            if not cancelled.is_set():
+                events.put(event)
+
+        trace, config = self._start_trace(question, verbose, emit=emit)
+        config['callbacks'].append(StreamCancelHandler(cancelled))
+        # The worker gets a copy of the context, CURRENT_TRACE is set in the copy
+        worker = threading.Thread(target=contextvars.copy_context().run,
+                                  args=(self._stream_answer, question, trace, config), daemon=True)
+        worker.start()
+        try:
+            while True:
+                event = events.get()
+                if event.event == StreamEvent.ERROR:
+                    raise event.data
+                yield event
+                if event.event == StreamEvent.DONE:
+                    break
+        finally:
+            # The consumer stopped early, the worker stops at the start of the next stage or the next answer token
+            cancelled.set()
+            worker.join()
+
+    async def aask_stream(self, question: str, verbose: bool = False) -> AsyncIterator[StreamEvent]:
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        # Sync callbacks may run in an executor thread, events are put on the queue from the loop
+        trace, config = self._start_trace(question, verbose,
+                                          emit=lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+        task = asyncio.create_task(self._astream_answer(question, trace, config))
+        try:
+            while True:
+                event = await events.get()
+                if event.event == StreamEvent.ERROR:
+                    raise event.data
+                yield event
+                if event.event == StreamEvent.DONE:
+                    break
+        finally:
+            # The consumer stopped early
+            if not task.done():
+                task.cancel()
+
+    def _stream_answer(self, question: str, trace: QueryTrace, config: Dict[str, Any]) -> None:
+        # Streamed answers are cached, but concurrent identical questions are not coalesced.
+        # A cancelled answer is not cached, its trace is recorded with the StreamCancelled error
+        handler = config['callbacks'][0]
+        CURRENT_TRACE.set(trace)
+        try:
+            context_chain, answer_chain = self._get_stream_chains()
+
+            version = self.graph_version.current() if self.answer_cache is not None else None
+            answer = self.answer_cache.get(question, version) if self.answer_cache is not None else None
+            trace.cached = answer is not None
+            if answer is not None:
+                handler.token(answer)
+            else:
+                # Only the response LLM is streamed, the steps before it run as in ask()
+                context = context_chain.invoke({"question": question}, config=config)
+                chunks = []
+                for chunk in answer_chain.stream(context, config=config):
+                    handler.token(chunk)
+                    chunks.append(chunk)
+                answer = ''.join(chunks)
+                if self.answer_cache is not None:
+                    self.answer_cache.put(question, version, answer)
+        except Exception as e:
+            trace.error = repr(e)
+            self._finish_trace(trace, handler.start)
+            handler.emit(StreamEvent.ERROR, e)
+        else:
+            self._finish_trace(trace, handler.start)
+            handler.emit(StreamEvent.DONE, {'answer': answer, 'trace': trace.to_dict()})
+
+    async def _astream_answer(self, question: str, trace: QueryTrace, config: Dict[str, Any]) -> None:
+        handler = config['callbacks'][0]
+        CURRENT_TRACE.set(trace)  # The task runs in a copy of the caller's context
+        try:
+            context_chain, answer_chain = self._get_stream_chains()
+
+            version = await self.graph_version.acurrent() if self.answer_cache is not None else None
+            answer = self.answer_cache.get(question, version) if self.answer_cache is not None else None
+            trace.cached = answer is not None
+            if answer is not None:
+                handler.token(answer)
+            else:
+                context = await context_chain.ainvoke({"question": question}, config=config)
+                chunks = []
+                async for chunk in answer_chain.astream(context, config=config):
+                    handler.token(chunk)
+                    chunks.append(chunk)
+                answer = ''.join(chunks)
+                if self.answer_cache is not None:
+                    self.answer_cache.put(question, version, answer)
+        except Exception as e:
+            trace.error = repr(e)
+            self._finish_trace(trace, handler.start)
+            handler.emit(StreamEvent.ERROR, e)
+        else:
+            self._finish_trace(trace, handler.start)
+            handler.emit(StreamEvent.DONE, {'answer': answer, 'trace': trace.to_dict()})
+
+    async def abatch(self, questions: List[str], max_concurrency: int = None) -> List[Any]:
+        """
+        Answers the questions concurrently, at most `max_concurrency` at a time.
+        A failed question does not fail the batch, its exception is returned in its place.
+        """
+        # Every question runs in its own task, so each one gets its own trace
+        semaphore = asyncio.Semaphore(max_concurrency or self.config['pipeline']['max_concurrency'])
+
+        async def answer(question: str) -> str:
+            async with semaphore:
+                return await self.aask(question)
+
+        return await asyncio.gather(*[answer(question) for question in questions], return_exceptions=True)
+
+    def _get_stream_chains(self) -> Tuple[Any, Any]:
+        # Lazy Load
+        if self.stream_chains is None:
+            self.stream_chains = self.prepare_context_chain(self._prepare_cypher_chain()), self.prepare_answer_chain()
+        return self.stream_chains
+
+    def _start_trace(self, question: str, verbose: bool, emit=None) -> Tuple[QueryTrace, Dict[str, Any]]:
+        # With `emit` the progress of the stages is also reported as StreamEvents
+        trace = QueryTrace(question)
+        callbacks = [StageTraceHandler(trace, self.STAGES) if emit is None
+                     else StreamEventHandler(trace, self.STAGES, emit)]
         if verbose:
-            self.chain.invoke({"question": question}, config={'callbacks': [ConsoleCallbackHandler()]})
+            callbacks.append(ConsoleCallbackHandler())
+        return trace, {'callbacks': callbacks}
 
-        return self.chain.invoke({"question": question})
+    def _finish_trace(self, trace: QueryTrace, start: float) -> None:
+        trace.total_ms = (time.perf_counter() - start) * 1000
+        self.metrics.record(trace)
+        first_token = f', first token {trace.first_token_ms:.0f}ms' if trace.first_token_ms is not None else ''
+        rows = f', {trace.rows_fetched} rows fetched, {trace.rows_sent} sent' if trace.rows_fetched is not None else ''
+        logger.info(f'Answered in {trace.total_ms:.0f}ms{first_token}{rows}: ' + ', '.join(
+            f'{stage} {stats.wall_ms:.0f}ms' for stage, stats in trace.stages.items()))
+
+    async def aclose(self) -> None:
+        """
+        Closes the async driver of the running event loop
+        """
+        async_db = self.async_dbs.pop(asyncio.get_running_loop(), None)
+        if async_db is not None:
+            await async_db.close()
 
     def _load_config(self) -> Dict[str, Any]:
         llm_config_path = Path(__file__).resolve().parent.parent / 'config' / 'app_config.yaml'
@@ -148,19 +808,122 @@ class GraphEduQuery(EduQuery):
             url=Neo4jDBConfig.NEO4J_URI,
             username=Neo4jDBConfig.NEO4J_USER,
             password=Neo4jDBConfig.NEO4J_PASSWORD,
-            database=Neo4jDBConfig.NEO4J_DATABASE
+            database=Neo4jDBConfig.NEO4J_DATABASE,
+            refresh_schema=False  # The SchemaCache loads it, from the snapshot when the data has not changed
+        )
+
+    def _load_answer_backend(self) -> AnswerCacheBackend:
+        answer_cfg = self.config['pipeline']['answer_cache']
+        if answer_cfg['backend'] == 'memory':
+            return MemoryAnswerBackend(max_entries=answer_cfg['cache_size'], ttl=answer_cfg['ttl'])
+        if answer_cfg['backend'] == 'disk':
+            return DiskAnswerBackend(Path(__file__).resolve().parent.parent / answer_cfg['disk_file'],
+                                     max_entries=answer_cfg['cache_size'], ttl=answer_cfg['ttl'])
+        raise ValueError(f"Unknown answer cache backend {answer_cfg['backend']}")
+
+    def _load_db(self) -> Neo4jDB:
+        # Entity matching and the generated queries run through the pooled Neo4jDB with retries and timeouts,
+        # Neo4jGraph is only used for the schema
+        return Neo4jDB(
+            Neo4jDBConfig.NEO4J_URI,
+            Neo4jDBConfig.NEO4J_USER,
+            Neo4jDBConfig.NEO4J_PASSWORD,
+            database=Neo4jDBConfig.NEO4J_DATABASE,
+            **self.config['db']['neo4j']['driver']
+        )
+
+    def refresh_schema(self) -> None:
+        self.schema_cache.refresh(self.graph_version.current())
+
+    def latency_stats(self) -> Dict[str, Any]:
+        """
+        Latency histograms per stage over all the questions answered so far, with the DB time and token totals
+        """
+        return self.metrics.summary()
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {
+            'entity': self.entity_cache.stats()
+        }
+        if self.cypher_cache is not None:
+            stats['cypher'] = self.cypher_cache.stats()
+        if self.result_cache is not None:
+            stats['result'] = self.result_cache.stats()
+        if self.answer_cache is not None:
+            stats['answer'] = self.answer_cache.stats()
+        return stats
+
+    def ner_stats(self) -> Dict[str, Any]:
+        """
+        How often the dictionary NER found the entities (fast path) and how often the LLM was called (fallback)
+        """
+        return self.dictionary_ner.stats() if self.dictionary_ner is not None else {}
+
+    def cost_stats(self) -> Dict[str, Any]:
+        """
+        Generated queries planned by the cost guard, and how many were rewritten or rejected
+        """
+        return self.cost_guard.stats() if self.cost_guard is not None else {}
+
+    def result_stats(self) -> Dict[str, Any]:
+        """
+        Rows read from Neo4j and rows sent to the response prompt, and how many results were summarized or truncated
+        """
+        return self.result_guard.stats()
+
+    def prompt_stats(self) -> Dict[str, Any]:
+        """
+        Mean size of the Cypher prompt parts in tokens, and the tokens saved by pruning the schema and the examples
+        """
+        return self.prompt_builder.stats()
+
+    def intent_stats(self) -> Dict[str, Any]:
+        """
+        Share of the questions answered by an intent template, and the count per template
+        """
+        return self.intent_router.stats() if self.intent_router is not None else {}
+
+    def _fetch_graph_version(self) -> int:
+        records = self.db.execute_read(self.query_repo.get_query(QueryName.GET_GRAPH_VERSION))
+        return records[0]['version'] if records else 0
+
+    async def _afetch_graph_version(self) -> int:
+        records = await self._get_async_db().execute_read(self.query_repo.get_query(QueryName.GET_GRAPH_VERSION))
+        return records[0]['version'] if records else 0
+
+    def _get_async_db(self) -> AsyncNeo4jDB:
+        # An async driver only works on the event loop it was created on, every asyncio.run() gets its own.
+        # The drivers of loops that were closed without aclose() cannot be closed any more, they are dropped
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_dbs:
+            for closed in [other for other in self.async_dbs if other.is_closed()]:
+                del self.async_dbs[closed]
+            self.async_dbs[loop] = self._async_db_factory()
+        return self.async_dbs[loop]
+
+    def _load_async_db(self) -> AsyncNeo4jDB:
+        return AsyncNeo4jDB(
+            Neo4jDBConfig.NEO4J_URI,
+            Neo4jDBConfig.NEO4J_USER,
+            Neo4jDBConfig.NEO4J_PASSWORD,
+            database=Neo4jDBConfig.NEO4J_DATABASE,
+            **self.config['db']['neo4j']['driver']
         )
 
     def _clean_cypher_output(self, ai_message: AIMessage) -> str:
-        # Remove the ```cypher and ``` markers, and strip any extra whitespace
-        clean_cypher = (ai_message.content
-                        .replace("```cypher", "")
-                        .replace("```", "")
-                        .replace("\n", " ")
-                        .strip())
+        clean_cypher = self._clean_cypher(ai_message.content)
         logger.info(clean_cypher)
         return clean_cypher
 
+    @staticmethod
+    def _clean_cypher(query: str) -> str:
+        # Remove the ```cypher and ``` markers, and strip any extra whitespace
+        return (query
+                .replace("```cypher", "")
+                .replace("```", "")
+                .replace("\n", " ")
+                .strip())
+
     # [TODO]
     # def _get_tools(self) -> List[BaseTool]:
     #     tool1 = StudentPerformanceTool(query_strategy=StudentPerformanceStrategy(self.graph))
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from src.pipeline.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+# This Module has the end-to-end answer cache:
+# Storage backends behind AnswerCacheBackend, in memory or in a local SQLite file that survives restarts
+# AnswerCache which keys the answers on the normalized question and the graph data version,
+# and lets concurrent identical questions wait on one computation
+
+def normalize_question(question: str) -> str:
+    return ' '.join(re.findall(r'\w+', question.casefold()))
+
+
+class AnswerCacheBackend(ABC):
+    """
+    Storage for the cached answers. A backend that blocks on I/O sets `blocking`, the async path then calls it
+    from a worker thread instead of the event loop.
+    """
+
+    blocking = False
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, answer: str) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        pass
+
+
+class MemoryAnswerBackend(AnswerCacheBackend):
+    """
+    Keeps the answers in an in-process LRU cache
+    """
+
+    def __init__(self, max_entries: int, ttl: float = None) -> None:
+        self._cache = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def put(self, key: str, answer: str) -> None:
+        self._cache.put(key, answer)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+
+class DiskAnswerBackend(AnswerCacheBackend):
+    """
+    Keeps the answers in a local SQLite file, so they survive a restart of the process.
+    The least recently used answers are deleted above `max_entries`.
+    """
+
+    blocking = True
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS answers (
+            key TEXT PRIMARY KEY,
+            answer TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS answers_accessed_at ON answers (accessed_at);
+    """
+
+    def __init__(self, cache_file: Path, max_entries: int, ttl: float = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(cache_file), check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(self._SCHEMA)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self.conn:
+            row = self.conn.execute('SELECT answer, created_at FROM answers WHERE key = ?', (key,)).fetchone()
+            if row is None or (self.ttl and row[1] + self.ttl < now):
+                if row is not None:
+                    self.conn.execute('DELETE FROM answers WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE answers SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, answer: str) -> None:
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO answers (key, answer, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                              (key, answer, now, now))
+            self.conn.execute('DELETE FROM answers WHERE key IN '
+                              '(SELECT key FROM answers ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                              (self.max_entries,))
+
+    def clear(self) -> None:
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM answers')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+class AnswerCache:
+    """
+    End-to-end cache of the answers, keyed on the normalized question and the graph data version, so a data load
+    makes all the earlier answers unreachable. Concurrent identical questions are coalesced: the first one computes
+    the answer and the others wait for it. A failed computation is not cached, its waiters get the exception.
+    The async waiters are coalesced per event loop, since a future can only be awaited on the loop it belongs to.
+    """
+
+    def __init__(self, backend: AnswerCacheBackend) -> None:
+        self.backend = backend
+        self.coalesced = 0
+        self._inflight: Dict[str, Future] = {}
+        self._ainflight: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Future]]' = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(question: str, version: Any) -> str:
+        return f'{version}:{normalize_question(question)}'
+
+    def get(self, question: str, version: Any) -> Optional[str]:
+        return self.backend.get(self.key(question, version))
+
+    def put(self, question: str, version: Any, answer: str) -> None:
+        self.backend.put(self.key(question, version), answer)
+
+    def get_or_compute(self, question: str, version: Any, compute: Callable[[], str]) -> Tuple[str, bool]:
+        """
+        Returns the answer and whether it came from the cache or from another caller's computation
+        """
+        key = self.key(question, version)
+        answer = self.backend.get(key)
+        if answer is not None:
+            return answer, True
+
+        with self._lock:
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if inflight is not None:
+            return inflight.result(), True
+
+        try:
+            answer = compute()
+            self.backend.put(key, answer)
+            future.set_result(answer)
+            return answer, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def aget_or_compute(self, question: str, version: Any,
+                              compute: Callable[[], Awaitable[str]]) -> Tuple[str, bool]:
+        key = self.key(question, version)
+        answer = await self._abackend(self.backend.get, key)
+        if answer is not None:
+            return answer, True
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            ainflight = self._ainflight.setdefault(loop, {})
+        inflight = ainflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            # Shielded, so a cancelled waiter does not cancel the computation the others wait on
+            return await asyncio.shield(inflight), True
+
+        future = ainflight[key] = loop.create_future()
+        try:
+            answer = await compute()
+            await self._abackend(self.backend.put, key, answer)
+            future.set_result(answer)
+            return answer, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting, mark the exception as retrieved
+            future.exception()
+            raise
+        finally:
+            del ainflight[key]
+
+    async def _abackend(self, method: Callable[..., Any], *args: Any) -> Any:
+        if self.backend.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.backend.stats(), 'coalesced': self.coalesced}
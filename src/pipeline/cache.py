@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Awaitable
+
+logger = logging.getLogger(__name__)
+
+
+# This Module has the caching building blocks used by the pipeline:
+# A thread safe LRU cache with time to live and hit/miss counters
+# A tracker for the graph data version, used to invalidate the caches when scripts/setup_neo4j.py loads new data
+
+class LRUCache:
+    """
+    Thread safe LRU cache with an optional time to live (in seconds) for the entries.
+    Counts hits and misses so the hit rate can be monitored.
+    Pinned entries are kept apart, they are never evicted, never expire and survive clear().
+    With `max_bytes` the entries are also evicted when the sizes given to put() add up to more than that.
+    """
+
+    def __init__(self, max_entries: int, ttl: float = None, max_bytes: int = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (value, expires_at, size)
+        self._pinned: Dict[Hashable, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._pinned:
+                self.hits += 1
+                return self._pinned[key]
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                if entry is not None:
+                    self._pop(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int = 0) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, expires_at, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _pop(self, key: Hashable) -> None:
+        self.bytes -= self._entries.pop(key)[2]
+
+    def pin(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._pinned[key] = value
+
+    def unpin(self, key: Hashable) -> None:
+        with self._lock:
+            self._pinned.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Drops every entry except the pinned ones
+        """
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._pinned)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'pinned': len(self._pinned),
+            'bytes': self.bytes,
+            'evictions': self.evictions,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+class GraphVersion:
+    """
+    Tracks the data version stamp that scripts/setup_neo4j.py bumps after every load.
+    The stamp is read from the database at most once per `check_interval` seconds,
+    and the listeners are called with the new version whenever it changes.
+    """
+
+    def __init__(self, fetch: Callable[[], Any], afetch: Callable[[], Awaitable[Any]], check_interval: float) -> None:
+        self._fetch = fetch
+        self._afetch = afetch
+        self.check_interval = check_interval
+        self._version = None
+        self._checked_at = None
+        self._listeners: List[Callable[[Any], None]] = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener: Callable[[Any], None]) -> None:
+        self._listeners.append(listener)
+
+    def current(self) -> Any:
+        if self._is_stale():
+            version = self._fetch()
+            if self._update(version):
+                self._notify(version)
+        return self._version
+
+    async def acurrent(self) -> Any:
+        if self._is_stale():
+            version = await self._afetch()
+            if self._update(version):
+                # Listeners like the schema refresh do sync I/O, they run in a worker thread instead of on the loop
+                await asyncio.get_running_loop().run_in_executor(None, self._notify, version)
+        return self._version
+
+    def _is_stale(self) -> bool:
+        return self._checked_at is None or time.monotonic() - self._checked_at >= self.check_interval
+
+    def _update(self, version: Any) -> bool:
+        """
+        Stores the version, returns whether it changed since the last check
+        """
+        with self._lock:
+            changed = self._checked_at is not None and version != self._version
+            self._version = version
+            self._checked_at = time.monotonic()
+        return changed
+
+    def _notify(self, version: Any) -> None:
+        logger.info(f'Graph data version changed to {version}')
+        for listener in self._listeners:
+            listener(version)
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from src.pipeline.cache import LRUCache
+from src.pipeline.result_cache import CYPHER_LITERAL, canonical_cypher
+
+logger = logging.getLogger(__name__)
+
+# Plan operators that read every node of a label, or every node of the graph
+LABEL_SCANS = {'NodeByLabelScan', 'UnionNodeByLabelsScan', 'IntersectionNodeByLabelsScan'}
+ALL_NODES_SCANS = {'AllNodesScan'}
+CARTESIAN_PRODUCTS = {'CartesianProduct'}
+VAR_LENGTH_EXPANDS = {'VarLengthExpand(All)', 'VarLengthExpand(Into)', 'VarLengthExpand(Pruning)',
+                      'BFSPruningVarExpand', 'ShortestPath'}
+
+# Variable-length pattern without an upper bound: [*], [:TYPE*], [r*2..]
+_UNBOUNDED_VAR_LENGTH = re.compile(r'\*\s*(\d*)\s*(\.\.)?\s*\]')
+
+
+class QueryCostError(Exception):
+    """
+    Raised when the plan of a generated query is over the budget and could not be rewritten under it
+    """
+
+    def __init__(self, query: str, reasons: List[str]) -> None:
+        super().__init__(f'Query rejected by the cost guard ({"; ".join(reasons)}): {query}')
+        self.query = query
+        self.reasons = reasons
+
+
+def plan_stats(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Operator counts and the largest row estimate of an EXPLAIN plan
+    """
+    operators = Counter()
+    max_rows = 0.0
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        # Operator names carry the runtime, e.g. NodeByLabelScan@neo4j
+        operators[node.get('operatorType', '').split('@')[0]] += 1
+        arguments = node.get('args') or node.get('arguments') or {}
+        max_rows = max(max_rows, float(arguments.get('EstimatedRows', 0) or 0))
+        stack.extend(node.get('children', []))
+    return {
+        'estimated_rows': max_rows,
+        'label_scans': sum(operators[op] for op in LABEL_SCANS),
+        'all_nodes_scans': sum(operators[op] for op in ALL_NODES_SCANS),
+        'cartesian_products': sum(operators[op] for op in CARTESIAN_PRODUCTS),
+        'var_length_expands': sum(operators[op] for op in VAR_LENGTH_EXPANDS),
+        'operators': dict(operators)
+    }
+
+
+def bound_var_length(query: str, max_hops: int) -> str:
+    """
+    Gives the variable-length relationships without an upper bound one of `max_hops`
+    """
+    parts, last = [], 0
+    for literal in CYPHER_LITERAL.finditer(query):
+        parts.append(_bound(query[last:literal.start()], max_hops))
+        parts.append(literal.group())
+        last = literal.end()
+    parts.append(_bound(query[last:], max_hops))
+    return ''.join(parts)
+
+
+def _bound(text: str, max_hops: int) -> str:
+    def replace(match: re.Match) -> str:
+        low, dots = match.group(1), match.group(2)
+        if low and not dots:
+            return match.group()  # Fixed length, *3
+        return f'*{low or 1}..{max_hops}]'
+    return _UNBOUNDED_VAR_LENGTH.sub(replace, text)
+
+
+class CostGuard:
+    """
+    Preflight of the generated Cypher queries. Every query is run with EXPLAIN first and its plan is checked against
+    the budget: the largest row estimate, label scans, scans of all nodes and cartesian products. A query over the
+    budget with unbounded variable-length relationships is rewritten with an upper bound of `max_hops` and checked
+    again, other queries over the budget are rejected with a QueryCostError. Verdicts are cached per canonical query
+    until the data version changes, and the plan stats of every question are appended to `plan_log` as JSON lines.
+    """
+
+    def __init__(self, max_estimated_rows: float, max_label_scans: int, max_cartesian_products: int,
+                 allow_all_nodes_scan: bool, max_hops: int, cache_size: int, plan_log: Optional[Path] = None) -> None:
+        self.max_estimated_rows = max_estimated_rows
+        self.max_label_scans = max_label_scans
+        self.max_cartesian_products = max_cartesian_products
+        self.allow_all_nodes_scan = allow_all_nodes_scan
+        self.max_hops = max_hops
+        self.plan_log = plan_log
+        self.checked = 0
+        self.rewritten = 0
+        self.rejected = 0
+        self._verdicts = LRUCache(max_entries=cache_size)
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def check(self, question: str, query: str, parameters: Optional[Dict[str, Any]],
+              explain: Callable[[str, Optional[Dict[str, Any]]], Dict[str, Any]]) -> str:
+        """
+        Returns the query to run, the query itself or its rewrite. Raises QueryCostError when it is over the budget.
+        """
+        key = canonical_cypher(query)
+        verdict = self._verdicts.get(key)
+        if verdict is None:
+            stats = plan_stats(explain(query, parameters))
+            rewrite = self._rewrite(query, stats)
+            rewrite_stats = plan_stats(explain(rewrite, parameters)) if rewrite is not None else None
+            verdict = self._verdict(query, stats, rewrite, rewrite_stats)
+            self._verdicts.put(key, verdict)
+        self._count(question, verdict)
+        self._log_plan(question, verdict)
+        return self._apply(verdict)
+
+    async def acheck(self, question: str, query: str, parameters: Optional[Dict[str, Any]],
+                     explain: Callable[[str, Optional[Dict[str, Any]]], Awaitable[Dict[str, Any]]]) -> str:
+        key = canonical_cypher(query)
+        verdict = self._verdicts.get(key)
+        if verdict is None:
+            stats = plan_stats(await explain(query, parameters))
+            rewrite = self._rewrite(query, stats)
+            rewrite_stats = plan_stats(await explain(rewrite, parameters)) if rewrite is not None else None
+            verdict = self._verdict(query, stats, rewrite, rewrite_stats)
+            self._verdicts.put(key, verdict)
+        self._count(question, verdict)
+        if self.plan_log is not None:
+            # The file append would block the event loop
+            await asyncio.to_thread(self._log_plan, question, verdict)
+        return self._apply(verdict)
+
+    def violations(self, stats: Dict[str, Any]) -> List[str]:
+        reasons = []
+        if stats['estimated_rows'] > self.max_estimated_rows:
+            reasons.append(f'estimated rows {stats["estimated_rows"]:.0f} > {self.max_estimated_rows}')
+        if stats['label_scans'] > self.max_label_scans:
+            reasons.append(f'label scans {stats["label_scans"]} > {self.max_label_scans}')
+        if stats['cartesian_products'] > self.max_cartesian_products:
+            reasons.append(f'cartesian products {stats["cartesian_products"]} > {self.max_cartesian_products}')
+        if stats['all_nodes_scans'] and not self.allow_all_nodes_scan:
+            reasons.append('scan of all nodes')
+        return reasons
+
+    def _rewrite(self, query: str, stats: Dict[str, Any]) -> Optional[str]:
+        # Only unbounded variable-length relationships are rewritten, the rest of the query is the LLM's
+        if not self.violations(stats):
+            return None
+        rewrite = bound_var_length(query, self.max_hops)
+        return rewrite if rewrite != query else None
+
+    def _verdict(self, query: str, stats: Dict[str, Any], rewrite: Optional[str],
+                 rewrite_stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        reasons = self.violations(stats)
+        if not reasons:
+            return {'action': 'run', 'query': query, 'stats': stats, 'reasons': []}
+        if rewrite is not None and not self.violations(rewrite_stats):
+            return {'action': 'rewrite', 'query': rewrite, 'stats': rewrite_stats, 'reasons': reasons}
+        return {'action': 'reject', 'query': query, 'stats': stats, 'reasons': reasons}
+
+    def _count(self, question: str, verdict: Dict[str, Any]) -> None:
+        with self._lock:
+            self.checked += 1
+            self.rewritten += verdict['action'] == 'rewrite'
+            self.rejected += verdict['action'] == 'reject'
+        stats = {key: value for key, value in verdict['stats'].items() if key != 'operators'}
+        logger.info(f'Plan of the query for "{question}": {verdict["action"]}, {stats}')
+
+    @staticmethod
+    def _apply(verdict: Dict[str, Any]) -> str:
+        if verdict['action'] == 'reject':
+            raise QueryCostError(verdict['query'], verdict['reasons'])
+        return verdict['query']
+
+    def _log_plan(self, question: str, verdict: Dict[str, Any]) -> None:
+        if self.plan_log is None:
+            return
+        line = json.dumps({'time': time.time(), 'question': question, **verdict}, default=str)
+        with self._log_lock:
+            with open(self.plan_log, 'a') as file:
+                file.write(line + '\n')
+
+    def clear(self) -> None:
+        self._verdicts.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'checked': self.checked, 'rewritten': self.rewritten, 'rejected': self.rejected}
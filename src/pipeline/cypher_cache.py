@@ -0,0 +1,82 @@
+import hashlib
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.pipeline.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Words that do not change the query a question maps to
+STOPWORDS = {'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'been', 'do', 'does', 'did', 'please', 'me', 'us',
+             'can', 'could', 'you', 'tell', 'show', 'give', 'of', 'for', 'in', 'on', 'so', 'far'}
+# Words the examples use interchangeably, mapped to one of them
+SYNONYMS = {'performing': 'doing', 'performed': 'doing', 'perform': 'doing', 'going': 'doing',
+            'pupil': 'student', 'pupils': 'students', 'learner': 'student', 'learners': 'students',
+            'test': 'assessment', 'tests': 'assessments', 'exam': 'assessment', 'exams': 'assessments',
+            'teacher': 'instructor', 'teachers': 'instructors', 'average': 'avg', 'mean': 'avg'}
+
+ENTITY_PLACEHOLDER = '<entity{}>'
+
+
+def question_template(question: str, names: List[str]) -> str:
+    """
+    Normalized form of the question with the entity names replaced by numbered placeholders, e.g.
+    "How is John Jones doing?" and "how is john jones performing" both become "how <entity0> doing"
+    """
+    template = question.casefold()
+    # Longest names first, so a name inside a longer one is not replaced on its own
+    for i, name in sorted(enumerate(names), key=lambda item: len(item[1]), reverse=True):
+        if name.strip():
+            template = re.sub(r'\b' + re.escape(name.casefold().strip()) + r'\b', f' {ENTITY_PLACEHOLDER.format(i)} ',
+                              template)
+    words = re.findall(r'<entity\d+>|[a-z0-9]+', template)
+    return ' '.join(SYNONYMS.get(word, word) for word in words if word not in STOPWORDS)
+
+
+def entity_signature(candidates: List[Dict[str, Any]]) -> Optional[Tuple[str, str]]:
+    """
+    Label and a digest of the properties of the node the entity resolved to, None when it did not resolve
+    """
+    if not candidates:
+        return None
+    best = candidates[0]
+    digest = hashlib.sha1(json.dumps(best['result'], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return best['type'], digest
+
+
+class CypherCache:
+    """
+    Maps a question template plus the nodes its entities resolved to onto the validated Cypher query that answered it.
+    A repeated question skips the Cypher generation LLM call. The entity mapping is part of the key because the
+    query embeds the property values of those nodes. Entries are dropped when the graph data version changes, except
+    the pinned ones which are kept as known-good queries.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self._cache = LRUCache(max_entries=max_entries)
+
+    @staticmethod
+    def key(question: str, names: List[str], matches: Dict[str, List[Dict[str, Any]]]) -> Tuple:
+        return question_template(question, names), tuple(entity_signature(matches.get(name, [])) for name in names)
+
+    def get(self, key: Tuple) -> Optional[str]:
+        return self._cache.get(key)
+
+    def put(self, key: Tuple, query: str) -> None:
+        if query:
+            self._cache.put(key, query)
+
+    def pin(self, key: Tuple, query: str) -> None:
+        logger.info(f'Pinned Cypher query for "{key[0]}"')
+        self._cache.pin(key, query)
+
+    def unpin(self, key: Tuple) -> None:
+        self._cache.unpin(key)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
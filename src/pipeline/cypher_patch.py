@@ -0,0 +1,48 @@
+import logging
+import re
+from typing import Any, Dict, List
+
+from src.pipeline.entity_index import normalize_name
+
+logger = logging.getLogger(__name__)
+
+# Property that identifies a node of each label
+ID_PROPERTIES = {
+    'Student': 'student_id',
+    'Assessment': 'assessment_id',
+    'Module': 'module_id',
+    'Instructor': 'instructor_id',
+    'Course': 'course_id'
+}
+
+# `key: 'value'` in a pattern or `n.key = 'value'` in a WHERE clause
+_PROPERTY_LITERAL = re.compile(r"(\b\w+\.)?(\w+)(\s*(?::|=)\s*)('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")")
+
+
+def quote(value: Any) -> str:
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def patch_entity_literals(query: str, names: List[str], matches: Dict[str, List[Dict[str, Any]]]) -> str:
+    """
+    Replaces the entity names written as property values in a draft Cypher query with the values of the nodes
+    they resolved to. When the node has no such property the condition is rewritten on the id property of its label,
+    e.g. {student_name: 'jon jones'} becomes {student_name: 'John Jones'} and {student_id: 'John Jones'} becomes
+    {student_id: '1'}. Names that did not resolve are left as written.
+    """
+    resolved = {normalize_name(name): matches[name][0] for name in names if matches.get(name)}
+
+    def patch(literal: re.Match) -> str:
+        prefix, key, separator, value = literal.groups()
+        best = resolved.get(normalize_name(value[1:-1]))
+        if best is None:
+            return literal.group()
+        properties = best['result']
+        if key not in properties:
+            key = ID_PROPERTIES.get(best['type'])
+            if key not in properties:
+                logger.info(f'No property to patch {value} with on the {best["type"]} node')
+                return literal.group()
+        return f'{prefix or ""}{key}{separator}{quote(properties[key])}'
+
+    return _PROPERTY_LITERAL.sub(patch, query)
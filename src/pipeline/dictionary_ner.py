@@ -0,0 +1,163 @@
+import logging
+import re
+import threading
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from src.pipeline.entity_index import edit_distance
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.casefold())
+
+
+def deletes(token: str) -> Set[str]:
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+class TokenAutomaton:
+    """
+    Aho-Corasick automaton over sequences of tokens, finds every pattern occurring in a token sequence in one pass
+    """
+
+    def __init__(self) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[int, Any]]] = [[]]  # state -> [(pattern length, value)]
+
+    def add(self, pattern: List[str], value: Any) -> None:
+        state = 0
+        for token in pattern:
+            if token not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][token] = len(self._goto) - 1
+            state = self._goto[state][token]
+        self._output[state].append((len(pattern), value))
+
+    def build(self) -> None:
+        # Breadth first, the states one token deep fail back to the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(token, 0) if state else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, tokens: List[str]) -> List[Tuple[int, int, Any]]:
+        """
+        Returns (start, end, value) of every match, end exclusive
+        """
+        matches, state = [], 0
+        for i, token in enumerate(tokens):
+            while state and token not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(token, 0)
+            for length, value in self._output[state]:
+                matches.append((i + 1 - length, i + 1, value))
+        return matches
+
+
+class DictionaryNER:
+    """
+    Extracts the entity names of a question locally, from the same names as the nameIndex fulltext index.
+    The names are matched as token sequences with an Aho-Corasick automaton, after correcting the question tokens
+    that are one edit away from exactly one word of the names. When no name is found, or the question has
+    uncovered tokens that look like entity mentions (numbers, capitalized words), the result is not confident
+    and the pipeline falls back to the LLM.
+    """
+
+    # Tokens shorter than this are not corrected, as they are one edit away from too many words
+    MIN_FUZZY_LENGTH = 4
+    # Names shorter than this are not matched, e.g. single letters
+    MIN_NAME_LENGTH = 3
+
+    def __init__(self) -> None:
+        self._automaton = TokenAutomaton()
+        self._vocabulary: Set[str] = set()
+        self._deletes: Dict[str, Set[str]] = {}  # word with one character deleted -> words
+        self._lock = threading.Lock()
+        self.fast_path = 0
+        self.fallback = 0
+
+    def sync(self, records: Iterable[Dict[str, Any]]) -> None:
+        """
+        Rebuilds the dictionary from the records ({'name', ...}) of all the named nodes
+        """
+        automaton, vocabulary, names = TokenAutomaton(), set(), set()
+        for record in records:
+            name = record['name']
+            if name is None or len(name.strip()) < self.MIN_NAME_LENGTH or name in names:
+                continue
+            names.add(name)
+            tokens = tokenize(name)
+            automaton.add(tokens, name)
+            vocabulary.update(tokens)
+        automaton.build()
+
+        delete_index = {}
+        for word in vocabulary:
+            if len(word) >= self.MIN_FUZZY_LENGTH:
+                for deleted in deletes(word):
+                    delete_index.setdefault(deleted, set()).add(word)
+
+        with self._lock:
+            self._automaton, self._vocabulary, self._deletes = automaton, vocabulary, delete_index
+        logger.info(f'Dictionary NER synced: {len(names)} names, {len(vocabulary)} words')
+
+    def extract(self, question: str) -> Optional[List[str]]:
+        """
+        Returns the names found in the question, None when the result is not confident
+        """
+        with self._lock:
+            automaton, vocabulary, delete_index = self._automaton, self._vocabulary, self._deletes
+
+        words = list(_TOKEN.finditer(question))
+        tokens = [self._correct(word.group().casefold(), vocabulary, delete_index) for word in words]
+
+        # Longest matches first, overlapping shorter ones are dropped
+        covered, names = set(), []
+        for start, end, name in sorted(automaton.find(tokens), key=lambda match: (match[0] - match[1], match[0])):
+            if covered.isdisjoint(range(start, end)):
+                covered.update(range(start, end))
+                names.append((start, name))
+
+        uncovered = [word.group() for i, word in enumerate(words)
+                     if i not in covered and self._mention_like(i, word.group())]
+        if not names or uncovered:
+            self.fallback += 1
+            return None
+        self.fast_path += 1
+        return [name for _, name in sorted(names)]
+
+    def _correct(self, token: str, vocabulary: Set[str], delete_index: Dict[str, Set[str]]) -> str:
+        if token in vocabulary or len(token) < self.MIN_FUZZY_LENGTH or token.isdigit():
+            return token
+        # Words the token is one insertion, deletion or substitution away from
+        token_deletes = deletes(token)
+        candidates = set(delete_index.get(token, ())) | (token_deletes & vocabulary)
+        for deleted in token_deletes:
+            candidates.update(delete_index.get(deleted, ()))
+        candidates = [word for word in candidates if edit_distance(token, word) <= 1]
+        return candidates[0] if len(candidates) == 1 else token
+
+    @staticmethod
+    def _mention_like(position: int, word: str) -> bool:
+        return any(char.isdigit() for char in word) or (position > 0 and len(word) > 1 and word[0].isupper())
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self.fast_path + self.fallback
+        return {
+            'fast_path': self.fast_path,
+            'fallback': self.fallback,
+            'fast_path_rate': self.fast_path / calls if calls else 0.0
+        }
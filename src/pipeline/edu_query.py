@@ -3,7 +3,7 @@ from pathlib import Path
 
 from pydantic import BaseModel, Field
 from abc import ABC, abstractmethod
-from typing import Any, List, Tuple, Dict
+from typing import Any, AsyncIterator, Iterator, List, Tuple, Dict
 
 
 # This Module has the following:
@@ -28,6 +28,27 @@ class EduQuery(ABC):
         """
         pass
 
+    @abstractmethod
+    async def aask(self, question: str, verbose: bool = False) -> str:
+        """
+        Async version of `ask`. Lets a single event loop serve many questions concurrently.
+        """
+        pass
+
+    @abstractmethod
+    def ask_stream(self, question: str, verbose: bool = False) -> Iterator[Any]:
+        """
+        Streaming version of `ask`. Yields the progress of the pipeline and then the answer tokens as they are produced.
+        """
+        pass
+
+    @abstractmethod
+    def aask_stream(self, question: str, verbose: bool = False) -> AsyncIterator[Any]:
+        """
+        Async version of `ask_stream`.
+        """
+        pass
+
     @abstractmethod
     def prepare_ner_chain(self) -> Any:
         """
@@ -77,6 +98,19 @@ class Entities(BaseModel):
     )
 
 
+class EntitiesAndCypher(BaseModel):
+    """Entities appearing in the text and a Cypher query answering it."""
+
+    names: List[str] = Field(
+        ...,
+        description="All the Students or Assessments or Modules or Instructors or Courses appearing in the text",
+    )
+    query: str = Field(
+        ...,
+        description="Cypher query answering the text, with the entities written as they appear in the text",
+    )
+
+
 # [TODO]
 # class FinalResponse(BaseModel):
 #     """Final Response"""
@@ -125,6 +159,12 @@ class PromptRepository:
         """
         return self._prepare_prompt('cypherPrompt')
 
+    def get_single_pass_prompt(self) -> Tuple[str, str]:
+        """
+        Returns the prompt for extracting the entities and drafting the Cypher query in one call
+        """
+        return self._prepare_prompt('singlePassPrompt')
+
     def get_response_prompt(self) -> Tuple[str, str]:
         """
         Returns the prompt for generating the final response
@@ -0,0 +1,141 @@
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_name(value: str) -> str:
+    return ' '.join(value.casefold().split())
+
+
+def trigrams(value: str) -> Set[str]:
+    padded = f'  {value} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str) -> int:
+    """
+    Levenshtein distance between two strings
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def similarity(a: str, b: str) -> float:
+    longest = max(len(a), len(b))
+    return 1.0 - edit_distance(a, b) / longest if longest else 1.0
+
+
+class EntityIndex:
+    """
+    In-memory index over the same names as the nameIndex fulltext index
+    (student, assessment, module and instructor names and course ids), for typo tolerant lookups without a
+    database round trip. Names are split into character trigrams, the entries sharing the most trigrams with the
+    query are ranked by edit distance. A partial name like a first name is matched against the words of the names.
+    """
+
+    # Entries sharing the most trigrams with the query that are ranked by edit distance
+    MAX_CANDIDATES = 10
+    # Entries sharing fewer than this fraction of the query trigrams are not considered
+    MIN_TRIGRAM_OVERLAP = 0.3
+    # Penalty for matching only some of the words of a name
+    PARTIAL_MATCH_WEIGHT = 0.9
+
+    def __init__(self, min_similarity: float = 0.8) -> None:
+        self.min_similarity = min_similarity
+        self._entries: Dict[str, Dict[str, Any]] = {}  # id -> {'name', 'type', 'result', 'courses'}
+        self._postings: Dict[str, Set[str]] = {}  # trigram -> ids
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def sync(self, records: Iterable[Dict[str, Any]]) -> Tuple[int, int]:
+        """
+        Brings the index in line with the records ({'id', 'type', 'name', 'result', 'courses'}) of all the named nodes.
+        Only the entries that were added, changed or removed are re-indexed. Returns the added and removed counts.
+        """
+        with self._lock:
+            seen = set()
+            added = 0
+            for record in records:
+                if record['name'] is None:
+                    continue
+                seen.add(record['id'])
+                entry = self._entries.get(record['id'])
+                courses = record.get('courses', [])
+                if entry is not None and entry['name'] == normalize_name(record['name']) \
+                        and entry['result'] == record['result'] and entry['courses'] == courses:
+                    continue
+                if entry is not None:
+                    self._remove(record['id'])
+                self._add(record['id'], record['type'], record['name'], record['result'], courses)
+                added += 1
+            removed = [entry_id for entry_id in self._entries if entry_id not in seen]
+            for entry_id in removed:
+                self._remove(entry_id)
+        logger.info(f'Entity index synced: {added} added or changed, {len(removed)} removed, {len(self)} entries')
+        return added, len(removed)
+
+    def lookup(self, value: str, top_k: int = 3) -> List[Dict[str, Any]]:
+        """
+        Returns up to top_k candidates scoring at least min_similarity,
+        in the same shape as the fulltext search:
+        {'result': properties, 'type': label, 'score': similarity, 'courses': ids of the courses the node is part of}
+        """
+        query = normalize_name(value)
+        if not query:
+            return []
+        query_grams = trigrams(query)
+        min_overlap = self.MIN_TRIGRAM_OVERLAP * len(query_grams)
+        overlap = Counter()
+        with self._lock:
+            for gram in query_grams:
+                overlap.update(self._postings.get(gram, ()))
+            entries = [self._entries[entry_id] for entry_id, count in overlap.most_common(self.MAX_CANDIDATES)
+                       if count >= min_overlap]
+
+        scored = []
+        for entry in entries:
+            score = self._score(query, entry['name'])
+            if score >= self.min_similarity:
+                scored.append({'result': entry['result'], 'type': entry['type'], 'score': score,
+                               'courses': entry['courses']})
+        scored.sort(key=lambda candidate: candidate['score'], reverse=True)
+        return scored[:top_k]
+
+    def _score(self, query: str, name: str) -> float:
+        if query == name:
+            return 1.0
+        score = similarity(query, name)
+        # Compare against the runs of words of the same length as the query, e.g. "jon" against "john" in "john jones"
+        query_words, name_words = query.split(), name.split()
+        if len(query_words) < len(name_words):
+            for start in range(len(name_words) - len(query_words) + 1):
+                window = ' '.join(name_words[start:start + len(query_words)])
+                score = max(score, self.PARTIAL_MATCH_WEIGHT * similarity(query, window))
+        return score
+
+    def _add(self, entry_id: str, entry_type: str, name: str, result: Dict[str, Any], courses: List[str]) -> None:
+        normalized = normalize_name(name)
+        self._entries[entry_id] = {'name': normalized, 'type': entry_type, 'result': result, 'courses': courses}
+        for gram in trigrams(normalized):
+            self._postings.setdefault(gram, set()).add(entry_id)
+
+    def _remove(self, entry_id: str) -> None:
+        entry = self._entries.pop(entry_id)
+        for gram in trigrams(entry['name']):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(entry_id)
+                if not postings:
+                    del self._postings[gram]
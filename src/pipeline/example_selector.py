@@ -0,0 +1,79 @@
+import logging
+import re
+import threading
+import zlib
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.example_selectors import BaseExampleSelector
+
+from src.pipeline.cypher_cache import SYNONYMS
+
+logger = logging.getLogger(__name__)
+
+
+def features(text: str) -> List[str]:
+    """
+    Words and word pairs of the normalized text
+    """
+    words = [SYNONYMS.get(word, word) for word in re.findall(r'\w+', text.casefold())]
+    return words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+
+
+class TfidfExampleSelector(BaseExampleSelector):
+    """
+    Selects the k few-shot examples whose questions are most similar to the question asked, so the Cypher prompt
+    does not grow with the example library. The example questions are turned into TF-IDF vectors with the hashing
+    trick (words and word pairs hashed into `n_features` columns) and kept as rows of one NumPy matrix, a selection
+    is a single matrix-vector product. Runs offline on the CPU, no embedding model is needed.
+    """
+
+    def __init__(self, examples: List[Dict[str, str]], k: int = 4, n_features: int = 2048,
+                 input_key: str = 'question') -> None:
+        self.k = k
+        self.n_features = n_features
+        self.input_key = input_key
+        self.examples: List[Dict[str, str]] = list(examples)
+        # Term counts per example, the TF-IDF matrix is recomputed from them when an example is added
+        self._counts = np.vstack([self._count_vector(example[input_key]) for example in examples]) \
+            if examples else np.zeros((0, n_features), dtype=np.float32)
+        self._lock = threading.Lock()
+        self._reweight()
+        logger.info(f'Example selector built over {len(self.examples)} examples')
+
+    def add_example(self, example: Dict[str, str]) -> None:
+        with self._lock:
+            self.examples.append(example)
+            self._counts = np.vstack([self._counts, self._count_vector(example[self.input_key])])
+            self._reweight()
+
+    def select_examples(self, input_variables: Dict[str, str]) -> List[Dict[str, str]]:
+        with self._lock:
+            matrix, idf, examples = self._matrix, self._idf, self.examples
+        if len(examples) <= self.k:
+            return list(examples)
+
+        query = self._count_vector(input_variables[self.input_key]) * idf
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return examples[:self.k]
+        scores = matrix @ (query / norm)
+        top = np.argpartition(-scores, self.k)[:self.k]
+        return [examples[i] for i in top[np.argsort(-scores[top])]]
+
+    def _count_vector(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.n_features, dtype=np.float32)
+        for feature in features(text):
+            vector[zlib.crc32(feature.encode('utf-8')) % self.n_features] += 1
+        return vector
+
+    def _reweight(self) -> None:
+        # Smoothed inverse document frequency, rows scaled to unit length so the dot product is the cosine
+        document_frequency = np.count_nonzero(self._counts, axis=0)
+        self._idf = (np.log((1 + len(self._counts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        weighted = self._counts * self._idf
+        norms = np.linalg.norm(weighted, axis=1, keepdims=True)
+        self._matrix = weighted / np.where(norms == 0, 1, norms)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'examples': len(self.examples), 'k': self.k, 'matrix_bytes': int(self._matrix.nbytes)}
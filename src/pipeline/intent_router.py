@@ -0,0 +1,116 @@
+import logging
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.pipeline.cypher_cache import SYNONYMS
+from src.pipeline.entity_index import normalize_name
+
+logger = logging.getLogger(__name__)
+
+# Questions with these words ask for more than a template answers (ordering, comparisons, filters)
+FREE_FORM_WORDS = {'top', 'best', 'worst', 'highest', 'lowest', 'most', 'least', 'compare', 'compared', 'rank',
+                   'than', 'not', 'without', 'each', 'per', 'every', 'above', 'below', 'between', 'trend', 'except'}
+
+
+class IntentTemplate:
+    """
+    Parameterized Cypher query for one shape of question. A question matches when its entities resolved to
+    exactly the labels of the template and it contains one of the keywords. The parameters are the properties
+    of the resolved nodes, named after the property.
+    """
+
+    def __init__(self, name: str, query: str, entities: Dict[str, str], keywords: List[str]) -> None:
+        self.name = name
+        self.query = query
+        self.entities = entities  # label -> property bound as the parameter of the same name
+        self.keywords = [re.compile(r'\b' + re.escape(keyword) + r'\b') for keyword in keywords]
+
+    def score(self, text: str) -> int:
+        return sum(1 for keyword in self.keywords if keyword.search(text))
+
+
+class IntentRouter:
+    """
+    Classifies questions locally against a library of intent templates (graph_templates.json), so the questions
+    that fit a known shape run a parameterized query instead of an LLM generated one. Only questions whose entities
+    all resolved unambiguously, one per label, and that match a single template best are routed.
+    Assessment and Module ids are only unique within a course, and the templates bind the id alone, so a node
+    that is part of more than one course is ambiguous too and the question is left to the LLM.
+    """
+
+    def __init__(self, templates: Dict[str, Dict[str, Any]], get_query: Callable[[str], str],
+                 ambiguity_ratio: float) -> None:
+        self.templates = [IntentTemplate(name, get_query(template['query']), template['entities'],
+                                         template['keywords'])
+                          for name, template in templates.items()]
+        self.ambiguity_ratio = ambiguity_ratio
+        self.routed: Dict[str, int] = {}
+        self.free_form = 0
+        self._lock = threading.Lock()
+
+    def route(self, question: str, names: List[str],
+              matches: Dict[str, List[Dict[str, Any]]]) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+        """
+        Returns the template name, query and parameters for the question, None when it is free-form
+        """
+        result = self._match(question, names, matches)
+        with self._lock:
+            if result is None:
+                self.free_form += 1
+            else:
+                self.routed[result[0]] = self.routed.get(result[0], 0) + 1
+        return result
+
+    def _match(self, question: str, names: List[str],
+               matches: Dict[str, List[Dict[str, Any]]]) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+        nodes = {}
+        for name in names:
+            candidates = matches.get(name)
+            if not candidates or candidates[0]['type'] in nodes:
+                return None
+            if len(candidates) > 1 and candidates[1]['score'] >= self.ambiguity_ratio * candidates[0]['score'] \
+                    and not self._is_exact(name, candidates[0]['result']):
+                return None
+            if len(candidates[0].get('courses', [])) > 1:
+                logger.info(f'{name} is part of courses {candidates[0]["courses"]}, not routed to a template')
+                return None
+            nodes[candidates[0]['type']] = candidates[0]['result']
+
+        text = self._normalize(question, names)
+        if FREE_FORM_WORDS.intersection(text.split()):
+            return None
+
+        scored = sorted(((template.score(text), template) for template in self.templates
+                         if set(template.entities) == set(nodes)), key=lambda item: item[0], reverse=True)
+        if not scored or scored[0][0] == 0 or (len(scored) > 1 and scored[1][0] == scored[0][0]):
+            return None
+
+        template = scored[0][1]
+        parameters = {prop: nodes[label].get(prop) for label, prop in template.entities.items()}
+        if any(value is None for value in parameters.values()):
+            return None
+        return template.name, template.query, parameters
+
+    @staticmethod
+    def _is_exact(name: str, node: Dict[str, Any]) -> bool:
+        return normalize_name(name) in {normalize_name(str(value)) for value in node.values()}
+
+    @staticmethod
+    def _normalize(question: str, names: List[str]) -> str:
+        # Entity names are removed first, so the words of a name like "Control Structures Test" are not keywords
+        text = question.casefold()
+        for name in sorted(names, key=len, reverse=True):
+            text = text.replace(name.casefold(), ' ')
+        return ' '.join(SYNONYMS.get(word, word) for word in re.findall(r'\w+', text))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            routed = sum(self.routed.values())
+            total = routed + self.free_form
+            return {
+                'routed': routed,
+                'free_form': self.free_form,
+                'coverage': routed / total if total else 0.0,
+                'intents': dict(self.routed)
+            }
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from src.pipeline.prompt_builder import estimate_tokens
+from src.pipeline.result_cache import canonical_cypher
+
+
+# This Module has the stand-ins that run the pipeline without Gemini and Neo4j, see scripts/benchmark_offline.py:
+# FakeChatModel is a deterministic chat model with fixed latencies that replies with canned outputs
+# Recording holds the responses of Neo4j recorded from a live run, RecordingNeo4jDB records them
+# RecordedNeo4jDB, AsyncRecordedNeo4jDB and RecordedGraph replay them in place of Neo4jDB, AsyncNeo4jDB and Neo4jGraph
+
+# Plan of a query that was not recorded, one operator with a single row so the cost guard lets it run
+DEFAULT_PLAN = {'operatorType': 'ProduceResults@neo4j', 'args': {'EstimatedRows': 1.0}, 'children': []}
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that replies with `respond(messages)`. Every call waits `latency_ms` before the first token and
+    `ms_per_token` per output token, and reports the token usage of the prompt and the reply like a real model.
+    Streamed replies are split into chunks of `chunk_size` characters. Structured output is parsed from a JSON reply.
+    """
+
+    respond: Callable[[List[BaseMessage]], str]
+    latency_ms: float = 0.0
+    ms_per_token: float = 0.0
+    chunk_size: int = 16
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-chat'
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        text, usage = self._reply(messages)
+        time.sleep((self.latency_ms + self.ms_per_token * usage['output_tokens']) / 1000)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        text, usage = self._reply(messages)
+        await asyncio.sleep((self.latency_ms + self.ms_per_token * usage['output_tokens']) / 1000)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        text, usage = self._reply(messages)
+        time.sleep(self.latency_ms / 1000)
+        for piece, chunk in self._chunks(text, usage):
+            # BaseChatModel.stream reports every chunk to the callbacks
+            time.sleep(self.ms_per_token * estimate_tokens(piece) / 1000)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        text, usage = self._reply(messages)
+        await asyncio.sleep(self.latency_ms / 1000)
+        for piece, chunk in self._chunks(text, usage):
+            await asyncio.sleep(self.ms_per_token * estimate_tokens(piece) / 1000)
+            yield chunk
+
+    def with_structured_output(self, schema: Any, **kwargs: Any) -> Runnable:
+        def parse(message: AIMessage) -> Any:
+            data = json.loads(message.content)
+            if isinstance(schema, dict):
+                # Tool calls, the shape GraphEduQuery._entity_names reads
+                return [{'type': schema['name'], 'args': data}]
+            return schema(**data)
+
+        return self | RunnableLambda(parse)
+
+    def _reply(self, messages: List[BaseMessage]) -> Tuple[str, Dict[str, int]]:
+        text = self.respond(messages)
+        input_tokens = sum(estimate_tokens(str(message.content)) for message in messages)
+        output_tokens = estimate_tokens(text)
+        return text, {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                      'total_tokens': input_tokens + output_tokens}
+
+    def _chunks(self, text: str, usage: Dict[str, int]) -> Iterator[Tuple[str, ChatGenerationChunk]]:
+        pieces = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or ['']
+        for i, piece in enumerate(pieces):
+            # The usage is reported once, on the last chunk
+            last = i == len(pieces) - 1
+            yield piece, ChatGenerationChunk(message=AIMessageChunk(content=piece,
+                                                                    usage_metadata=usage if last else None))
+
+
+class Recording:
+    """
+    Records of the reads, plans of the EXPLAINs and the graph schema recorded from Neo4j, keyed on the canonical
+    query text and its parameters. Lookups of queries that were not recorded are counted as misses.
+    """
+
+    def __init__(self, schema: Dict[str, Any] = None, reads: Dict[str, List[Dict[str, Any]]] = None,
+                 plans: Dict[str, Dict[str, Any]] = None) -> None:
+        self.schema = schema or {'node_props': {}, 'rel_props': {}, 'relationships': [], 'metadata': {}}
+        self.reads = reads or {}
+        self.plans = plans or {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(query: str, parameters: Optional[Dict[str, Any]]) -> str:
+        return json.dumps([canonical_cypher(query), parameters or {}], sort_keys=True, default=str)
+
+    def read(self, query: str, parameters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return self._lookup(self.reads, query, parameters, [])
+
+    def plan(self, query: str, parameters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        return self._lookup(self.plans, query, parameters, DEFAULT_PLAN)
+
+    def add_read(self, query: str, parameters: Optional[Dict[str, Any]], records: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self.reads[self.key(query, parameters)] = records
+
+    def add_plan(self, query: str, parameters: Optional[Dict[str, Any]], plan: Dict[str, Any]) -> None:
+        with self._lock:
+            self.plans[self.key(query, parameters)] = plan
+
+    def _lookup(self, entries: Dict[str, Any], query: str, parameters: Optional[Dict[str, Any]], default: Any) -> Any:
+        value = entries.get(self.key(query, parameters))
+        with self._lock:
+            self.hits += value is not None
+            self.misses += value is None
+        return value if value is not None else default
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    @classmethod
+    def load(cls, file: Path) -> 'Recording':
+        with open(file, 'r') as f:
+            data = json.load(f)
+        return cls(schema=data['schema'], reads=data['reads'], plans=data['plans'])
+
+    def save(self, file: Path) -> None:
+        with open(file, 'w') as f:
+            json.dump({'schema': self.schema, 'reads': self.reads, 'plans': self.plans}, f, indent=2, default=str)
+
+
+class RecordingNeo4jDB:
+    """
+    Wraps a Neo4jDB and records the records of its reads and the plans of its EXPLAINs
+    """
+
+    def __init__(self, db: Any, recording: Recording) -> None:
+        self.db = db
+        self.recording = recording
+
+    def execute_read(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None,
+                     max_rows: int = None) -> List[Dict]:
+        records = self.db.execute_read(query, parameters, timeout=timeout, max_rows=max_rows)
+        self.recording.add_read(query, parameters, records)
+        return records
+
+    def explain(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None) -> Dict[str, Any]:
+        plan = self.db.explain(query, parameters, timeout=timeout)
+        self.recording.add_plan(query, parameters, plan)
+        return plan
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.db, name)
+
+
+class RecordedNeo4jDB:
+    """
+    Stand-in of Neo4jDB that answers the reads and EXPLAINs from a Recording, each call takes `latency_ms`
+    """
+
+    def __init__(self, recording: Recording, latency_ms: float = 0.0) -> None:
+        self.recording = recording
+        self.latency_ms = latency_ms
+
+    def execute_read(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None,
+                     max_rows: int = None) -> List[Dict]:
+        time.sleep(self.latency_ms / 1000)
+        return list(self.recording.read(query, parameters)[:max_rows])
+
+    def explain(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None) -> Dict[str, Any]:
+        time.sleep(self.latency_ms / 1000)
+        return self.recording.plan(query, parameters)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AsyncRecordedNeo4jDB:
+    """
+    Async counterpart of RecordedNeo4jDB, in place of AsyncNeo4jDB
+    """
+
+    def __init__(self, recording: Recording, latency_ms: float = 0.0) -> None:
+        self.recording = recording
+        self.latency_ms = latency_ms
+
+    async def execute_read(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None,
+                           max_rows: int = None) -> List[Dict]:
+        await asyncio.sleep(self.latency_ms / 1000)
+        return list(self.recording.read(query, parameters)[:max_rows])
+
+    async def explain(self, query: str, parameters: Dict[str, Any] = None, timeout: float = None) -> Dict[str, Any]:
+        await asyncio.sleep(self.latency_ms / 1000)
+        return self.recording.plan(query, parameters)
+
+    async def close(self) -> None:
+        pass
+
+
+class RecordedGraph:
+    """
+    Stand-in of Neo4jGraph for the SchemaCache, the schema is the recorded one and is never refreshed
+    """
+
+    def __init__(self, structured_schema: Dict[str, Any]) -> None:
+        self.structured_schema = structured_schema
+
+    def refresh_schema(self) -> None:
+        pass
@@ -0,0 +1,99 @@
+import logging
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from src.pipeline.schema_cache import SchemaCache
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Token count approximated as 4 characters per token, counting with the model's tokenizer would be an API call
+    """
+    return (len(text) + 3) // 4
+
+
+class CypherPromptBuilder:
+    """
+    Builds the schema and the few-shot examples of the Cypher prompt for one question. The schema only keeps the
+    labels within `hops` relationships of the labels the entities resolved to or the question names, and the
+    relationships between them. When the schema, the entity mappings and the examples exceed `max_tokens`,
+    the least similar examples are dropped first (one is always kept), then the schema is cut back hop by hop.
+    Hops of None keep the full schema, a max_tokens of None disables the budget.
+    """
+
+    def __init__(self, schema_cache: SchemaCache, select_examples: Callable[[str], List[Dict[str, str]]],
+                 format_example: Callable[[Dict[str, str]], str], hops: Optional[int] = 1,
+                 max_tokens: Optional[int] = None) -> None:
+        self.schema_cache = schema_cache
+        self.select_examples = select_examples  # Examples for the question, most similar first
+        self.format_example = format_example
+        self.hops = hops
+        self.max_tokens = max_tokens
+        self.requests = 0
+        self.tokens_used = 0
+        self.tokens_saved = 0
+        self.over_budget = 0
+        self._lock = threading.Lock()
+
+    def build(self, question: str, matches: Dict[str, List[Dict[str, Any]]], entities_list: str) -> Dict[str, str]:
+        """
+        Returns the schema and the examples for the prompt
+        """
+        selected = [self.format_example(example) for example in self.select_examples(question)]
+        examples = list(selected)
+        seeds = self.seed_labels(question, matches)
+        hops = self.hops
+        schema = self._schema(seeds, hops)
+
+        # Cut the examples, then the schema hops, until the prompt parts fit the budget
+        def size() -> int:
+            return estimate_tokens(schema) + estimate_tokens(entities_list) + estimate_tokens('\n'.join(examples))
+
+        if self.max_tokens is not None:
+            while size() > self.max_tokens and len(examples) > 1:
+                examples.pop()
+            while size() > self.max_tokens and hops:
+                hops -= 1
+                schema = self._schema(seeds, hops)
+
+        used = size()
+        # Tokens the prompt would take with the full schema and all the selected examples
+        full = estimate_tokens(self.schema_cache.schema) + estimate_tokens(entities_list) + \
+            estimate_tokens('\n'.join(selected))
+        scope = f'labels within {hops} hops of {sorted(seeds)}' if seeds and hops is not None else 'full schema'
+        logger.info(f'Cypher prompt: {used} tokens, {full - used} saved ({scope}, {len(examples)} examples)')
+        with self._lock:
+            self.requests += 1
+            self.tokens_used += used
+            self.tokens_saved += full - used
+            if self.max_tokens is not None and used > self.max_tokens:
+                self.over_budget += 1
+                logger.warning(f'Cypher prompt over the budget of {self.max_tokens} tokens: {used}')
+        return {'schema': schema, 'examples': '\n'.join(examples)}
+
+    def seed_labels(self, question: str, matches: Dict[str, List[Dict[str, Any]]]) -> Set[str]:
+        """
+        Labels of the best candidate of every resolved entity, and labels the question names ("modules")
+        """
+        seeds = {candidates[0]['type'] for candidates in matches.values() if candidates}
+        words = set(re.findall(r'\w+', question.casefold()))
+        seeds.update(label for label in self.schema_cache.labels
+                      if label.casefold() in words or label.casefold() + 's' in words)
+        return seeds
+
+    def _schema(self, seeds: Set[str], hops: Optional[int]) -> str:
+        if hops is None:
+            return self.schema_cache.schema
+        return self.schema_cache.pruned(seeds, hops)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'mean_tokens': self.tokens_used / self.requests if self.requests else 0.0,
+                'tokens_saved': self.tokens_saved,
+                'over_budget': self.over_budget
+            }
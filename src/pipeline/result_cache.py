@@ -0,0 +1,83 @@
+import json
+import logging
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from src.pipeline.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# String literals and backquoted names are kept as they are, the whitespace between the other tokens is collapsed
+CYPHER_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`")
+
+
+def canonical_cypher(query: str) -> str:
+    """
+    Cypher text with the whitespace outside of literals collapsed and the trailing semicolon removed,
+    so the same query generated with different formatting maps to one cache entry
+    """
+    parts, last = [], 0
+    for literal in CYPHER_LITERAL.finditer(query):
+        parts.append(re.sub(r'\s+', ' ', query[last:literal.start()]))
+        parts.append(literal.group())
+        last = literal.end()
+    parts.append(re.sub(r'\s+', ' ', query[last:]))
+    return ''.join(parts).strip().rstrip(';').rstrip()
+
+
+def result_size(records: List[Dict[str, Any]]) -> int:
+    """
+    Approximate memory held by the records, measured as the length of their JSON encoding
+    """
+    return len(json.dumps(records, default=str))
+
+
+class ResultCache:
+    """
+    Read-through cache of the records returned by the generated Cypher queries, keyed on the canonical query text,
+    its parameters and the graph data version. Different questions often compile to the same query, only the first
+    one runs against Neo4j. The cache is bounded by the number of results and by their total size, results larger
+    than `max_result_bytes` are not cached at all.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, max_result_bytes: int) -> None:
+        self.max_result_bytes = max_result_bytes
+        self.oversized = 0
+        self._cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    @staticmethod
+    def key(query: str, parameters: Optional[Dict[str, Any]], version: Any) -> Tuple[str, str, Any]:
+        return canonical_cypher(query), json.dumps(parameters or {}, sort_keys=True, default=str), version
+
+    def read(self, query: str, parameters: Optional[Dict[str, Any]], version: Any,
+             run: Callable[[str, Optional[Dict[str, Any]]], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        key = self.key(query, parameters, version)
+        records = self._cache.get(key)
+        if records is None:
+            records = run(query, parameters)
+            self._put(key, records)
+        return records
+
+    async def aread(self, query: str, parameters: Optional[Dict[str, Any]], version: Any,
+                    run: Callable[[str, Optional[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]]) \
+            -> List[Dict[str, Any]]:
+        key = self.key(query, parameters, version)
+        records = self._cache.get(key)
+        if records is None:
+            records = await run(query, parameters)
+            self._put(key, records)
+        return records
+
+    def _put(self, key: Tuple[str, str, Any], records: List[Dict[str, Any]]) -> None:
+        size = result_size(records)
+        if size > self.max_result_bytes:
+            self.oversized += 1
+            logger.info(f'Not caching a {size} byte result of: {key[0]}')
+            return
+        self._cache.put(key, records, size=size)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._cache.stats(), 'oversized': self.oversized}
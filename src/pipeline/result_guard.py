@@ -0,0 +1,142 @@
+import json
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from src.pipeline.result_cache import CYPHER_LITERAL
+
+logger = logging.getLogger(__name__)
+
+# Longest text kept for a value in a summary
+MAX_VALUE_LENGTH = 200
+
+
+def enforce_limit(query: str, max_rows: int) -> str:
+    """
+    Adds LIMIT `max_rows` to the final RETURN of the query, or lowers a larger literal LIMIT to it.
+    UNION queries and queries without a RETURN are left as they are.
+    """
+    # Literals are blanked out so keywords inside strings are not matched
+    masked = CYPHER_LITERAL.sub(lambda literal: ' ' * len(literal.group()), query)
+    returns = list(re.finditer(r'\bRETURN\b', masked, re.IGNORECASE))
+    if not returns or re.search(r'\bUNION\b', masked, re.IGNORECASE):
+        return query
+
+    tail_start = returns[-1].end()
+    limit = re.search(r'\bLIMIT\s+(\d+)\s*;?\s*$', masked[tail_start:], re.IGNORECASE)
+    if limit is not None:
+        if int(limit.group(1)) <= max_rows:
+            return query
+        return query[:tail_start + limit.start(1)] + str(max_rows) + query[tail_start + limit.end(1):]
+    if re.search(r'\bLIMIT\b', masked[tail_start:], re.IGNORECASE):
+        return query  # LIMIT with a parameter or an expression
+    return query.rstrip().rstrip(';').rstrip() + f' LIMIT {max_rows}'
+
+
+def _number(value: Any) -> Optional[float]:
+    # Numbers are strings in data loaded before the completions were cast, and in CSV-like results
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _text(value: Any) -> str:
+    text = value if isinstance(value, str) else json.dumps(value, default=str, sort_keys=True)
+    return text if len(text) <= MAX_VALUE_LENGTH else text[:MAX_VALUE_LENGTH] + '...'
+
+
+def summarize_records(records: List[Dict[str, Any]], top_k: int) -> Dict[str, Any]:
+    """
+    Per column statistics of the records: count, min, max, mean and sum of the numeric columns,
+    distinct count and the `top_k` most frequent values of the others
+    """
+    columns = {}
+    for column in dict.fromkeys(key for record in records for key in record):
+        values = [record.get(column) for record in records if record.get(column) is not None]
+        numbers = [_number(value) for value in values]
+        # Ids are numeric strings too, their statistics mean nothing
+        if values and not column.endswith('_id') and all(number is not None for number in numbers):
+            columns[column] = {
+                'count': len(numbers),
+                'min': min(numbers),
+                'max': max(numbers),
+                'mean': round(sum(numbers) / len(numbers), 4),
+                'sum': round(sum(numbers), 4)
+            }
+        else:
+            counts = Counter(_text(value) for value in values)
+            columns[column] = {
+                'count': len(values),
+                'distinct': len(counts),
+                'most_common': [{'value': value, 'count': count} for value, count in counts.most_common(top_k)]
+            }
+    return {'columns': columns, 'first_rows': records[:top_k]}
+
+
+class ResultGuard:
+    """
+    Keeps the query results that reach the response prompt small. Generated queries get a LIMIT of `max_rows`,
+    every query is read as a stream that stops after `max_rows` records, and results with more than
+    `max_prompt_rows` records are replaced by a local summary (see summarize_records) before the response prompt.
+    """
+
+    def __init__(self, max_rows: int, max_prompt_rows: int, top_k: int) -> None:
+        if max_prompt_rows > max_rows:
+            raise ValueError('max_prompt_rows cannot be larger than max_rows')
+        self.max_rows = max_rows
+        self.max_prompt_rows = max_prompt_rows
+        self.top_k = top_k
+        self.requests = 0
+        self.rows_fetched = 0
+        self.rows_sent = 0
+        self.summarized = 0
+        self.truncated = 0
+        self._lock = threading.Lock()
+
+    def limit(self, query: str) -> str:
+        return enforce_limit(query, self.max_rows)
+
+    def prepare(self, records: List[Dict[str, Any]]) -> Tuple[Union[List[Dict[str, Any]], Dict[str, Any]], int]:
+        """
+        Returns what goes into the response prompt, the records or their summary, and the number of rows sent
+        """
+        truncated = len(records) >= self.max_rows
+        if len(records) <= self.max_prompt_rows:
+            response, sent = records, len(records)
+        else:
+            count = f'at least {len(records)}' if truncated else str(len(records))
+            response = {
+                'note': f'The query returned {count} rows, too many to list. '
+                        f'These are statistics over the rows and the first {self.top_k} rows.',
+                'rows': len(records),
+                **summarize_records(records, self.top_k)
+            }
+            sent = len(response['first_rows'])
+            logger.info(f'Summarized {len(records)} rows{" (truncated)" if truncated else ""}, {sent} rows sent')
+
+        with self._lock:
+            self.requests += 1
+            self.rows_fetched += len(records)
+            self.rows_sent += sent
+            self.summarized += response is not records
+            self.truncated += truncated
+        return response, sent
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'rows_fetched': self.rows_fetched,
+                'rows_sent': self.rows_sent,
+                'summarized': self.summarized,
+                'truncated': self.truncated
+            }
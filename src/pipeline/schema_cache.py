@@ -0,0 +1,121 @@
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from langchain_community.chains.graph_qa.cypher import construct_schema
+from langchain_community.chains.graph_qa.cypher_utils import CypherQueryCorrector, Schema
+from langchain_community.graphs import Neo4jGraph
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaCache:
+    """
+    Holds the graph schema that goes into the Cypher prompt and the CypherQueryCorrector built from it, so neither
+    is rebuilt per question. The schema is read from Neo4j again only on refresh, which the pipeline calls when the
+    graph data version changes. With a snapshot file the schema is also saved to disk along with the data version,
+    and a restart on unchanged data skips the APOC schema query.
+    """
+
+    # Internal bookkeeping nodes that the LLM should not see
+    EXCLUDED_LABELS = ['GraphMeta']
+
+    def __init__(self, graph: Neo4jGraph, snapshot_file: Optional[Path] = None) -> None:
+        self.graph = graph
+        self.snapshot_file = snapshot_file
+        self.version = None
+        self.structured_schema: Dict[str, Any] = {}
+        self.schema = ''
+        self.corrector = None
+        self._pruned: Dict[Tuple[frozenset, int], str] = {}
+        self._lock = threading.Lock()
+
+    def load(self, version: Any) -> None:
+        """
+        Loads the schema from the snapshot if it was taken at this data version, otherwise from the database
+        """
+        snapshot = self._read_snapshot()
+        if snapshot is not None and snapshot['version'] == version:
+            logger.info(f'Loaded graph schema snapshot for data version {version}')
+            self._set(version, snapshot['structured_schema'])
+        else:
+            self.refresh(version)
+
+    def refresh(self, version: Any) -> None:
+        self.graph.refresh_schema()
+        self._set(version, self.graph.structured_schema)
+        self._write_snapshot()
+        logger.info(f'Refreshed graph schema for data version {version}')
+
+    def _set(self, version: Any, structured_schema: Dict[str, Any]) -> None:
+        structured_schema = {
+            'node_props': {label: props for label, props in structured_schema.get('node_props', {}).items()
+                           if label not in self.EXCLUDED_LABELS},
+            'rel_props': structured_schema.get('rel_props', {}),
+            'relationships': [rel for rel in structured_schema.get('relationships', [])
+                              if rel['start'] not in self.EXCLUDED_LABELS and rel['end'] not in self.EXCLUDED_LABELS],
+            'metadata': structured_schema.get('metadata', {})
+        }
+        schema = construct_schema(structured_schema, [], self.EXCLUDED_LABELS)
+        corrector = CypherQueryCorrector([
+            Schema(el["start"], el["type"], el["end"]) for el in structured_schema['relationships']
+        ])
+        # Swapped together, so pruned() never pairs a schema with the pruned schemas of another version
+        with self._lock:
+            self.version = version
+            self.structured_schema = structured_schema
+            self._pruned = {}
+            self.schema = schema
+            self.corrector = corrector
+
+    @property
+    def labels(self) -> Set[str]:
+        return self._labels(self.structured_schema)
+
+    @staticmethod
+    def _labels(structured_schema: Dict[str, Any]) -> Set[str]:
+        return set(structured_schema.get('node_props', {})) | {
+            label for rel in structured_schema.get('relationships', []) for label in (rel['start'], rel['end'])}
+
+    def pruned(self, seeds: Iterable[str], hops: int) -> str:
+        """
+        Schema of the labels within `hops` relationships of the seed labels, and of the relationships between them.
+        Without any known seed label the full schema is returned.
+        """
+        # A refresh on another thread swaps these, the question keeps working on the ones it started with
+        with self._lock:
+            structured_schema, schema, cache = self.structured_schema, self.schema, self._pruned
+        seeds = frozenset(seeds) & self._labels(structured_schema)
+        if not seeds:
+            return schema
+        key = (seeds, hops)
+        pruned = cache.get(key)
+        if pruned is None:
+            labels = set(seeds)
+            for _ in range(hops):
+                labels |= {rel['end'] if rel['start'] in labels else rel['start']
+                           for rel in structured_schema['relationships']
+                           if rel['start'] in labels or rel['end'] in labels}
+            rel_types = {rel['type'] for rel in structured_schema['relationships']
+                         if rel['start'] in labels and rel['end'] in labels}
+            pruned = construct_schema(structured_schema, list(labels | rel_types), self.EXCLUDED_LABELS)
+            cache[key] = pruned
+        return pruned
+
+    def _read_snapshot(self) -> Optional[Dict[str, Any]]:
+        if self.snapshot_file is None or not self.snapshot_file.exists():
+            return None
+        try:
+            with open(self.snapshot_file, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable schema snapshot {self.snapshot_file}: {e}')
+            return None
+
+    def _write_snapshot(self) -> None:
+        if self.snapshot_file is None:
+            return
+        with open(self.snapshot_file, 'w') as file:
+            json.dump({'version': self.version, 'structured_schema': self.structured_schema}, file, default=str)
@@ -0,0 +1,97 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from src.pipeline.tracing import QueryTrace, StageTraceHandler
+
+
+# This Module has the events of a streamed answer:
+# StreamEvent is one event, the progress of the pipeline (entities, Cypher, rows), an answer token, or the end
+# StreamEventHandler is the StageTraceHandler that reports the progress of the stages as StreamEvents
+# StreamCancelHandler stops the pipeline of a streamed answer whose consumer stopped reading
+
+class StreamCancelled(Exception):
+    """
+    Raised in the worker of a streamed answer when the consumer stopped reading the events
+    """
+
+class StreamEvent:
+    """
+    One event of a streamed answer, `elapsed_ms` is the time since the question was asked
+    """
+
+    ENTITIES = 'entities'  # Names found in the question and the node each one resolved to
+    CYPHER = 'cypher'  # Cypher query about to run
+    ROWS = 'rows'  # Number of records the query returned
+    TOKEN = 'token'  # Piece of the answer
+    DONE = 'done'  # Full answer and the trace of the question
+    ERROR = 'error'  # Raised to the caller, not yielded
+
+    def __init__(self, event: str, data: Any, elapsed_ms: float) -> None:
+        self.event = event
+        self.data = data
+        self.elapsed_ms = elapsed_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'event': self.event, 'data': self.data, 'elapsed_ms': round(self.elapsed_ms, 3)}
+
+    def __repr__(self) -> str:
+        return f'StreamEvent({self.event!r}, {self.data!r}, {self.elapsed_ms:.0f}ms)'
+
+
+class StreamEventHandler(StageTraceHandler):
+    """
+    Fills the QueryTrace like StageTraceHandler, and passes the end of the entity mapping, cost guard and
+    DB execution stages to `emit` as StreamEvents. The answer tokens are emitted by the caller through `token`,
+    which also records the time to the first token in the trace.
+    """
+
+    def __init__(self, trace: QueryTrace, stages: List[str], emit: Callable[[StreamEvent], Any]) -> None:
+        super().__init__(trace, stages)
+        self.emit_event = emit
+        self.start = time.perf_counter()
+
+    def emit(self, event: str, data: Any) -> None:
+        self.emit_event(StreamEvent(event, data, (time.perf_counter() - self.start) * 1000))
+
+    def token(self, text: str) -> None:
+        if not text:
+            return
+        if self.trace.first_token_ms is None:
+            self.trace.first_token_ms = (time.perf_counter() - self.start) * 1000
+        self.emit(StreamEvent.TOKEN, text)
+
+    def on_stage_end(self, stage: str, outputs: Any) -> None:
+        if stage == 'entity_mapping':
+            self.emit(StreamEvent.ENTITIES, {
+                name: {'type': candidates[0]['type'], 'properties': candidates[0]['result']} if candidates else None
+                for name, candidates in outputs.items()})
+        elif stage == 'cost_guard':
+            self.emit(StreamEvent.CYPHER, outputs)
+        elif stage == 'db_execution':
+            self.emit(StreamEvent.ROWS, len(outputs))
+
+
+class StreamCancelHandler(BaseCallbackHandler):
+    """
+    Stops the pipeline of a streamed answer once `cancelled` is set, by raising StreamCancelled from the callbacks
+    at the start of the next run or at the next token of the response LLM. Closing the LangChain stream instead
+    would let the response LLM run to the end of its answer.
+    """
+
+    raise_error = True
+
+    def __init__(self, cancelled: threading.Event) -> None:
+        self.cancelled = cancelled
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, **kwargs: Any) -> None:
+        self._check()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self._check()
+
+    def _check(self) -> None:
+        if self.cancelled.is_set():
+            raise StreamCancelled()
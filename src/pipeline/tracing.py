@@ -0,0 +1,277 @@
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+
+# This Module has the instrumentation for the pipeline:
+# QueryTrace records wall time, DB time and token counts per stage for one question
+# StageTraceHandler is a LangChain callback that fills the trace from the named stages of the chain
+# PipelineMetrics aggregates the traces into per-stage latency histograms
+
+class StageStats:
+    """
+    Time and tokens spent in one stage of the pipeline
+    """
+
+    def __init__(self) -> None:
+        self.wall_ms = 0.0
+        self.db_ms = 0.0
+        self.llm_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'wall_ms': round(self.wall_ms, 3),
+            'db_ms': round(self.db_ms, 3),
+            'llm_calls': self.llm_calls,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens
+        }
+
+
+class QueryTrace:
+    """
+    Structured trace of one question through the pipeline
+    """
+
+    def __init__(self, question: str) -> None:
+        self.question = question
+        self.stages: Dict[str, StageStats] = {}
+        self.total_ms = 0.0
+        self.first_token_ms: Optional[float] = None  # Time to the first answer token, only when streamed
+        self.cached = False  # Answered from the answer cache, or by an identical question in flight
+        self.query: Optional[str] = None  # Cypher query that ran
+        self.rows_fetched: Optional[int] = None  # Records read from Neo4j
+        self.rows_sent: Optional[int] = None  # Records in the response prompt, fewer when the result was summarized
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def stage(self, name: str) -> StageStats:
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            return self.stages[name]
+
+    def add_db_time(self, stage: str, seconds: float) -> None:
+        self.stage(stage).db_ms += seconds * 1000
+
+    @property
+    def input_tokens(self) -> int:
+        return sum(stats.input_tokens for stats in self.stages.values())
+
+    @property
+    def output_tokens(self) -> int:
+        return sum(stats.output_tokens for stats in self.stages.values())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'question': self.question,
+            'total_ms': round(self.total_ms, 3),
+            'first_token_ms': round(self.first_token_ms, 3) if self.first_token_ms is not None else None,
+            'cached': self.cached,
+            'query': self.query,
+            'rows_fetched': self.rows_fetched,
+            'rows_sent': self.rows_sent,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'error': self.error,
+            'stages': {name: stats.to_dict() for name, stats in self.stages.items()}
+        }
+
+
+# Trace of the question being answered in the current thread or task
+CURRENT_TRACE: ContextVar[Optional[QueryTrace]] = ContextVar('current_trace', default=None)
+
+
+@contextmanager
+def db_timer(stage: str):
+    """
+    Adds the time spent in the block to the DB time of the stage, when a question is being traced
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.add_db_time(stage, time.perf_counter() - start)
+
+
+class StageTraceHandler(BaseCallbackHandler):
+    """
+    Fills a QueryTrace from the chain callbacks. Runs named after one of the stages are timed,
+    and the token usage of every LLM call is added to the stage it runs under.
+    """
+
+    def __init__(self, trace: QueryTrace, stages: List[str]) -> None:
+        self.trace = trace
+        self.stages = set(stages)
+        self._parents: Dict[UUID, Optional[UUID]] = {}
+        self._stage_runs: Dict[UUID, str] = {}
+        self._started: Dict[UUID, float] = {}
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._parents[run_id] = parent_run_id
+        name = kwargs.get('name')
+        if name in self.stages:
+            self._stage_runs[run_id] = name
+            self._started[run_id] = time.perf_counter()
+            self.on_stage_start(name, inputs)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_stage(run_id, outputs)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_stage(run_id, None)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._parents[run_id] = parent_run_id
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._parents[run_id] = parent_run_id
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        stage = self._find_stage(run_id)
+        if stage is None:
+            return
+        stats = self.trace.stage(stage)
+        stats.llm_calls += 1
+        input_tokens, output_tokens = self._token_usage(response)
+        stats.input_tokens += input_tokens
+        stats.output_tokens += output_tokens
+
+    def on_stage_start(self, stage: str, inputs: Any) -> None:
+        """
+        Hook for subclasses that need to follow the progress of the question
+        """
+        pass
+
+    def on_stage_end(self, stage: str, outputs: Any) -> None:
+        """
+        Hook for subclasses that need to follow the progress of the question
+        """
+        pass
+
+    def _end_stage(self, run_id: UUID, outputs: Any) -> None:
+        stage = self._stage_runs.get(run_id)
+        if stage is None:
+            return
+        self.trace.stage(stage).wall_ms += (time.perf_counter() - self._started.pop(run_id)) * 1000
+        if outputs is not None:
+            self.on_stage_end(stage, outputs)
+
+    def _find_stage(self, run_id: Optional[UUID]) -> Optional[str]:
+        while run_id is not None:
+            if run_id in self._stage_runs:
+                return self._stage_runs[run_id]
+            run_id = self._parents.get(run_id)
+        return None
+
+    @staticmethod
+    def _token_usage(response: LLMResult) -> Tuple[int, int]:
+        input_tokens, output_tokens = 0, 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    input_tokens += usage.get('input_tokens', 0)
+                    output_tokens += usage.get('output_tokens', 0)
+        if not (input_tokens or output_tokens) and response.llm_output:
+            usage = response.llm_output.get('token_usage') or {}
+            input_tokens = usage.get('prompt_tokens', 0)
+            output_tokens = usage.get('completion_tokens', 0)
+        return input_tokens, output_tokens
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket latency histogram in milliseconds, which also keeps the most recent samples for percentiles
+    """
+
+    BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+    def __init__(self, max_samples: int = 10000) -> None:
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)  # Last bucket is everything above the largest bound
+        self.count = 0
+        self.sum_ms = 0.0
+        self.samples = deque(maxlen=max_samples)
+
+    def observe(self, value_ms: float) -> None:
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, value_ms)] += 1
+        self.count += 1
+        self.sum_ms += value_ms
+        self.samples.append(value_ms)
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'mean_ms': self.sum_ms / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': {f'<={bound}': count for bound, count in zip(self.BUCKETS_MS, self.counts)}
+                       | {'inf': self.counts[-1]}
+        }
+
+
+class PipelineMetrics:
+    """
+    Aggregates the traces of all the questions into latency histograms per stage, plus the total
+    """
+
+    TOTAL = 'total'
+    FIRST_TOKEN = 'first_token'  # Time to the first token of the streamed answers
+
+    def __init__(self) -> None:
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.db_histograms: Dict[str, LatencyHistogram] = {}
+        self.tokens = {'input': 0, 'output': 0}
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, trace: QueryTrace) -> None:
+        with self._lock:
+            self._observe(self.histograms, self.TOTAL, trace.total_ms)
+            if trace.first_token_ms is not None:
+                self._observe(self.histograms, self.FIRST_TOKEN, trace.first_token_ms)
+            for stage, stats in trace.stages.items():
+                self._observe(self.histograms, stage, stats.wall_ms)
+                if stats.db_ms:
+                    self._observe(self.db_histograms, stage, stats.db_ms)
+            self.tokens['input'] += trace.input_tokens
+            self.tokens['output'] += trace.output_tokens
+            if trace.error is not None:
+                self.errors += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'wall': {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+                'db': {stage: histogram.summary() for stage, histogram in self.db_histograms.items()},
+                'tokens': dict(self.tokens),
+                'errors': self.errors
+            }
+
+    @staticmethod
+    def _observe(histograms: Dict[str, LatencyHistogram], name: str, value_ms: float) -> None:
+        if name not in histograms:
+            histograms[name] = LatencyHistogram()
+        histograms[name].observe(value_ms)
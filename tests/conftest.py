@@ -0,0 +1,45 @@
+# The tests of the loader run against a real Neo4j database, which they wipe.
+# They are skipped unless NEO4J_TEST_URI points at a database set aside for them.
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+import yaml
+
+from src.datamodel.graph_db import Neo4jDB, CypherQueryRepository
+
+ROOT_FOLDER = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope='session')
+def config():
+    with open(ROOT_FOLDER / 'config' / 'app_config.yaml') as file:
+        return yaml.safe_load(file)
+
+
+@pytest.fixture(scope='session')
+def query_repo(config):
+    return CypherQueryRepository(
+        examples_file=config['db']['neo4j']['examples_file'],
+        queries_file=config['db']['neo4j']['queries_file']
+    )
+
+
+@pytest.fixture
+def db(config):
+    uri = os.getenv('NEO4J_TEST_URI')
+    if not uri:
+        pytest.skip('NEO4J_TEST_URI is not set')
+    with Neo4jDB(uri, os.getenv('NEO4J_TEST_USER', 'neo4j'), os.getenv('NEO4J_TEST_PASSWORD'),
+                 database=os.getenv('NEO4J_TEST_DATABASE'), **config['db']['neo4j']['driver']) as db:
+        yield db
+
+
+@pytest.fixture
+def course_root(tmp_path):
+    """
+    A root folder whose ./data holds one section of the sample course
+    """
+    shutil.copytree(ROOT_FOLDER / 'data' / 'CS49C_F24_1', tmp_path / 'data' / 'CS49C_F24_1')
+    return tmp_path
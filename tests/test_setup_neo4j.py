@@ -0,0 +1,61 @@
+import shutil
+
+from src.datamodel.graph_db import QueryName
+from src.datamodel.ingest_state import IngestionState
+from scripts.setup_neo4j import BulkWriter, bump_graph_version, clear_graph, load_courses
+
+
+# Every relationship with the ids of its ends, Course ends also with their semester and section
+EDGES = """
+MATCH (a)-[r]->(b)
+RETURN type(r) AS type,
+       coalesce(a.student_id, a.instructor_id, a.assessment_id, a.module_id) AS start,
+       [b.course_id, b.semester, b.section_number, b.assessment_id, b.module_id] AS end
+"""
+
+
+def edges(db) -> set:
+    return {(row['type'], row['start'], tuple(row['end'])) for row in db.execute_read(EDGES)}
+
+
+def graph_version(db, query_repo) -> int:
+    return db.execute_read(query_repo.get_query(QueryName.GET_GRAPH_VERSION))[0]['version']
+
+
+def load(root, db, query_repo, **ingestion_cfg) -> int:
+    ingestion_cfg = {'mode': 'bulk', 'workers': 1, **ingestion_cfg}
+    with IngestionState(root / '.ingest_state.sqlite') as state:
+        state.clear()
+        writer = BulkWriter(db, query_repo, 100, state)
+        load_courses(root, ingestion_cfg, writer)
+    return bump_graph_version(db, query_repo)
+
+
+def test_clean_up_keeps_counting_the_graph_version(db, query_repo, course_root):
+    clear_graph(db, query_repo)
+    cleared = graph_version(db, query_repo)
+
+    loaded = load(course_root, db, query_repo)
+    assert loaded > cleared
+
+    # A clean up and a reload never hand out a version an answer or schema cache was keyed by before
+    clear_graph(db, query_repo)
+    assert graph_version(db, query_repo) > loaded
+    assert load(course_root, db, query_repo) > loaded + 1
+
+
+def test_serial_and_parallel_loads_enroll_students_in_their_section(db, query_repo, course_root):
+    # A second section of the same course with half of the students
+    section = course_root / 'data' / 'CS49C_F24_2'
+    shutil.copytree(course_root / 'data' / 'CS49C_F24_1', section)
+    students = (section / 'students.csv').read_text().splitlines()
+    (section / 'students.csv').write_text('\n'.join(students[:11]) + '\n')
+
+    clear_graph(db, query_repo)
+    load(course_root, db, query_repo, workers=1)
+    serial = edges(db)
+
+    clear_graph(db, query_repo)
+    load(course_root, db, query_repo, workers=2)
+    assert edges(db) == serial
+    assert sum(1 for edge in serial if edge[0] == 'ENROLLED_IN' and edge[2][2] == '2') == 10